@@ -1,119 +1,247 @@
 #!/usr/bin/env python3
 
 import os, sys
+import glob
 import json
 import ast
 import hashlib
-from typing import List, Set, Dict, Tuple, Any, Callable
+from typing import List, Set, Dict, Tuple, Any, Callable, Iterator
 import argparse
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from ast_cache import cache_from_env, converter_tag
+from ast_dataflow import dataflow, scopes_dict, test_dataflow
+from ast_clones import find_clones
+from ast_query import select, test_select
+from ast_scopes import build_scopes, scope_tables, test_scopes
+from ast_store import write_store
+import flat_tree
+import ast_json
+import ast_stats
 
 node_id_counter = 0
 
-def node_to_dict(node, level=0, parent_id=None):
-    global node_id_counter
-    node_id = str(node_id_counter)
-    node_id_counter += 1
-    tree_node = {
-        '__type': type(node).__name__,
-        '_id': node_id,
-        '_loc': {},
-        '_val_hash': None,
-        '_tree_hash': None,
-        '_weight': None,
-        '_max_depth': None,
-        '_level': level,
-        '_parent_id': parent_id,
-    }
-    weight = 1
-    max_depth = 0
-    for k,v in node.__dict__.items():
-        if k == 'col_offset' or k == 'lineno':
-            tree_node['_loc'][k] = v
-            continue
-        weight += 1
-        if isinstance(v, str) or isinstance(v, int) or isinstance(v, float) or v is None:
-            tree_node[k] = v
-        elif isinstance(v, list):
-            if len(v) > 0 and isinstance(v[0], str):
-                tree_node[k] = v
-            else:
-                children = []
-                for item in v:
-                    child_node = node_to_dict(item, level+1, node_id)
-                    weight += child_node['_weight']
-                    max_depth = max([max_depth, child_node['_max_depth'] + 1])
-                    children.append(child_node)
-                tree_node[k] = children
-        else:
-            attr_node = node_to_dict(v, level+1, node_id)
-            weight += attr_node['_weight']
-            max_depth = max([max_depth, attr_node['_max_depth'] + 1])
-            tree_node[k] = attr_node
-
-    tree_node['_weight'] = weight
-    tree_node['_max_depth'] = max_depth
-
-    tree_value = filter_meta(tree_node)
-    canonical_value = json.dumps(tree_value, sort_keys=True)
+# location attributes, stored in _loc and not part of values of node
+LOC_FIELDS = ('lineno', 'col_offset', 'end_lineno', 'end_col_offset')
 
-    tree_structure = filter_tree_structure(tree_node)
-    canonical_tree = json.dumps(tree_structure, sort_keys=True)
+# attribute values stored as is, bool is int
+SCALAR_TYPES = (str, int, float, type(None))
 
-    #print('canonical_value', canonical_value)
-    #print('canonical_tree', canonical_tree)
+# same output as json.dumps(..., sort_keys=True), without creating encoder for each node
+_canonical_encoder = json.JSONEncoder(sort_keys=True)
 
-    tree_node['_val_hash'] = hashlib.md5(canonical_value.encode('utf-8')).hexdigest()
-    tree_node['_tree_hash'] = hashlib.md5(canonical_tree.encode('utf-8')).hexdigest()
+def node_hash(fields, children):
+    """
+    Merkle hash of a node: md5 of its own fields plus hashes of its children.
+    """
+    canonical = _canonical_encoder.encode([fields, children])
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
 
-    return tree_node
+def node_to_dict(node, level=0, parent_id=None):
+    """
+    Convert ast node with subtree to tree of dicts, without recursion:
+    first pass creates dicts in pre-order (ids, levels, scalars, child links),
+    second pass in reverse pre-order computes weights, depths and hashes
+    from already finished children.
+    """
+    global node_id_counter
+    order = []
+    root = None
+    # (ast node, level, parent id, parent dict, key in parent, index in list or None)
+    stack = [(node, level, parent_id, None, None, None)]
+    while stack:
+        node, level, parent_id, parent, key, index = stack.pop()
+        node_id = str(node_id_counter)
+        node_id_counter += 1
+        tree_node = {
+            '__type': type(node).__name__,
+            '_id': node_id,
+            '_loc': {},
+            '_val_hash': None,
+            '_tree_hash': None,
+            '_weight': None,
+            '_max_depth': None,
+            '_level': level,
+            '_parent_id': parent_id,
+        }
+        if parent is None:
+            root = tree_node
+        elif index is not None:
+            parent[key][index] = tree_node
+        else:
+            parent[key] = tree_node
+        order.append(tree_node)
+        children = []
+        loc = tree_node['_loc']
+        for k,v in node.__dict__.items():
+            if k in LOC_FIELDS:
+                loc[k] = v
+            elif isinstance(v, SCALAR_TYPES):
+                tree_node[k] = v
+            elif isinstance(v, list):
+                if len(v) > 0 and isinstance(v[0], str):
+                    tree_node[k] = v
+                else:
+                    # None items (kw_defaults, keys of dict unpacking) stay None
+                    tree_node[k] = [None] * len(v)
+                    for i, item in enumerate(v):
+                        if item is not None:
+                            children.append((item, level+1, node_id, tree_node, k, i))
+            elif isinstance(v, ast.AST):
+                # placeholder keeps order of keys
+                tree_node[k] = None
+                children.append((v, level+1, node_id, tree_node, k, None))
+            else:
+                # bytes, complex and Ellipsis constants
+                tree_node[k] = repr(v)
+        children.reverse()
+        stack.extend(children)
+
+    ast_stats.count('nodes converted', len(order))
+    with ast_stats.phase('hash'):
+        for tree_node in reversed(order):
+            # own fields and child hashes, the same values filter_meta and filter_tree_structure keep
+            value_fields = {'__type': tree_node['__type']}
+            value_children = {}
+            tree_children = {}
+            weight = 1
+            max_depth = 0
+            for k,v in tree_node.items():
+                if k[0] == '_':
+                    continue
+                weight += 1
+                if isinstance(v, dict):
+                    weight += v['_weight']
+                    if v['_max_depth'] >= max_depth:
+                        max_depth = v['_max_depth'] + 1
+                    value_children[k] = v['_val_hash']
+                    tree_children[k] = v['_tree_hash']
+                elif isinstance(v, list) and (len(v) == 0 or not isinstance(v[0], str)):
+                    val = []
+                    tre = []
+                    for child in v:
+                        if child is None:
+                            val.append(None)
+                            tre.append(None)
+                            continue
+                        weight += child['_weight']
+                        if child['_max_depth'] >= max_depth:
+                            max_depth = child['_max_depth'] + 1
+                        val.append(child['_val_hash'])
+                        tre.append(child['_tree_hash'])
+                    value_children[k] = val
+                    tree_children[k] = tre
+                else:
+                    value_fields[k] = v
+            tree_node['_weight'] = weight
+            tree_node['_max_depth'] = max_depth
+            tree_node['_val_hash'] = node_hash(value_fields, value_children)
+            tree_node['_tree_hash'] = node_hash({'__type': tree_node['__type']}, tree_children)
+
+    return root
 
 def filter_meta(node):
-    obj = {}
-    for k,v in node.items():
-        if k[0] == '_' and k != '__type':
-            continue
-        if isinstance(v, str) or isinstance(v, int) or isinstance(v, float) or v is None:
-            obj[k] = v
-        elif isinstance(v, list):
-            if len(v) > 0 and isinstance(v[0], str):
+    """
+    Copy of tree without meta attributes, except __type
+    """
+    root = {}
+    stack = [(node, root)]
+    while stack:
+        node, obj = stack.pop()
+        for k,v in node.items():
+            if k[0] == '_' and k != '__type':
+                continue
+            if isinstance(v, SCALAR_TYPES):
                 obj[k] = v
+            elif isinstance(v, list):
+                if len(v) > 0 and isinstance(v[0], str):
+                    obj[k] = v
+                else:
+                    children = []
+                    for item in v:
+                        if item is None:
+                            children.append(None)
+                            continue
+                        child_obj = {}
+                        children.append(child_obj)
+                        stack.append((item, child_obj))
+                    obj[k] = children
             else:
-                children = []
-                for item in v:
-                    child_node = filter_meta(item)
-                    children.append(child_node)
-                obj[k] = children
-        else:
-            obj[k] = filter_meta(v)
-    return obj
+                child_obj = {}
+                obj[k] = child_obj
+                stack.append((v, child_obj))
+    return root
 
 def filter_tree_structure(node):
-    obj = {}
-    for k,v in node.items():
-        if k == '__type':
-            obj[k] = v
-        if k[0] == '_':
-            continue
-        if isinstance(v, str) or isinstance(v, int) or isinstance(v, float) or v is None:
-            continue
-        elif isinstance(v, list):
-            if len(v) > 0 and isinstance(v[0], str):
+    """
+    Copy of tree with only types and child nodes
+    """
+    root = {}
+    stack = [(node, root)]
+    while stack:
+        node, obj = stack.pop()
+        for k,v in node.items():
+            if k == '__type':
+                obj[k] = v
+            if k[0] == '_' or isinstance(v, SCALAR_TYPES):
                 continue
-            else:
+            elif isinstance(v, list):
+                if len(v) > 0 and isinstance(v[0], str):
+                    continue
                 children = []
                 for item in v:
-                    child_node = filter_tree_structure(item)
-                    children.append(child_node)
+                    if item is None:
+                        children.append(None)
+                        continue
+                    child_obj = {}
+                    children.append(child_obj)
+                    stack.append((item, child_obj))
                 obj[k] = children
-        else:
-            obj[k] = filter_tree_structure(v)
-    return obj
+            else:
+                child_obj = {}
+                obj[k] = child_obj
+                stack.append((v, child_obj))
+    return root
 
-def parse_file(filename):
-    with open(filename) as f:
+def parse_file(filename, cache=None, flat=False):
+    """
+    Parse file and convert to tree, with cache (ast_cache.parse_cache) skip both on hit.
+    With flat returns root view of flat_tree.flat_tree instead of nested dicts.
+    """
+    global node_id_counter
+    with open(filename, 'rb') as f:
         code = f.read()
-    ast_tree = ast.parse(code)
-    return node_to_dict(ast_tree)
+    ast_stats.count('bytes parsed', len(code))
+    if cache is not None:
+        with ast_stats.phase('cache'):
+            key = cache.key(b'flat\0' + code if flat else code)
+            tree = cache.get(key)
+        if tree is not None:
+            ast_stats.count('cache hits')
+            return flat_tree.flat_tree.from_tuple(tree).root() if flat else tree
+        ast_stats.count('cache misses')
+    with ast_stats.phase('parse'):
+        ast_tree = ast.parse(code)
+    if flat:
+        with ast_stats.phase('convert'):
+            ft = flat_tree.flat_tree.from_ast(ast_tree)
+        ast_stats.count('nodes converted', len(ft))
+        if cache is not None:
+            with ast_stats.phase('cache'):
+                cache.put(key, ft.to_tuple())
+        return ft.root()
+    node_id_counter = 0
+    with ast_stats.phase('convert'):
+        tree = node_to_dict(ast_tree)
+    if cache is not None:
+        with ast_stats.phase('cache'):
+            cache.put(key, tree)
+    return tree
 
 
 
@@ -161,30 +289,82 @@ def parse_file(filename):
 # TODO: data flow graph for each scope
 # TODO: variable type inference
 
+def iter_nodes(
+    node: Dict[str, Any],
+    order: str = 'pre',
+    prune: Callable[[Dict[str, Any]], bool] = None
+    ) -> Iterator[Dict[str, Any]]:
+    """
+    Lazy traversal of tree in pre-order or post-order with explicit stack.
+    Children of nodes for which prune(node) is true are not visited (node itself is),
+    stop iteration to exit early.
+    """
+    if order not in ('pre', 'post'):
+        raise ValueError(f'order must be pre or post, not {order}')
+    post = order == 'post'
+    # post-order visit of node is marked by tuple (node,) on stack
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if type(node) is tuple:
+            yield node[0]
+            continue
+        if node is None:
+            # None item of list
+            continue
+        if post:
+            stack.append((node,))
+        else:
+            yield node
+        if prune is not None and prune(node):
+            continue
+        for k,v in reversed(node.items()):
+            if k[0] == '_' or isinstance(v, SCALAR_TYPES):
+                continue
+            elif isinstance(v, list):
+                if len(v) > 0 and isinstance(v[0], str):
+                    continue
+                stack.extend(reversed(v))
+            else:
+                stack.append(v)
+
 def walk_tree(
     node: Dict[str, Any],
     visitor_pre: Callable[[Dict[str, Any]], None] = None,
     visitor_post: Callable[[Dict[str, Any]], None] = None
     ):
-    if visitor_pre is not None:
-        visitor_pre(node)
-    for k,v in node.items():
-        if k == '__type':
+    # attributes of nodes by type, nodes of one type have the same attributes
+    fields_of = {}
+    # post-order visit of node is marked by tuple (node,) on stack, only with visitor_post
+    stack = [node]
+    pop = stack.pop
+    while stack:
+        node = pop()
+        if node is None:
+            # None item of list
             continue
-        if k[0] == '_':
+        if type(node) is tuple:
+            visitor_post(node[0])
             continue
-        if isinstance(v, str) or isinstance(v, int) or isinstance(v, float) or v is None:
-            continue
-        elif isinstance(v, list):
-            if len(v) > 0 and isinstance(v[0], str):
-                continue
-            else:
-                for item in v:
-                    walk_tree(item, visitor_pre, visitor_post)
-        else:
-            walk_tree(v, visitor_pre, visitor_post)
-    if visitor_post is not None:
-        visitor_post(node)
+        if visitor_pre is not None:
+            visitor_pre(node)
+        if visitor_post is not None:
+            stack.append((node,))
+        type_name = node['__type']
+        fields = fields_of.get(type_name)
+        if fields is None:
+            fields = fields_of[type_name] = tuple(k for k in node.keys() if k[0] != '_')
+        # children of each attribute are inserted at the same position, so first child is popped first
+        top = len(stack)
+        for k in fields:
+            v = node[k]
+            t = type(v)
+            if t is list:
+                if len(v) == 0 or type(v[0]) is str:
+                    continue
+                stack[top:top] = v[::-1]
+            elif t is dict or not isinstance(v, SCALAR_TYPES):
+                stack.insert(top, v)
 
 def get_flat_node(node):
     """
@@ -200,66 +380,581 @@ def get_flat_node(node):
             if len(v) > 0 and isinstance(v[0], str):
                 flat_node[k] = v
             else:
-                flat_node[k] = [{'_id':item['_id']} for item in v]
+                flat_node[k] = [None if item is None else {'_id':item['_id']} for item in v]
         else:
             flat_node[k] = {'_id':v['_id']}
     return flat_node
 
 class tables:
-    def __init__(self):
-        self.node_by_id = {}
-        self.node_id_by_type = {}
+    """
+    Columnar, append-only store of visited nodes.
+
+    Every node gets a row; integer node ids, parent ids, type codes and hash
+    codes live in typed arrays, type names and hashes are interned.
+    Groupings are built lazily as CSR arrays: rows of key code k of an index
+    are order[offsets[k]:offsets[k+1]], in visiting order.
+
+    Nodes must be visited in pre-order (walk_tree(tree, tables_instance)),
+    so rows are sorted by node id and parents come before children.
 
+    Tables of several files are merged with extend(), node ids of merged
+    rows are namespaced as 'file:id'.
+
+    With on_node callback flat nodes are passed to it instead of stored in
+    nodes, for streaming output: only the typed columns stay in memory.
+    """
+
+    def __init__(self, on_node=None):
+        # flat nodes, one per row, empty if on_node is set
+        self.nodes = []
+        self.on_node = on_node
+
+        # file code of row, -1 for not namespaced nodes
+        self.files = array('l')
+        self.file_names = []
+        self.file_codes = {}
+        # first row of each file, rows of one file are contiguous
+        self.file_offsets = array('q')
+
+        self.ids = array('q')
+        self.parent_ids = array('q')
+        self.max_depths = array('l')
+        self.weights = array('q')
+
+        # codes, -1 if node is not indexed (leaf nodes for hashes and type_depth_weight)
+        self.types = array('l')
+        self.trees = array('q')
+        self.values = array('q')
+        self.type_depth_weights = array('q')
+
+        self.type_names = []
+        self.type_codes = {}
+
+        # shared by tree and value hashes
+        self.hashes = []
+        self.hash_codes = {}
+
+        self.tdw_keys = []
+        self.tdw_codes = {}
+
+        self._cache = {}
+
+    def _index(self, name):
+        if name == 'types':
+            return self.types, self.type_names, self.type_codes
+        if name == 'trees':
+            return self.trees, self.hashes, self.hash_codes
+        if name == 'values':
+            return self.values, self.hashes, self.hash_codes
+        if name == 'type_depth_weight':
+            return self.type_depth_weights, self.tdw_keys, self.tdw_codes
+        raise KeyError(name)
+
+    def group(self, name):
+        """
+        CSR arrays (offsets, order) of index name, build on first use
+        """
+        if name not in self._cache:
+            column, keys, _ = self._index(name)
+            order = array('q', sorted(range(len(column)), key=column.__getitem__))
+            counts = Counter(column)
+            offsets = array('q', [0]*(len(keys) + 1))
+            offsets[0] = counts.get(-1, 0)
+            for code in range(len(keys)):
+                offsets[code + 1] = offsets[code] + counts.get(code, 0)
+            self._cache[name] = (offsets, order)
+        return self._cache[name]
+
+    def rows(self, name, key):
+        """
+        Rows of nodes with key in index name, for example rows('types', 'Name')
+        """
+        _, _, codes = self._index(name)
+        code = codes.get(key)
+        if code is None:
+            return array('q')
+        offsets, order = self.group(name)
+        return order[offsets[code]:offsets[code + 1]]
+
+    def row(self, node_id):
+        lo, hi = 0, len(self.ids)
+        local_id = node_id
+        if isinstance(node_id, str) and ':' in node_id:
+            file_name, local_id = node_id.rsplit(':', 1)
+            file_code = self.file_codes[file_name]
+            lo = self.file_offsets[file_code]
+            if file_code + 1 < len(self.file_offsets):
+                hi = self.file_offsets[file_code + 1]
+        local_id = int(local_id)
+        row = bisect_left(self.ids, local_id, lo, hi)
+        if row == hi or self.ids[row] != local_id:
+            raise KeyError(node_id)
+        return row
+
+    def node_id(self, row):
+        file_code = self.files[row]
+        if file_code < 0:
+            return str(self.ids[row])
+        return f'{self.file_names[file_code]}:{self.ids[row]}'
+
+    def node(self, node_id):
+        return self.nodes[self.row(node_id)]
+
+    def parent_rows(self):
+        """
+        Row of parent of each row, -1 for roots
+        """
+        if 'parents' not in self._cache:
+            ids = self.ids
+            parents = array('q', [-1]) * len(ids)
+            for row, parent_id in enumerate(self.parent_ids):
+                if parent_id < 0:
+                    continue
+                file_code = self.files[row]
+                lo = self.file_offsets[file_code] if file_code >= 0 else 0
+                parents[row] = bisect_left(ids, parent_id, lo, row)
+            self._cache['parents'] = parents
+        return self._cache['parents']
+
+    def subtree_ends(self):
+        """
+        Row after last row of subtree of each row: subtree of row is rows[row:end], rows are in pre-order
+        """
+        if 'ends' not in self._cache:
+            parents = self.parent_rows()
+            ends = array('q', range(1, len(self.ids) + 1))
+            for row in range(len(ends) - 1, -1, -1):
+                parent = parents[row]
+                if parent >= 0 and ends[row] > ends[parent]:
+                    ends[parent] = ends[row]
+            self._cache['ends'] = ends
+        return self._cache['ends']
+
+    def iter_index(self, name):
+        """
+        Pairs (key, list of node ids) of index name, in order of first occurrence of keys
+        """
+        _, keys, _ = self._index(name)
+        offsets, order = self.group(name)
+        for code, key in enumerate(keys):
+            group = order[offsets[code]:offsets[code + 1]]
+            if len(group) > 0:
+                yield key, [self.node_id(row) for row in group]
+
+    def index_dict(self, name):
+        """
+        Index name as dict: key -> list of node ids
+        """
+        return dict(self.iter_index(name))
+
+    @property
+    def node_by_id(self):
+        return {self.node_id(row): node for row, node in enumerate(self.nodes)}
+
+    @property
+    def node_id_by_type(self):
+        return self.index_dict('types')
+
+    @property
+    def node_id_by_tree(self):
         # list of nodes by tree hash (nodes of identical structure)
-        self.node_id_by_tree = {}
+        return self.index_dict('trees')
 
+    @property
+    def node_id_by_value(self):
         # list of nodes by value hash (identical nodes)
-        self.node_id_by_value = {}
+        return self.index_dict('values')
 
-        self.node_id_by_type_depth_weight = {}
+    @property
+    def node_id_by_type_depth_weight(self):
+        return self.index_dict('type_depth_weight')
 
     def to_dict(self):
-        return {
+        d = {
             'nodes' : self.node_by_id,
             'trees' : self.node_id_by_tree,
             'types' : self.node_id_by_type,
             'type_depth_weight' : self.node_id_by_type_depth_weight,
             'values' : self.node_id_by_value,
         }
+        if len(self.file_names) > 0:
+            d['files'] = self.file_names
+        return d
+
+    @staticmethod
+    def _intern(keys, codes, key):
+        code = codes.get(key)
+        if code is None:
+            code = len(keys)
+            codes[key] = code
+            keys.append(key)
+        return code
 
     def __call__(self, node):
-        node_id = node['_id']
         node_type = node['__type']
-        node_val_hash = node['_val_hash']
-        node_tree_hash = node['_tree_hash']
-        tdw = f"{node_type}_{node['_max_depth']}_{node['_weight']}"
-        self.node_by_id[node_id] = get_flat_node(node)
-        self.node_id_by_type[node_type] = self.node_id_by_type.get(node_type, []) + [node_id]
-        if node['_max_depth'] > 0:
-            self.node_id_by_tree[node_tree_hash] = self.node_id_by_tree.get(node_tree_hash, []) + [node_id]
-            self.node_id_by_value[node_val_hash] = self.node_id_by_value.get(node_val_hash, []) + [node_id]
-            self.node_id_by_type_depth_weight[tdw] = self.node_id_by_type_depth_weight.get(tdw, []) + [node_id]
+        parent_id = node['_parent_id']
+        max_depth = node['_max_depth']
+        weight = node['_weight']
+        if self.on_node is not None:
+            self.on_node(get_flat_node(node))
+        else:
+            self.nodes.append(get_flat_node(node))
+        self.files.append(-1)
+        self.ids.append(int(node['_id']))
+        self.parent_ids.append(-1 if parent_id is None else int(parent_id))
+        self.max_depths.append(max_depth)
+        self.weights.append(weight)
+        self.types.append(self._intern(self.type_names, self.type_codes, node_type))
+        if max_depth > 0:
+            tdw = f"{node_type}_{max_depth}_{weight}"
+            self.trees.append(self._intern(self.hashes, self.hash_codes, node['_tree_hash']))
+            self.values.append(self._intern(self.hashes, self.hash_codes, node['_val_hash']))
+            self.type_depth_weights.append(self._intern(self.tdw_keys, self.tdw_codes, tdw))
+        else:
+            self.trees.append(-1)
+            self.values.append(-1)
+            self.type_depth_weights.append(-1)
+        if self._cache:
+            self._cache = {}
+
+    def extend(self, other, file_name):
+        """
+        Append all rows of other (tables of single file) in namespace file_name
+        """
+        file_code = self._intern(self.file_names, self.file_codes, file_name)
+        self.file_offsets.append(len(self.ids))
+
+        if self.on_node is not None:
+            for node in other.nodes:
+                self.on_node(namespace_node(node, file_name))
+        else:
+            self.nodes.extend(namespace_node(node, file_name) for node in other.nodes)
+        self.files.extend(array('l', [file_code]) * len(other.ids))
+        self.ids.extend(other.ids)
+        self.parent_ids.extend(other.parent_ids)
+        self.max_depths.extend(other.max_depths)
+        self.weights.extend(other.weights)
+
+        def remap(column, other_column, other_keys, keys, codes):
+            m = [self._intern(keys, codes, key) for key in other_keys]
+            column.extend(array(column.typecode, [m[code] if code >= 0 else -1 for code in other_column]))
+
+        remap(self.types, other.types, other.type_names, self.type_names, self.type_codes)
+        remap(self.trees, other.trees, other.hashes, self.hashes, self.hash_codes)
+        remap(self.values, other.values, other.hashes, self.hashes, self.hash_codes)
+        remap(self.type_depth_weights, other.type_depth_weights, other.tdw_keys, self.tdw_keys, self.tdw_codes)
+        self._cache = {}
+
+
+def namespace_node(flat_node, file_name):
+    """
+    Prefix node id, parent id and child stub ids of flat node with file_name
+    """
+    node = {}
+    for k,v in flat_node.items():
+        if k == '_id' or (k == '_parent_id' and v is not None):
+            node[k] = f'{file_name}:{v}'
+        elif isinstance(v, dict) and '_id' in v:
+            node[k] = {'_id': f'{file_name}:{v["_id"]}'}
+        elif isinstance(v, list) and len(v) > 0 and not isinstance(v[0], str):
+            node[k] = [None if item is None else {'_id': f'{file_name}:{item["_id"]}'} for item in v]
+        else:
+            node[k] = v
+    return node
+
+
+def find_files(paths):
+    """
+    Expand directories and glob patterns into sorted list of *.py files
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.update(os.path.join(root, name) for name in names if name.endswith('.py'))
+        elif glob.has_magic(path):
+            files.update(name for name in glob.glob(path, recursive=True) if os.path.isfile(name))
+        else:
+            files.add(path)
+    return sorted(files)
+
+
+def dump_file(filename, cache=None, flat=False, mode='tables'):
+    """
+    Process pool worker: parse file and build its tables, its scope tables (mode 'scopes')
+    or data-flow graphs of its scopes (mode 'dataflow', graphs are cached in cache)
+    """
+    try:
+        tree = parse_file(filename, cache, flat)
+    except (SyntaxError, ValueError, UnicodeDecodeError, RecursionError) as e:
+        return filename, None, f'{type(e).__name__}: {e}'
+    if mode == 'scopes':
+        with ast_stats.phase('scopes'):
+            return filename, build_scopes(tree.to_dict() if flat else tree), None
+    if mode == 'dataflow':
+        return filename, scopes_dict(dataflow(cache).update(tree.to_dict() if flat else tree)), None
+    ic = tables()
+    with ast_stats.phase('tables'):
+        walk_tree(tree, ic)
+    return filename, ic, None
+
 
+def dump_project(files, jobs=None, cache=None, flat=False, on_node=None, mode='tables'):
+    """
+    Parse files in process pool and merge their tables into one project-wide index.
+    Files are merged in order of files list, whatever the number of jobs.
+    Flat nodes are passed to on_node as each file is merged, see tables.
+    In mode 'scopes' scope tables of files are merged instead, see ast_scopes.py,
+    in mode 'dataflow' result is dict: file name -> graphs of file, see ast_dataflow.py.
+    """
+    project = scope_tables() if mode == 'scopes' else {} if mode == 'dataflow' else tables(on_node)
+    errors = {}
+    worker = ast_stats.traced(partial(dump_file, cache=cache, flat=flat, mode=mode))
+    if jobs == 1:
+        results = map(worker, files)
+    else:
+        executor = ProcessPoolExecutor(jobs)
+        results = executor.map(worker, files, chunksize=max(1, len(files) // (8 * (jobs or os.cpu_count() or 1))))
+    for filename, ic, error in ast_stats.untraced(results):
+        if error is not None:
+            print(f'{filename}: {error}', file=sys.stderr)
+            errors[filename] = error
+            continue
+        with ast_stats.phase('merge'):
+            if mode == 'dataflow':
+                project[filename] = ic
+            else:
+                project.extend(ic, filename)
+    if jobs != 1:
+        executor.shutdown()
+    return project, errors
+
+
+
+def write_json(obj, out=None):
+    """
+    Write obj as indented JSON block by block, without building the whole string
+    """
+    out = out or sys.stdout
+    with ast_stats.phase('serialize'):
+        chunks = ast_json.iterencode(obj, indent=4, sort_keys=True)
+        # join small chunks of encoder, stdout can be unbuffered
+        while True:
+            block = ''.join(islice(chunks, 4096))
+            if not block:
+                break
+            ast_stats.count('bytes serialized', len(block))
+            out.write(block)
+        out.write('\n')
+
+
+def write_line(obj, out=None):
+    """
+    Write obj as one line of NDJSON
+    """
+    out = out or sys.stdout
+    try:
+        line = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    except RecursionError:
+        # whole tree of deeply nested code
+        line = ast_json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    if ast_stats.enabled:
+        ast_stats.counters['bytes serialized'] += len(line) + 1
+    out.write(line)
+    out.write('\n')
+
+
+def write_ndjson_indexes(ic, errors=None, out=None):
+    """
+    Write files, errors and indexes of tables, one key of index per line
+    """
+    if len(ic.file_names) > 0:
+        write_line({'files': ic.file_names}, out)
+    for filename, error in (errors or {}).items():
+        write_line({'file': filename, 'error': error}, out)
+    for name in ('trees', 'types', 'type_depth_weight', 'values'):
+        for key, node_ids in ic.iter_index(name):
+            write_line({'index': name, 'key': key, 'nodes': node_ids}, out)
+
+
+def write_selected(ic, selector, ndjson=False, out=None):
+    """
+    Write flat nodes of tables ic matching selector (ast_query.py), as dict by node id or one per line
+    """
+    with ast_stats.phase('select'):
+        rows = select(ic, selector)
+    if ndjson:
+        for row in rows:
+            write_line(ic.nodes[row], out)
+    else:
+        write_json({ic.node_id(row): ic.nodes[row] for row in rows}, out)
+
+
+def write_ndjson_clones(clones, out=None):
+    for kind, groups in clones.items():
+        for group in groups:
+            line = {'clones': kind}
+            line.update(group)
+            write_line(line, out)
+
+
+def run_tests():
+    test_select()
+    test_scopes()
+    test_dataflow()
 
 
 def main():
     parser = argparse.ArgumentParser(description='Dump AST (Abstract Syntax Tree) for Python code.')
-    parser.add_argument('filepath', metavar='file.py',
-                        help='*.py file to parse')
+    parser.add_argument('filepath', metavar='file.py', nargs='*',
+                        help='*.py file to parse, or directories and glob patterns to dump whole project')
     parser.add_argument('--tree', action='store_true',
                         help='dump tree instead of list of tables')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes in project mode (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory of persistent parse cache (default: $AST_CACHE_DIR, no cache if not set)')
+    parser.add_argument('--flat', action='store_true',
+                        help='convert to compact array-backed trees (flat_tree.py) instead of nested dicts')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='stream one JSON object per line: flat nodes as they are visited, then index keys')
+    parser.add_argument('--binary', metavar='FILE', default=None,
+                        help='write tables to memory-mappable binary FILE (read with ast_store.py) instead of JSON')
+    parser.add_argument('--clones', action='store_true',
+                        help='dump exact, structural and near-miss clones instead of tables')
+    parser.add_argument('--min-weight', type=int, default=20,
+                        help='minimal weight of reported clones (default: 20)')
+    parser.add_argument('--similarity', type=float, default=0.8,
+                        help='minimal estimated similarity of near-miss clones (default: 0.8)')
+    parser.add_argument('--select', metavar='SELECTOR', default=None,
+                        help='dump only nodes matching selector, for example \'FunctionDef > body Call[func.id="print"]\', '
+                             'see ast_query.py')
+    parser.add_argument('--scopes', action='store_true',
+                        help='dump scopes, symbols and usages of names instead of tables, see ast_scopes.py')
+    parser.add_argument('--dataflow', action='store_true',
+                        help='dump data-flow graphs of scopes instead of tables, see ast_dataflow.py; '
+                             'with --cache-dir graphs of unchanged scopes are reused')
+    parser.add_argument('--stats', nargs='?', const='text', choices=('text', 'json'), default=None,
+                        help='write time of phases and counters to stderr, as table or JSON')
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help='save cProfile stats to FILE and write hottest calls to stderr '
+                             '(work of worker processes is profiled with -j 1 only)')
+    parser.add_argument('--test', action='store_true',
+                        help='run self-tests and exit')
     args = parser.parse_args(sys.argv[1:])
 
-    tree = parse_file(args.filepath)
+    if args.test:
+        run_tests()
+        return
+    if len(args.filepath) == 0:
+        parser.error('at least one file.py is required')
+    with ast_stats.session(args.stats, args.profile):
+        run(args)
+
+
+def run(args):
+    cache = cache_from_env(converter_tag(__file__) + ',' + converter_tag(flat_tree.__file__), args.cache_dir)
+
+    # nodes are written as they are visited or merged, or dropped if not needed
+    on_node = None
+    if args.scopes or args.dataflow or args.select:
+        # scopes and graphs of all nodes, or selected nodes are written: all nodes are needed
+        pass
+    elif args.clones:
+        on_node = lambda node: None
+    elif args.ndjson:
+        on_node = write_line
+
+    project_mode = len(args.filepath) > 1 or os.path.isdir(args.filepath[0]) or glob.has_magic(args.filepath[0])
+    if project_mode:
+        files = find_files(args.filepath)
+        if args.tree:
+            trees = {}
+            for filename in files:
+                tree = parse_file(filename, cache, args.flat)
+                tree = tree.to_dict() if args.flat else tree
+                if args.ndjson:
+                    write_line({'file': filename, 'tree': tree})
+                else:
+                    trees[filename] = tree
+            if not args.ndjson:
+                write_json(trees)
+            return
+        mode = 'scopes' if args.scopes else 'dataflow' if args.dataflow else 'tables'
+        project, errors = dump_project(files, args.jobs, cache, args.flat, on_node, mode)
+        if args.scopes or args.dataflow:
+            d = project if args.dataflow else project.to_dict()
+            if len(errors) > 0:
+                d['errors'] = errors
+            write_json(d)
+            return
+        if args.select:
+            write_selected(project, args.select, args.ndjson)
+            return
+        if args.clones:
+            with ast_stats.phase('clones'):
+                d = find_clones(project, args.min_weight, args.similarity)
+        elif args.ndjson:
+            write_ndjson_indexes(project, errors)
+            return
+        elif args.binary:
+            with ast_stats.phase('serialize'):
+                write_store(project, args.binary)
+            return
+        else:
+            d = project.to_dict()
+        if args.ndjson:
+            for filename, error in errors.items():
+                write_line({'file': filename, 'error': error})
+            write_ndjson_clones(d)
+            return
+        if len(errors) > 0:
+            d['errors'] = errors
+        write_json(d)
+        return
+
+    tree = parse_file(args.filepath[0], cache, args.flat)
 
     if args.tree:
-        print(json.dumps(tree, indent=4, sort_keys=True))
+        tree = tree.to_dict() if args.flat else tree
+        if args.ndjson:
+            write_line(tree)
+        else:
+            write_json(tree)
         return
 
-    ic = tables()
-    walk_tree(tree, ic)
-    print(json.dumps(ic.to_dict(), indent=4, sort_keys=True))
+    if args.scopes:
+        with ast_stats.phase('scopes'):
+            st = build_scopes(tree.to_dict() if args.flat else tree)
+        write_json(st.to_dict())
+        return
 
+    if args.dataflow:
+        write_json(scopes_dict(dataflow(cache).update(tree.to_dict() if args.flat else tree)))
+        return
+
+    ic = tables(on_node)
+    with ast_stats.phase('tables'):
+        walk_tree(tree, ic)
+    if args.select:
+        write_selected(ic, args.select, args.ndjson)
+        return
+    if args.clones:
+        with ast_stats.phase('clones'):
+            d = find_clones(ic, args.min_weight, args.similarity)
+        if args.ndjson:
+            write_ndjson_clones(d)
+        else:
+            write_json(d)
+        return
+    if args.ndjson:
+        write_ndjson_indexes(ic)
+        return
+    if args.binary:
+        with ast_stats.phase('serialize'):
+            write_store(ic, args.binary)
+        return
+    write_json(ic.to_dict())
 
 if __name__ == '__main__':
     main()
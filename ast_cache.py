@@ -0,0 +1,174 @@
+import os, sys
+import hashlib
+import marshal
+import zlib
+import tempfile
+import time
+
+# bump when format of cache entries changes
+CACHE_VERSION = 1
+
+DEFAULT_MAX_SIZE = 1 << 30
+
+
+class parse_cache:
+    """
+    Content-addressed on-disk cache of converted trees.
+
+    Entry key is a hash of source bytes, Python version and converter tag,
+    entry is the tree (dicts, lists and scalars) in marshal format, zlib
+    compressed.  Entries are written to a temporary file and renamed into
+    place, so processes sharing one directory never read partial entries.
+    Reading an entry touches its mtime, eviction removes least recently used
+    entries when total size exceeds max_size.
+
+    Sizes of written entries are appended to log file shared by all
+    processes, directory is scanned for eviction when they add up to tenth
+    part of max_size, so short runs sharing one directory are counted too.
+    Cache without log (new or not scanned yet) is scanned on first write.
+    """
+
+    def __init__(self, path, tag, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.salt = f'{CACHE_VERSION}\0{sys.version}\0{tag}\0'.encode('utf-8')
+        self.log_path = os.path.join(path, 'written')
+        # bytes written by all processes since last eviction scan, read from log on first write
+        self.written = None
+
+    def key(self, source: bytes) -> str:
+        return hashlib.sha256(self.salt + source).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            tree = marshal.loads(zlib.decompress(data))
+        except (OSError, ValueError, EOFError, TypeError, zlib.error):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # read-only cache or entry evicted meanwhile, tree is valid anyway
+            pass
+        return tree
+
+    def put(self, key, tree):
+        try:
+            data = zlib.compress(marshal.dumps(tree), 1)
+        except ValueError:
+            # too deeply nested for marshal, not cached
+            return
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        # full scan of directory is expensive, do it after each tenth part of cache is written
+        if self._log_written(len(data)) > self.max_size // 10:
+            self.evict()
+
+    def _log_written(self, size):
+        """
+        Append size of written entry to log, total written since last scan
+        """
+        if self.written is None:
+            try:
+                with open(self.log_path, 'rb') as f:
+                    self.written = sum(int(line) for line in f.read().split())
+            except FileNotFoundError:
+                # never scanned
+                return self.max_size
+            except (OSError, ValueError):
+                self.written = 0
+        # appends of short lines are atomic, lines of concurrent writers are not mixed
+        try:
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, b'%d\n' % size)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+        self.written += size
+        return self.written
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache size is under 90% of max_size
+        """
+        self.written = 0
+        # entries written from now on are counted in new log, earlier ones by scan
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+            os.close(fd)
+            os.replace(tmp_path, self.log_path)
+        except OSError:
+            pass
+        entries = []
+        total = 0
+        now = time.time()
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                if root == self.path and name == 'written':
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith('.tmp-'):
+                    # leftover of killed writer
+                    if now - st.st_mtime > 3600:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        limit = self.max_size * 9 // 10
+        for mtime, size, path in entries:
+            if total <= limit:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # already evicted by another process
+                pass
+            total -= size
+
+
+def cache_from_env(tag, path=None):
+    """
+    Cache in directory path or $AST_CACHE_DIR, size limit from $AST_CACHE_SIZE.
+    Returns None if no directory given.
+    """
+    path = path or os.environ.get('AST_CACHE_DIR')
+    if not path:
+        return None
+    max_size = int(os.environ.get('AST_CACHE_SIZE', DEFAULT_MAX_SIZE))
+    return parse_cache(path, tag, max_size)
+
+
+def converter_tag(filename):
+    """
+    Converter tag: script name and hash of its source, so any change of converter invalidates entries
+    """
+    with open(filename, 'rb') as f:
+        return os.path.basename(filename) + ':' + hashlib.md5(f.read()).hexdigest()
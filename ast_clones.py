@@ -0,0 +1,210 @@
+import random
+from bisect import bisect_right
+from collections import Counter
+from typing import List, Dict, Any
+
+
+# node types compared as near-miss clones: definitions and compound statements
+NEAR_MISS_TYPES = {
+    'FunctionDef', 'AsyncFunctionDef', 'ClassDef',
+    'For', 'AsyncFor', 'While', 'If', 'With', 'AsyncWith', 'Try',
+}
+
+# MinHash signature of BANDS * ROWS values, LSH buckets by bands
+BANDS = 16
+ROWS = 4
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20190601)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for i in range(BANDS * ROWS)]
+
+
+def hash_groups(ic, name: str, min_weight: int):
+    """
+    Groups of two or more rows with the same key in index name of tables ic
+    """
+    offsets, order = ic.group(name)
+    weights = ic.weights
+    for code in range(len(offsets) - 1):
+        rows = order[offsets[code]:offsets[code + 1]]
+        if len(rows) > 1 and weights[rows[0]] >= min_weight:
+            yield code, rows
+
+
+def is_maximal(rows, column, parents) -> bool:
+    """
+    Group is not maximal if its members are distinct children of members of one group of the same index
+    """
+    parent_rows = set()
+    parent_codes = set()
+    for row in rows:
+        parent = parents[row]
+        if parent < 0:
+            return True
+        parent_rows.add(parent)
+        parent_codes.add(column[parent])
+    return len(parent_codes) > 1 or -1 in parent_codes or len(parent_rows) < len(rows)
+
+
+def exact_clones(ic, min_weight: int) -> List[List[int]]:
+    """
+    Maximal groups of identical subtrees, from values index
+    """
+    parents = ic.parent_rows()
+    return [list(rows) for code, rows in hash_groups(ic, 'values', min_weight) if is_maximal(rows, ic.values, parents)]
+
+
+def structural_clones(ic, min_weight: int) -> List[List[int]]:
+    """
+    Maximal groups of subtrees of identical structure (with different values), from trees index
+    """
+    parents = ic.parent_rows()
+    values = ic.values
+    groups = []
+    for code, rows in hash_groups(ic, 'trees', min_weight):
+        if len(set(values[row] for row in rows)) == 1:
+            # exact clones
+            continue
+        if is_maximal(rows, ic.trees, parents):
+            groups.append(list(rows))
+    return groups
+
+
+def minhash_signatures(ic, candidates: List[int]) -> Dict[int, tuple]:
+    """
+    MinHash signatures of candidate rows.  Shingles of subtree are structure hashes
+    of its inner nodes, so renames don't change them and small edits change few of them.
+    """
+    ends = ic.subtree_ends()
+    trees = ic.trees
+    hashes = ic.hashes
+    # hash values of each shingle for all permutations, computed once per distinct shingle
+    shingle_values = {}
+    signatures = {}
+    for row in candidates:
+        # multiset of shingles: k-th occurrence of structure is a distinct shingle
+        counts = Counter(trees[row + 1:ends[row]])
+        counts.pop(-1, None)
+        if len(counts) == 0:
+            continue
+        columns = []
+        for code, count in counts.items():
+            for k in range(count):
+                v = shingle_values.get((code, k))
+                if v is None:
+                    x = int(hashes[code][:15], 16) + (k << 60)
+                    v = tuple((a * x + b) % _PRIME for a, b in _PERMUTATIONS)
+                    shingle_values[(code, k)] = v
+                columns.append(v)
+        signatures[row] = tuple(map(min, zip(*columns)))
+    return signatures
+
+
+def _nested(rows1, rows2, ends) -> bool:
+    """
+    Some row of sorted rows1 is inside some row of sorted rows2 or contains it
+    """
+    for rows, others in ((rows1, rows2), (rows2, rows1)):
+        for row in rows:
+            i = bisect_right(others, row)
+            if i < len(others) and others[i] < ends[row]:
+                return True
+    return False
+
+
+def near_miss_clones(ic, min_weight: int, similarity: float, max_bucket: int = 1000):
+    """
+    Pairs of similar definitions and compound statements by MinHash/LSH.
+    Subtrees of the same structure have the same signature, so candidates are
+    grouped by structure hash and pairs are pairs of groups; nested pairs and
+    pairs inside reported pairs are excluded, by all members of groups.
+    Returns list of (rows1, rows2, estimated similarity).
+    """
+    weights = ic.weights
+    trees = ic.trees
+    type_codes = set(ic.type_codes[t] for t in NEAR_MISS_TYPES if t in ic.type_codes)
+    members = {}
+    for row, t in enumerate(ic.types):
+        if t in type_codes and weights[row] >= min_weight:
+            members.setdefault(trees[row], []).append(row)
+    # first row of group represents it
+    signatures = minhash_signatures(ic, [rows[0] for rows in members.values()])
+
+    candidate_pairs = set()
+    for band in range(BANDS):
+        buckets = {}
+        for row, sig in signatures.items():
+            buckets.setdefault(sig[band * ROWS:(band + 1) * ROWS], []).append(row)
+        for rows in buckets.values():
+            if len(rows) < 2 or len(rows) > max_bucket:
+                continue
+            for i in range(len(rows)):
+                for j in range(i + 1, len(rows)):
+                    candidate_pairs.add((rows[i], rows[j]))
+
+    ends = ic.subtree_ends()
+    n = BANDS * ROWS
+    pairs = {}
+    for a, b in candidate_pairs:
+        if _nested(members[trees[a]], members[trees[b]], ends):
+            # some member of one group inside some member of other
+            continue
+        s = sum(1 for x, y in zip(signatures[a], signatures[b]) if x == y) / n
+        if s >= similarity:
+            pairs[(trees[a], trees[b])] = s
+
+    # keep only maximal pairs: drop pair if pair of its closest candidate ancestors is reported
+    parents = ic.parent_rows()
+
+    def candidate_ancestors(rows):
+        result = set()
+        for row in rows:
+            row = parents[row]
+            while row >= 0 and trees[row] not in members:
+                row = parents[row]
+            result.add(trees[row] if row >= 0 else -1)
+        return result
+
+    result = []
+    for (a, b), s in pairs.items():
+        pas = candidate_ancestors(members[a])
+        pbs = candidate_ancestors(members[b])
+        if any((pa, pb) in pairs or (pb, pa) in pairs for pa in pas for pb in pbs):
+            continue
+        result.append((members[a], members[b], s))
+    return result
+
+
+def find_clones(ic, min_weight: int = 20, similarity: float = 0.8) -> Dict[str, Any]:
+    """
+    Clone report of tables ic: exact, structural and near-miss clones,
+    ordered by weight of clones, with node ids.
+    Near-miss clone is a pair of groups of subtrees of the same structure.
+    """
+    weights = ic.weights
+    types = ic.types
+
+    def group_dict(rows):
+        return {
+            'type': ic.type_names[types[rows[0]]],
+            'weight': weights[rows[0]],
+            'nodes': [ic.node_id(row) for row in rows],
+        }
+
+    def order(rows):
+        return (-weights[rows[0]], rows[0])
+
+    exact = sorted(exact_clones(ic, min_weight), key=order)
+    structural = sorted(structural_clones(ic, min_weight), key=order)
+    near_miss = sorted(near_miss_clones(ic, min_weight, similarity), key=lambda p: (-p[2], p[0][0], p[1][0]))
+
+    return {
+        'exact': [group_dict(rows) for rows in exact],
+        'structural': [group_dict(rows) for rows in structural],
+        'near_miss': [
+            {
+                'similarity': s,
+                'nodes': [[ic.node_id(row) for row in rows1], [ic.node_id(row) for row in rows2]],
+                'types': [ic.type_names[types[rows1[0]]], ic.type_names[types[rows2[0]]]],
+            } for rows1, rows2, s in near_miss
+        ],
+    }
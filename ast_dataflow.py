@@ -0,0 +1,751 @@
+import hashlib
+import json
+from array import array
+from typing import List, Dict, Tuple, Any
+
+from ast_cache import converter_tag
+from ast_scopes import USAGE_KINDS, BINDING_KINDS, FUNCTION_TYPES, COMPREHENSION_TYPES, EVALUATION_ORDER
+import ast_stats
+
+# Per-scope data-flow graphs: reaching definitions of names, for trees of
+# ast-dump.py and pyast.py.
+#
+# Graph of scope has usages of names in the scope in order of evaluation,
+# the same usages as in ast_scopes.py, and links each usage reading a name
+# (load, update, modify, del) to usages binding it which may reach it by
+# control flow of statements.  ENTRY stands for value from outside of scope:
+# argument of enclosing scope, global or builtin for free names, unbound
+# value for local names.  Writes from nested scopes (nonlocal, global) and
+# conditional evaluation inside expressions (and, or, if else) are not
+# tracked, body of try may jump to handlers between its statements only.
+#
+# Graph of scope depends only on scope itself, not on bodies of nested
+# functions, classes and lambdas.  Graphs are cached by own key of scope:
+# Merkle hash of its subtree where nested scopes are represented by their
+# headers (decorators, arguments, bases) and subtrees without nested scopes
+# by their _val_hash.  When body of one function changes only its graph is
+# rebuilt, enclosing module and classes keep their keys.  Graphs refer to
+# usages by their index in scope and keep paths of usage nodes from scope
+# node (field names and list indexes), nodes of usages are found by paths in
+# any tree with equal scope without walking it again.
+
+ENTRY = -1
+
+# usages reading value of name, update and del both read and bind
+READ_KINDS = ('load', 'update', 'modify', 'del')
+
+SCOPE_TYPES = FUNCTION_TYPES + ('ClassDef',) + COMPREHENSION_TYPES
+
+# fields of nested scope evaluated or bound in enclosing scope, comprehension
+# is part of enclosing scope as whole, its := targets bind there
+HEADER_FIELDS = {
+    'FunctionDef': ('name', 'decorator_list', 'args', 'returns'),
+    'AsyncFunctionDef': ('name', 'decorator_list', 'args', 'returns'),
+    'Lambda': ('args',),
+    'ClassDef': ('name', 'decorator_list', 'bases', 'keywords'),
+}
+
+# location attributes, not part of values of nodes
+LOC_FIELDS = ('lineno', 'col_offset', 'end_lineno', 'end_col_offset')
+
+_KIND_CODES = {kind: code for code, kind in enumerate(USAGE_KINDS)}
+_READ_CODES = frozenset(_KIND_CODES[kind] for kind in READ_KINDS)
+_BINDING_CODES = frozenset(_KIND_CODES[kind] for kind in BINDING_KINDS)
+_ENTRY_SET = frozenset((ENTRY,))
+
+_canonical_encoder = json.JSONEncoder(sort_keys=True)
+
+
+def node_type(node: Dict[str, Any]) -> str:
+    """
+    Type of node of ast-dump.py (__type) or pyast.py (_type) tree
+    """
+    return node['__type'] if '__type' in node else node['_type']
+
+
+def _children(node, fields=None):
+    """
+    Child nodes in order of evaluation, only of fields if given
+    """
+    keys = fields or EVALUATION_ORDER.get(node_type(node))
+    items = node.items() if keys is None else ((k, node.get(k)) for k in keys)
+    for k, v in items:
+        if k[0] == '_':
+            continue
+        if isinstance(v, dict):
+            yield v
+        elif isinstance(v, list):
+            for item in v:
+                if isinstance(item, dict):
+                    yield item
+
+
+def _own_hash(node, child_key, fields=None):
+    """
+    Hash of node fields and keys of children, of given fields only if fields
+    """
+    values = {}
+    children = {}
+    for k, v in node.items():
+        if k[0] == '_' or k in LOC_FIELDS or (fields is not None and k not in fields):
+            continue
+        if isinstance(v, dict):
+            children[k] = child_key(v)
+        elif isinstance(v, list) and (len(v) == 0 or not isinstance(v[0], str)):
+            children[k] = [None if item is None else child_key(item) for item in v]
+        else:
+            values[k] = v
+    canonical = _canonical_encoder.encode([node_type(node), values, children])
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
+
+
+def scope_keys(tree: Dict[str, Any]) -> List[Tuple[Dict[str, Any], str]]:
+    """
+    Scope nodes of tree (module first) in pre-order with their own keys.
+    Only scopes and nodes containing scopes are hashed, other subtrees have _val_hash.
+    """
+    # pre-order nodes and their parents, then nodes on paths from scopes to root
+    order = []
+    parents = []
+    scopes = [0]
+    stack = [(tree, -1)]
+    while stack:
+        node, parent = stack.pop()
+        i = len(order)
+        order.append(node)
+        parents.append(parent)
+        if i > 0 and node_type(node) in SCOPE_TYPES:
+            scopes.append(i)
+        for k, v in reversed(node.items()):
+            if k[0] == '_':
+                continue
+            if isinstance(v, dict):
+                stack.append((v, i))
+            elif isinstance(v, list):
+                stack.extend((item, i) for item in reversed(v) if isinstance(item, dict))
+    hashed = set(scopes)
+    for i in scopes:
+        p = parents[i]
+        while p >= 0 and p not in hashed:
+            hashed.add(p)
+            p = parents[p]
+
+    # keys of nodes containing scopes, headers of nested scopes, by id of node
+    keys = {}
+    headers = {}
+
+    def child_key(child):
+        key = headers.get(id(child))
+        if key is None:
+            key = keys.get(id(child))
+        return key or child['_val_hash']
+
+    is_scope = set(scopes)
+    for i in sorted(hashed, reverse=True):
+        node = order[i]
+        key = keys[id(node)] = _own_hash(node, child_key)
+        if i in is_scope and i > 0:
+            fields = HEADER_FIELDS.get(node_type(node))
+            headers[id(node)] = key if fields is None else _own_hash(node, child_key, fields)
+    return [(order[i], keys[id(order[i])]) for i in scopes]
+
+
+class scope_graph:
+    """
+    Data-flow graph of one scope: usages of names in order of evaluation and
+    usages binding name which may reach each reading usage, as CSR arrays:
+    reaching definitions of usage u are targets[offsets[u]:offsets[u+1]],
+    node of usage u is at paths[u] from scope node
+    """
+
+    def __init__(self, names, usage_names, usage_kinds, local, offsets, targets, paths):
+        self.names = names
+        self.usage_names = usage_names
+        self.usage_kinds = usage_kinds
+        # per name: 1 if name is bound in this scope
+        self.local = local
+        self.offsets = offsets
+        self.targets = targets
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.usage_names)
+
+    def reaching(self, usage: int):
+        """
+        Usages binding name which may reach usage, ENTRY for value from outside of scope
+        """
+        return self.targets[self.offsets[usage]:self.offsets[usage+1]]
+
+    def usage_nodes(self, scope_node: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Nodes of usages in tree of scope_node with key of this graph, found by paths
+        """
+        nodes = []
+        for path in self.paths:
+            node = scope_node
+            for step in path:
+                node = node[step]
+            nodes.append(node)
+        return nodes
+
+    def to_tuple(self):
+        return (self.names, self.usage_names.tobytes(), self.usage_kinds.tobytes(), self.local.tobytes(),
+                self.offsets.tobytes(), self.targets.tobytes(), tuple(self.paths))
+
+    @staticmethod
+    def from_tuple(t):
+        names, usage_names, usage_kinds, local, offsets, targets, paths = t
+        return scope_graph(list(names), array('l', usage_names), array('b', usage_kinds), array('b', local),
+                           array('q', offsets), array('q', targets), list(paths))
+
+    def to_dict(self, scope_node: Dict[str, Any], nodes: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Graph with usages as node ids, nodes are nodes of usages from usage_nodes()
+        """
+        usages = []
+        for u in range(len(self.usage_names)):
+            d = {
+                'node': nodes[u]['_id'],
+                'name': self.names[self.usage_names[u]],
+                'kind': USAGE_KINDS[self.usage_kinds[u]],
+            }
+            if self.usage_kinds[u] in _READ_CODES:
+                d['defs'] = [None if r == ENTRY else nodes[r]['_id'] for r in self.reaching(u)]
+            usages.append(d)
+        d = {'node': scope_node['_id'], 'type': node_type(scope_node)}
+        if isinstance(scope_node.get('name'), str):
+            d['name'] = scope_node['name']
+        d['usages'] = usages
+        return d
+
+
+class _builder:
+    """
+    One walk of scope: usages in order of evaluation in basic blocks of
+    statements, nested scopes are not entered except their headers
+    """
+
+    def __init__(self, scope_node):
+        self.scope_node = scope_node
+        self.names = []
+        self.name_codes = {}
+        self.usage_names = array('l')
+        self.usage_kinds = array('b')
+        self.nodes = []
+        self.bound = set()
+        self.declared = set()
+        # usages of each block and successors of each block, block 0 is entry
+        self.blocks = [[]]
+        self.succ = [[]]
+        # current block, -1 after jump
+        self.cur = 0
+        # (continue target, break target) of enclosing loops, handlers of enclosing try
+        self.loops = []
+        self.handlers = []
+
+    def block(self):
+        self.blocks.append([])
+        self.succ.append([])
+        return len(self.blocks) - 1
+
+    def jump(self, target):
+        if self.cur >= 0:
+            self.succ[self.cur].append(target)
+
+    def use(self, name, kind, node, bind=True):
+        if self.cur < 0:
+            # unreachable code
+            self.cur = self.block()
+        code = self.name_codes.get(name)
+        if code is None:
+            code = self.name_codes[name] = len(self.names)
+            self.names.append(name)
+        if kind in BINDING_KINDS:
+            if bind:
+                self.bound.add(code)
+        elif kind in ('global', 'nonlocal'):
+            self.declared.add(code)
+        self.blocks[self.cur].append(len(self.nodes))
+        self.usage_names.append(code)
+        self.usage_kinds.append(_KIND_CODES[kind])
+        self.nodes.append(node)
+
+    def params(self, args):
+        items = []
+        for key in ('posonlyargs', 'args', 'vararg', 'kwonlyargs', 'kwarg'):
+            value = args.get(key)
+            if value is None:
+                continue
+            for arg in (value if isinstance(value, list) else [value]):
+                items.append(('use', (arg['arg'], 'param', arg)))
+        return items
+
+    def header(self, node, t):
+        """
+        Items of nested scope evaluated in this scope
+        """
+        items = [('node', item) for item in node.get('decorator_list', [])]
+        if t == 'ClassDef':
+            items += [('node', item) for item in _children(node, ('bases', 'keywords'))]
+        else:
+            args = node['args']
+            items += [('node', item) for item in _children(args, ('defaults', 'kw_defaults'))]
+            for arg in _children(args, ('posonlyargs', 'args', 'vararg', 'kwonlyargs', 'kwarg')):
+                if arg.get('annotation') is not None:
+                    items.append(('node', arg['annotation']))
+            if node.get('returns') is not None:
+                items.append(('node', node['returns']))
+        if t != 'Lambda':
+            items.append(('use', (node['name'], 'def', node)))
+        return items
+
+    def comprehension(self, node, outer):
+        """
+        Items of comprehension: loop over generators in its own scope,
+        or first iterator and := targets (bound if loop runs) in enclosing scope
+        """
+        head = self.block()
+        exit = self.block()
+        fork = [None]
+        if outer:
+            items = [('node', node['generators'][0]['iter'])]
+            targets = []
+            stack = list(_children(node))
+            while stack:
+                child = stack.pop()
+                t = node_type(child)
+                if t == 'NamedExpr' and node_type(child['target']) == 'Name':
+                    targets.append(child['target'])
+                if t not in FUNCTION_TYPES and t != 'ClassDef':
+                    stack.extend(_children(child))
+            if len(targets) == 0:
+                return items
+            items += [('save', fork), ('branch', fork)]
+            items += [('use', (target['id'], 'store', target)) for target in reversed(targets)]
+            return items + [('goto', exit), ('branch', fork), ('goto', exit), ('set', exit)]
+        items = [('goto', head), ('set', head), ('save', fork), ('branch', fork)]
+        for i, gen in enumerate(node['generators']):
+            if i > 0:
+                items.append(('node', gen['iter']))
+            items.append(('node', gen['target']))
+            items += [('node', item) for item in gen['ifs']]
+        items += [('node', node[key]) for key in ('key', 'value', 'elt') if key in node]
+        return items + [('goto', head), ('branch', fork), ('goto', exit), ('set', exit)]
+
+    def walk(self):
+        scope = self.scope_node
+        t = node_type(scope)
+        in_comprehension = t in COMPREHENSION_TYPES
+        if t in FUNCTION_TYPES:
+            items = self.params(scope['args'])
+            if t == 'Lambda':
+                items.append(('node', scope['body']))
+            else:
+                items += [('node', item) for item in scope['body']]
+        elif in_comprehension:
+            items = self.comprehension(scope, False)
+        else:
+            items = [('node', item) for item in scope['body']]
+
+        # (action, argument, flag), pushed in reverse order of evaluation
+        stack = [(action, arg, None) for action, arg in reversed(items)]
+        while stack:
+            action, node, flag = stack.pop()
+            if action != 'node':
+                self.control(action, node)
+                continue
+            t = node_type(node)
+            items = None
+            if t in FUNCTION_TYPES or t == 'ClassDef':
+                items = self.header(node, t)
+            elif t in COMPREHENSION_TYPES:
+                items = self.comprehension(node, True)
+            elif t == 'Name':
+                ctx = node_type(node['ctx'])
+                if ctx == 'Store':
+                    kind = 'update' if flag == 'update' else 'store'
+                elif ctx == 'Del':
+                    kind = 'del'
+                else:
+                    kind = flag if flag in ('update', 'modify') else 'load'
+                # := in comprehension binds in enclosing function
+                self.use(node['id'], kind, node, not (flag == 'walrus' and in_comprehension))
+                continue
+            elif t in ('Global', 'Nonlocal'):
+                for name in node['names']:
+                    self.use(name, t.lower(), node)
+                continue
+            elif t in ('Import', 'ImportFrom'):
+                for alias in node['names']:
+                    if alias['name'] != '*':
+                        self.use(alias['asname'] or alias['name'].split('.')[0], 'import', alias)
+                continue
+            elif t == 'AugAssign':
+                stack.append(('node', node['target'], 'update'))
+                stack.append(('node', node['value'], None))
+                continue
+            elif t == 'NamedExpr':
+                stack.append(('node', node['target'], 'walrus'))
+                stack.append(('node', node['value'], None))
+                continue
+            elif t in ('Attribute', 'Subscript') and (flag is not None or node_type(node['ctx']) != 'Load'):
+                # object is modified by assignment to its attribute or item
+                if t == 'Subscript':
+                    stack.append(('node', node['slice'], None))
+                stack.append(('node', node['value'], 'modify'))
+                continue
+            elif t in ('If', 'While', 'For', 'AsyncFor', 'Try', 'TryStar', 'Match',
+                       'Break', 'Continue', 'Return', 'Raise'):
+                items = self.statement(node, t)
+            elif t in ('MatchAs', 'MatchStar') and node.get('name'):
+                items = [('node', child) for child in _children(node)] + [('use', (node['name'], 'store', node))]
+            elif t == 'MatchMapping' and node.get('rest'):
+                items = [('node', child) for child in _children(node)] + [('use', (node['rest'], 'store', node))]
+            if items is None:
+                stack.extend(('node', child, None) for child in reversed(list(_children(node))))
+            else:
+                stack.extend((action, arg, None) for action, arg in reversed(items))
+        return self
+
+    def statement(self, node, t):
+        """
+        Items of control flow statement
+        """
+        fork = [None]
+        if t == 'If':
+            join = self.block()
+            return [('node', node['test']), ('save', fork), ('branch', fork)] + \
+                [('node', item) for item in node['body']] + [('goto', join), ('branch', fork)] + \
+                [('node', item) for item in node['orelse']] + [('goto', join), ('set', join)]
+        if t in ('While', 'For', 'AsyncFor'):
+            head = self.block()
+            exit = self.block()
+            items = [] if t == 'While' else [('node', node['iter'])]
+            items += [('goto', head), ('set', head)]
+            if t == 'While':
+                items.append(('node', node['test']))
+            items += [('save', fork), ('branch', fork)]
+            if t != 'While':
+                items.append(('node', node['target']))
+            items.append(('loop', (head, exit)))
+            items += [('node', item) for item in node['body']]
+            items += [('loop', None), ('goto', head), ('branch', fork)]
+            return items + [('node', item) for item in node['orelse']] + [('goto', exit), ('set', exit)]
+        if t in ('Try', 'TryStar'):
+            handler = self.block()
+            final = self.block()
+            items = [('try', handler), ('raise', None)]
+            for item in node['body']:
+                items += [('node', item), ('raise', None)]
+            items.append(('try', None))
+            items += [('node', item) for item in node['orelse']]
+            items += [('goto', final), ('set', handler), ('save', fork)]
+            for h in node['handlers']:
+                items.append(('branch', fork))
+                if h.get('type') is not None:
+                    items.append(('node', h['type']))
+                if h.get('name'):
+                    items.append(('use', (h['name'], 'store', h)))
+                items += [('node', item) for item in h['body']]
+                items.append(('goto', final))
+            # exception not handled, finally runs and exception is raised again
+            items += [('branch', fork), ('goto', final), ('set', final)]
+            return items + [('node', item) for item in node['finalbody']]
+        if t == 'Match':
+            join = self.block()
+            items = [('node', node['subject']), ('save', fork)]
+            for case in node['cases']:
+                items += [('branch', fork), ('node', case['pattern'])]
+                if case.get('guard') is not None:
+                    items.append(('node', case['guard']))
+                items += [('node', item) for item in case['body']]
+                items.append(('goto', join))
+            return items + [('branch', fork), ('goto', join), ('set', join)]
+        if t in ('Break', 'Continue'):
+            return [('goto', self.loops[-1][1 if t == 'Break' else 0])]
+        # Return and Raise
+        items = [('node', child) for child in _children(node)]
+        if t == 'Raise':
+            items.append(('raise', None))
+        return items + [('goto', None)]
+
+    def control(self, action, arg):
+        if action == 'use':
+            self.use(*arg)
+        elif action == 'goto':
+            # jump to block, or out of scope if None
+            if arg is not None:
+                self.jump(arg)
+            self.cur = -1
+        elif action == 'set':
+            self.cur = arg
+        elif action == 'save':
+            arg[0] = self.cur
+        elif action == 'branch':
+            # new block starting from saved block
+            block = self.block()
+            if arg[0] >= 0:
+                self.succ[arg[0]].append(block)
+            self.cur = block
+        elif action == 'loop':
+            if arg is None:
+                self.loops.pop()
+            else:
+                self.loops.append(arg)
+        elif action == 'try':
+            if arg is None:
+                self.handlers.pop()
+            else:
+                self.handlers.append(arg)
+        elif action == 'raise':
+            # exception may be raised here and handled by enclosing try,
+            # new block starts so that handler gets bindings made before this point
+            if len(self.handlers) > 0 and self.cur >= 0:
+                self.jump(self.handlers[-1])
+                block = self.block()
+                self.jump(block)
+                self.cur = block
+
+    def solve(self) -> scope_graph:
+        """
+        Reaching definitions over blocks, iterated to fixed point
+        """
+        usage_names = self.usage_names
+        usage_kinds = self.usage_kinds
+        blocks = self.blocks
+        succ = self.succ
+        # per block: name code -> frozenset of binding usages, missing name is ENTRY only
+        ins = [None] * len(blocks)
+        outs = [None] * len(blocks)
+        ins[0] = {}
+        work = [0]
+        queued = {0}
+        while work:
+            b = work.pop()
+            queued.discard(b)
+            out = dict(ins[b])
+            for u in blocks[b]:
+                if usage_kinds[u] in _BINDING_CODES:
+                    out[usage_names[u]] = frozenset((u,))
+            if out == outs[b]:
+                continue
+            outs[b] = out
+            for s in succ[b]:
+                state = ins[s]
+                if state is None:
+                    joined = dict(out)
+                else:
+                    joined = dict(state)
+                    for name in state.keys() | out.keys():
+                        joined[name] = state.get(name, _ENTRY_SET) | out.get(name, _ENTRY_SET)
+                if joined != state:
+                    ins[s] = joined
+                    if s not in queued:
+                        queued.add(s)
+                        work.append(s)
+
+        local = array('b', [0]) * len(self.names)
+        for code in self.bound - self.declared:
+            local[code] = 1
+        reaching = [None] * len(usage_names)
+        for b, usages in enumerate(blocks):
+            # unreachable block starts as entry of scope
+            state = dict(ins[b] or {})
+            for u in usages:
+                kind = usage_kinds[u]
+                name = usage_names[u]
+                if kind in _READ_CODES:
+                    r = state.get(name, _ENTRY_SET)
+                    reaching[u] = r if local[name] else r | _ENTRY_SET
+                if kind in _BINDING_CODES:
+                    state[name] = frozenset((u,))
+        offsets = array('q', [0])
+        targets = array('q')
+        for r in reaching:
+            if r is not None:
+                targets.extend(sorted(r))
+            offsets.append(len(targets))
+        return scope_graph(self.names, usage_names, usage_kinds, local, offsets, targets, self.paths())
+
+    def paths(self):
+        """
+        Path of node of each usage from scope node: field names and list indexes
+        """
+        wanted = set(id(node) for node in self.nodes)
+        found = {}
+        stack = [(self.scope_node, ())]
+        while stack and len(found) < len(wanted):
+            node, path = stack.pop()
+            if id(node) in wanted:
+                found[id(node)] = path
+            for k, v in node.items():
+                if k[0] == '_':
+                    continue
+                if isinstance(v, dict):
+                    stack.append((v, path + (k,)))
+                elif isinstance(v, list):
+                    stack.extend((item, path + (k, i)) for i, item in enumerate(v) if isinstance(item, dict))
+        return [found[id(node)] for node in self.nodes]
+
+
+def build_graph(scope_node: Dict[str, Any]) -> scope_graph:
+    """
+    Data-flow graph of scope of module, class, function, lambda or comprehension node
+    """
+    return _builder(scope_node).walk().solve()
+
+
+def usage_nodes(scope_node: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Nodes of usages of scope, in order of usages of its graph
+    """
+    return _builder(scope_node).walk().nodes
+
+
+class dataflow:
+    """
+    Graphs of scopes kept up to date with versions of trees: graphs are
+    reused by own keys of scopes, from memory or from persistent cache
+    (ast_cache.parse_cache) shared by processes and runs.
+    """
+
+    def __init__(self, cache=None):
+        # own key -> scope_graph
+        self.graphs = {}
+        self.cache = cache
+        self.prefix = b'dataflow\0' + converter_tag(__file__).encode('utf-8') + b'\0'
+
+    def graph(self, scope_node, key):
+        """
+        Graph of scope with own key, and True if it is built now
+        """
+        g = self.graphs.get(key)
+        if g is None and self.cache is not None:
+            with ast_stats.phase('cache'):
+                t = self.cache.get(self.cache.key(self.prefix + key.encode('utf-8')))
+            if t is not None:
+                g = self.graphs[key] = scope_graph.from_tuple(t)
+        if g is not None:
+            ast_stats.count('scopes reused')
+            return g, False
+        g = self.graphs[key] = build_graph(scope_node)
+        ast_stats.count('scopes built')
+        if self.cache is not None:
+            with ast_stats.phase('cache'):
+                self.cache.put(self.cache.key(self.prefix + key.encode('utf-8')), g.to_tuple())
+        return g, True
+
+    def update(self, tree: Dict[str, Any]) -> List[Tuple[Dict[str, Any], scope_graph, bool]]:
+        """
+        (scope node, graph, built now) of scopes of tree in pre-order
+        """
+        with ast_stats.phase('dataflow'):
+            result = []
+            for node, key in scope_keys(tree):
+                g, built = self.graph(node, key)
+                result.append((node, g, built))
+            return result
+
+
+
+def scopes_dict(scopes: List[Tuple[Dict[str, Any], scope_graph, bool]], built_only: bool = False) -> Dict[str, Any]:
+    """
+    Graphs of scopes from dataflow.update() with node ids, only graphs built by update if built_only
+    """
+    return {'scopes': [g.to_dict(node, g.usage_nodes(node)) for node, g, built in scopes if built or not built_only]}
+
+
+def test_dataflow():
+    import ast
+    from ast_store import load_ast_dump
+    ast_dump = load_ast_dump()
+
+    def graph(code, scope=0):
+        ast_dump.node_id_counter = 0
+        tree = ast_dump.node_to_dict(ast.parse(code))
+        node, key = scope_keys(tree)[scope]
+        g = build_graph(node)
+        nodes = usage_nodes(node)
+        assert len(nodes) == len(g)
+        lines = {}
+        # name -> reaching lines of loads of name (0 is ENTRY), in order of usages
+        for u in range(len(g)):
+            if USAGE_KINDS[g.usage_kinds[u]] in READ_KINDS:
+                lines.setdefault(g.names[g.usage_names[u]], []).append(
+                    sorted(0 if r == ENTRY else nodes[r].get('_loc', {}).get('lineno', 0) for r in g.reaching(u)))
+        return lines
+
+    lines = graph('\n'.join([
+        'def f(a, b):',
+        '    x = a',
+        '    if b:',
+        '        x = 2',
+        '    else:',
+        '        y = 1',
+        '    print(x, y)',
+        '    while a:',
+        '        a = a - 1',
+        '        if a:',
+        '            break',
+        '        z = 1',
+        '    else:',
+        '        return z',
+        '    try:',
+        '        w = 1',
+        '        w = f(w)',
+        '    except E as e:',
+        '        return w, e',
+        '    x += 1',
+        '    return [x for x in z if x], (n := 1), n',
+    ]), 1)
+    assert lines['a'] == [[1], [1, 9], [1, 9], [9]]
+    assert lines['b'] == [[1]]
+    assert lines['x'] == [[2, 4], [2, 4]]
+    assert lines['y'] == [[0, 6]]
+    assert lines['z'] == [[0, 12], [0, 12]]
+    assert lines['w'] == [[16], [0, 16, 17]]
+    assert lines['e'] == [[18]]
+    assert lines['print'] == [[0]]
+    assert lines['n'] == [[21]]
+
+    # comprehension: first iterator is evaluated outside, loop variable reaches itself
+    lines = graph('[[y for y in x] for x in a if x]', 1)
+    assert lines == {'x': [[1], [1]]}
+    lines = graph('x = 1\ndef f(): pass\nif [y := x for x in a]: y\nclass C:\n    x\n    x = 1\n    x')
+    assert lines == {'a': [[0]], 'y': [[0, 3]]}
+    assert graph('x = 1\nclass C:\n    x\n    x = 1\n    x', 1) == {'x': [[0], [4]]}
+
+    # change of body of one function rebuilds only its graph
+    before = 'import os\nclass C:\n    def f(self):\n        return 1\n    def g(self):\n        return self.f()\nx = C()\n'
+    after = before.replace('return 1', 'y = os.sep\n        return y')
+    df = dataflow()
+    ast_dump.node_id_counter = 0
+    assert [built for node, g, built in df.update(ast_dump.node_to_dict(ast.parse(before)))] == [True] * 4
+    ast_dump.node_id_counter = 0
+    tree = ast_dump.node_to_dict(ast.parse(after))
+    scopes = df.update(tree)
+    assert [(node_type(node), built) for node, g, built in scopes] == \
+        [('Module', False), ('ClassDef', False), ('FunctionDef', True), ('FunctionDef', False)]
+    d = scopes_dict(scopes, True)
+    assert [s['name'] for s in d['scopes']] == ['f']
+    usages = d['scopes'][0]['usages']
+    assert [(u['name'], u['kind']) for u in usages] == [('self', 'param'), ('os', 'load'), ('y', 'store'), ('y', 'load')]
+    assert usages[1]['defs'] == [None] and usages[3]['defs'] == [usages[2]['node']]
+    # reused graph refers to nodes of new tree
+    d = scopes_dict(scopes)
+    assert d['scopes'][0]['usages'][0]['node'] == tree['body'][0]['names'][0]['_id']
+
+    g = build_graph(tree)
+    t = scope_graph.from_tuple(g.to_tuple())
+    assert t.names == g.names and t.targets == g.targets and t.usage_kinds == g.usage_kinds
+    assert t.paths == g.paths
+
+    # renamed function changes key of enclosing scope
+    df = dataflow()
+    ast_dump.node_id_counter = 0
+    df.update(ast_dump.node_to_dict(ast.parse('def f(): return 1\ndef h(): return f()\n')))
+    ast_dump.node_id_counter = 0
+    scopes = df.update(ast_dump.node_to_dict(ast.parse('def g(): return 1\ndef h(): return g()\n')))
+    assert [built for node, g, built in scopes] == [True, True, True]
+    assert [(u['name'], u['kind']) for u in scopes_dict(scopes)['scopes'][0]['usages']] == [('g', 'def'), ('h', 'def')]
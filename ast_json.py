@@ -0,0 +1,126 @@
+import json
+from json.encoder import encode_basestring_ascii
+
+_END = object()
+
+
+def _float(o):
+    if o != o:
+        return 'NaN'
+    if o == float('inf'):
+        return 'Infinity'
+    if o == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(o)
+
+
+def _scalar(o):
+    """
+    JSON of scalar value, None for containers
+    """
+    if isinstance(o, str):
+        return encode_basestring_ascii(o)
+    if o is None:
+        return 'null'
+    if o is True:
+        return 'true'
+    if o is False:
+        return 'false'
+    if isinstance(o, int):
+        return int.__repr__(o)
+    if isinstance(o, float):
+        return _float(o)
+    return None
+
+
+def _key(k):
+    if isinstance(k, str):
+        return k
+    s = _scalar(k)
+    if s is None:
+        raise TypeError(f'keys must be str, int, float, bool or None, not {type(k).__name__}')
+    return s
+
+
+def iterencode(obj, indent=None, sort_keys=False, separators=None):
+    """
+    Chunks of JSON of obj, the same as json.JSONEncoder(indent=..., sort_keys=..., separators=...).iterencode(obj),
+    with explicit stack instead of recursion, so depth of nesting is not limited
+    """
+    if indent is not None and not isinstance(indent, str):
+        indent = ' ' * indent
+    if separators is not None:
+        item_separator, key_separator = separators
+    elif indent is not None:
+        item_separator, key_separator = ',', ': '
+    else:
+        item_separator, key_separator = ', ', ': '
+
+    # frames of open containers: [items iterator, closing bracket, first item, is dict]
+    stack = []
+    value = obj
+    while True:
+        s = _scalar(value)
+        if s is not None:
+            yield s
+        elif isinstance(value, dict):
+            if len(value) == 0:
+                yield '{}'
+            else:
+                yield '{'
+                items = sorted(value.items()) if sort_keys else value.items()
+                stack.append([iter(items), '}', True, True])
+        elif isinstance(value, (list, tuple)):
+            if len(value) == 0:
+                yield '[]'
+            else:
+                yield '['
+                stack.append([iter(value), ']', True, False])
+        else:
+            raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+        # find next value in innermost open container, closing finished ones
+        while stack:
+            frame = stack[-1]
+            item = next(frame[0], _END)
+            if item is _END:
+                stack.pop()
+                if indent is not None:
+                    yield '\n' + indent * len(stack) + frame[1]
+                else:
+                    yield frame[1]
+                continue
+            prefix = '' if frame[2] else item_separator
+            frame[2] = False
+            if indent is not None:
+                prefix += '\n' + indent * len(stack)
+            if frame[3]:
+                k, value = item
+                prefix += encode_basestring_ascii(_key(k)) + key_separator
+            else:
+                value = item
+            yield prefix
+            break
+        else:
+            return
+
+
+def dumps(obj, indent=None, sort_keys=False, separators=None):
+    return ''.join(iterencode(obj, indent, sort_keys, separators))
+
+
+def test_iterencode():
+    samples = [
+        None, True, 1, -2.5, float('nan'), 'str "q" я \n', [], {}, [[]], {'a': {}},
+        {'b': [1, 2, {'c': None}], 'a': (1, 'x'), 1: 2, None: True, 2.5: False},
+        [1, [2, [3, [4]]], {'k': [{}]}],
+    ]
+    for obj in samples:
+        for kwargs in ({}, {'indent': 4}, {'indent': 4, 'sort_keys': True}, {'separators': (',', ':')}):
+            if kwargs.get('sort_keys') and isinstance(obj, dict) and None in obj:
+                continue
+            assert dumps(obj, **kwargs) == json.dumps(obj, **kwargs), (obj, kwargs)
+    deep = []
+    for i in range(100000):
+        deep = [deep]
+    assert len(dumps(deep)) == 200002
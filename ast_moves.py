@@ -0,0 +1,280 @@
+import hashlib
+import json
+from typing import List, Dict, Tuple, Any
+
+from ast_dataflow import node_type, LOC_FIELDS
+
+# Moves and renames of functions and classes across files.
+#
+# Each version of changed file is summarized once: its definitions with
+# qualified names and hashes, and lines of identifiers used in it.  Removed
+# definitions (no definition with the same file and qualified name after
+# change) are joined with added ones through hash buckets:
+#   1. value hash: same code, moved to other file or class
+#   2. value hash with name of definition and its uses in it blanked:
+#      renamed, maybe moved
+#   3. structure hash (_tree_hash): moved or renamed with changed values,
+#      only definitions of min_weight or heavier
+# Candidates in same file, then with same name, then closest line are
+# preferred.  Definitions nested in matched ones are not reported.
+# Rename is grouped with usages of old name before change and new name
+# after change in files where usages of old name are replaced or which had
+# the definition, usages of old name left after change are reported as
+# remaining (maybe incomplete rename).  Only changed files are seen.
+
+DEF_TYPES = ('FunctionDef', 'AsyncFunctionDef', 'ClassDef')
+
+_canonical_encoder = json.JSONEncoder(sort_keys=True)
+
+
+def _line(node):
+    if 'lineno' in node:
+        return node['lineno']
+    return node.get('_loc', {}).get('lineno')
+
+
+def _norm_hash(node):
+    """
+    Value hash of definition with its name and uses of its name in it
+    (recursive calls, references of class to itself) blanked
+    """
+    name = node['name']
+    # normalized hashes by id of node, subtrees without uses of name keep _val_hash
+    hashes = {}
+    # post-order, (node, children pushed)
+    stack = [(node, False)]
+    while stack:
+        n, pushed = stack.pop()
+        if not pushed:
+            stack.append((n, True))
+            for k, v in n.items():
+                if k[0] == '_':
+                    continue
+                if isinstance(v, dict):
+                    stack.append((v, False))
+                elif isinstance(v, list):
+                    stack.extend((item, False) for item in v if isinstance(item, dict))
+            continue
+        t = node_type(n)
+        values = {'__type': t}
+        children = {}
+        changed = n is node
+        for k, v in n.items():
+            if k[0] == '_' or k in LOC_FIELDS or (k == 'name' and n is node):
+                continue
+            if isinstance(v, dict):
+                children[k] = hashes[id(v)]
+                changed = changed or children[k] != v['_val_hash']
+            elif isinstance(v, list) and (len(v) == 0 or not isinstance(v[0], str)):
+                children[k] = [None if item is None else hashes[id(item)] for item in v]
+                changed = changed or any(item is not None and hashes[id(item)] != item['_val_hash'] for item in v)
+            elif v == name and ((t == 'Name' and k == 'id') or (t == 'Attribute' and k == 'attr')):
+                changed = True
+            else:
+                values[k] = v
+        if changed:
+            canonical = _canonical_encoder.encode([values, children])
+            hashes[id(n)] = hashlib.md5(canonical.encode('utf-8')).hexdigest()
+        else:
+            hashes[id(n)] = n['_val_hash']
+    return hashes[id(node)]
+
+
+def summary(tree: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Definitions of tree in pre-order and lines of identifiers: name -> lines,
+    compact enough to be returned from process pool workers
+    """
+    defs = []
+    names = {}
+    # (node, index of enclosing definition)
+    stack = [(tree, -1)]
+    while stack:
+        node, parent = stack.pop()
+        t = node_type(node)
+        if t in DEF_TYPES:
+            qualname = node['name'] if parent < 0 else defs[parent]['qualname'] + '.' + node['name']
+            defs.append({
+                'type': t,
+                'name': node['name'],
+                'qualname': qualname,
+                'line': _line(node),
+                'weight': node['_weight'],
+                'parent': parent,
+                'val_hash': node['_val_hash'],
+                'norm_hash': _norm_hash(node),
+                'tree_hash': node['_tree_hash'],
+            })
+            parent = len(defs) - 1
+        elif t == 'Name':
+            names.setdefault(node['id'], []).append(_line(node))
+        elif t == 'Attribute':
+            names.setdefault(node['attr'], []).append(_line(node))
+        elif t == 'alias':
+            line = _line(node)
+            names.setdefault(node['name'].split('.')[-1], []).append(line)
+            if node.get('asname'):
+                names.setdefault(node['asname'], []).append(line)
+        for k, v in reversed(node.items()):
+            if k[0] == '_':
+                continue
+            if isinstance(v, dict):
+                stack.append((v, parent))
+            elif isinstance(v, list):
+                stack.extend((item, parent) for item in reversed(v) if isinstance(item, dict))
+    return {'defs': defs, 'names': names}
+
+
+def _place(path, d):
+    return {'path': path, 'qualname': d['qualname'], 'line': d['line']}
+
+
+def find_moves(before: Dict[str, Dict[str, Any]], after: Dict[str, Dict[str, Any]],
+               min_weight: int = 10) -> List[Dict[str, Any]]:
+    """
+    Moves and renames of definitions between summaries of files before and after change: path -> summary()
+    """
+    # (path, index) of definitions without definition of same path and qualified name on other side
+    def unmatched(side, other):
+        result = []
+        for path, s in side.items():
+            o = other.get(path)
+            qualnames = set(d['qualname'] for d in o['defs']) if o is not None else set()
+            result.extend((path, i) for i, d in enumerate(s['defs']) if d['qualname'] not in qualnames)
+        return result
+
+    removed = unmatched(before, after)
+    added = unmatched(after, before)
+    matched1 = set()
+    matched2 = set()
+
+    def covered(side, matched, path, i):
+        # nested in matched definition
+        defs = side[path]['defs']
+        p = defs[i]['parent']
+        while p >= 0:
+            if (path, p) in matched:
+                return True
+            p = defs[p]['parent']
+        return False
+
+    changes = []
+    for key, kind in (('val_hash', 'move'), ('norm_hash', 'rename'), ('tree_hash', 'modified')):
+        buckets = {}
+        for path, i in added:
+            if (path, i) in matched2:
+                continue
+            d = after[path]['defs'][i]
+            if kind == 'modified' and d['weight'] < min_weight:
+                continue
+            buckets.setdefault((d['type'], d[key]), []).append((path, i))
+        # heavier first, so outer definitions are matched before nested ones
+        for path, i in sorted(removed, key=lambda item: -before[item[0]]['defs'][item[1]]['weight']):
+            if (path, i) in matched1 or covered(before, matched1, path, i):
+                continue
+            d = before[path]['defs'][i]
+            candidates = [c for c in buckets.get((d['type'], d[key]), [])
+                          if c not in matched2 and not covered(after, matched2, *c)]
+            if len(candidates) == 0:
+                continue
+            path2, j = min(candidates, key=lambda c: (c[0] != path, after[c[0]]['defs'][c[1]]['name'] != d['name'],
+                                                      abs((after[c[0]]['defs'][c[1]]['line'] or 0) - (d['line'] or 0))))
+            d2 = after[path2]['defs'][j]
+            matched1.add((path, i))
+            matched2.add((path2, j))
+            change = {
+                'kind': 'rename' if d['name'] != d2['name'] else 'move',
+                'type': d['type'],
+                'before': _place(path, d),
+                'after': _place(path2, d2),
+                'moved': path != path2 or d['qualname'].rpartition('.')[0] != d2['qualname'].rpartition('.')[0],
+                'modified': kind == 'modified',
+                'weight': d2['weight'],
+            }
+            changes.append((path, i, path2, j, change))
+    # definitions matched by value before their enclosing definitions were matched by structure
+    changes = [change for path, i, path2, j, change in changes
+               if not (covered(before, matched1, path, i) and covered(after, matched2, path2, j))]
+
+    # renames with usages of old and new names in changed files
+    for change in changes:
+        if change['kind'] != 'rename':
+            continue
+        old = change['before']['qualname'].rpartition('.')[2]
+        new = change['after']['qualname'].rpartition('.')[2]
+        usages = {}
+        for path in sorted(set(before) | set(after)):
+            lines1 = before[path]['names'].get(old, []) if path in before else []
+            lines2 = after[path]['names'].get(new, []) if path in after else []
+            remaining = after[path]['names'].get(old, []) if path in after else []
+            # other files using same name for other things are not related
+            if lines2 or len(lines1) > len(remaining) or (lines1 and path == change['before']['path']):
+                u = {'before': sorted(lines1), 'after': sorted(lines2)}
+                if remaining:
+                    u['remaining'] = sorted(remaining)
+                usages[path] = u
+        change['usages'] = usages
+    changes.sort(key=lambda c: (c['after']['path'], c['after']['line'] or 0))
+    return changes
+
+
+def test_moves():
+    import ast
+    from ast_store import load_ast_dump
+    ast_dump = load_ast_dump()
+
+    def summaries(files):
+        return {path: summary(ast_dump.node_to_dict(ast.parse(code))) for path, code in files.items()}
+
+    before = summaries({
+        'a.py': '\n'.join([
+            'def helper(x):',
+            '    return [i * 2 for i in range(x) if i % 3]',
+            'def old_name(y):',
+            '    return helper(y) + 1',
+            'class K:',
+            '    def m(self):',
+            '        return old_name(self.v) + helper(2) * 3',
+            'def small(): pass',
+        ]),
+        'b.py': 'from a import old_name\nprint(old_name(1))\n',
+    })
+    after = summaries({
+        'a.py': '\n'.join([
+            'def new_name(y):',
+            '    return helper(y) + 1',
+            'class K:',
+            '    def m(self):',
+            '        return new_name(self.v) + helper(5) * 3',
+            'def small2(): pass',
+        ]),
+        'b.py': 'from a import new_name\nprint(old_name(1))\n',
+        'c.py': 'def helper(x):\n    return [i * 2 for i in range(x) if i % 3]\n',
+    })
+    changes = find_moves(before, after)
+    kinds = [(c['kind'], c['before']['path'], c['before']['qualname'], c['after']['path'], c['after']['qualname'],
+              c['modified'], c['moved']) for c in changes]
+    assert kinds == [
+        ('rename', 'a.py', 'old_name', 'a.py', 'new_name', False, False),
+        ('rename', 'a.py', 'small', 'a.py', 'small2', False, False),
+        ('move', 'a.py', 'helper', 'c.py', 'helper', False, True),
+    ], kinds
+    assert changes[0]['usages'] == {
+        'a.py': {'before': [7], 'after': [5]},
+        'b.py': {'before': [1, 2], 'after': [1], 'remaining': [2]},
+    }, changes[0]['usages']
+    # changed values of heavy definition, nested definitions are not reported
+    before = summaries({'a.py': 'class A:\n    def f(self):\n        return self.x + 1 + 2 + 3\n'})
+    after = summaries({'b.py': 'class B:\n    def f(self):\n        return self.y + 1 + 2 + 4\n'})
+    changes = find_moves(before, after)
+    assert [(c['kind'], c['after']['qualname'], c['modified']) for c in changes] == [('rename', 'B', True)]
+    before = summaries({'a.py': 'def f(x):\n    def g(y):\n        return y + 1\n    return g(x) + f(x - 1) + 3\n'})
+    after = summaries({'a.py': 'def h(x):\n    def g(y):\n        return y + 1\n    return g(x) + h(x - 1) + 3\n'})
+    changes = find_moves(before, after)
+    assert [(c['kind'], c['after']['qualname'], c['modified']) for c in changes] == [('rename', 'h', False)]
+    assert changes[0]['usages'] == {'a.py': {'before': [4], 'after': [4]}}
+    # light class referring to itself, renamed without other changes
+    before = summaries({'a.py': 'class A:\n    def copy(self):\n        return A()\n'})
+    after = summaries({'a.py': 'class B:\n    def copy(self):\n        return B()\n'})
+    changes = find_moves(before, after)
+    assert [(c['kind'], c['after']['qualname'], c['modified']) for c in changes] == [('rename', 'B', False)]
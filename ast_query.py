@@ -0,0 +1,508 @@
+import re
+import ast
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from typing import List, Tuple
+
+from ast_store import load_ast_dump
+
+# Selector language over tables of ast-dump.py, like CSS selectors:
+#
+#   Type            nodes of type, * for any type, abstract type (stmt, expr, ...) for its subtypes
+#   A > B           B is child of A
+#   A B             B is descendant of A
+#   A > field > B   B is child of A in attribute field
+#   A > field B     B is in subtree of child of A in attribute field
+#   Names of classes of ast module and capitalized names are types, other
+#   lowercase names are fields, .name is always field (.arg, .slice, .pattern).
+#   A, B            union
+#   Type[pred]      predicates on attributes of node:
+#       [a.b]             attribute path is not None, child nodes are followed by their ids
+#       [a.b="v"]         =, != and for strings ^=, $=, *=, for numbers <, >, <=, >=
+#       [@weight>20]      pseudo attributes: @weight, @depth, @type, @id, @value, @tree (hashes)
+#   List attribute matches if any of its items matches.
+#
+# Steps are evaluated left to right as semi-joins of sorted sets of rows:
+# candidates of step come from types index (and values or trees index for
+# hash predicates) and are restricted to subtree ranges of rows of previous
+# step, rows are in pre-order so subtree of row is rows[row:ends[row]].
+# Attribute predicates and fields are checked last, on remaining rows only.
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<child>>)
+  | (?P<union>,)
+  | (?P<name>\*|\.?[A-Za-z_][A-Za-z0-9_]*)
+  | \[\s*(?P<path>@?[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)\s*
+      (?:(?P<op>!=|\^=|\$=|\*=|<=|>=|=|<|>)\s*
+         (?P<value>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[^\]\s]+)\s*)?\]
+''', re.VERBOSE)
+
+PSEUDO_ATTRS = ('@weight', '@depth', '@type', '@id', '@value', '@tree')
+
+_MISSING = object()
+
+
+class step:
+    """
+    Compiled step of selector: relation to previous step (None for first step,
+    'child', 'descendant' or 'self' - descendant or self), node type names
+    (None for any), field of node in its parent and predicates (path, op, value)
+    """
+    __slots__ = ('axis', 'types', 'field', 'predicates')
+
+    def __init__(self, axis, types=None, field=None, predicates=()):
+        self.axis = axis
+        self.types = types
+        self.field = field
+        self.predicates = tuple(predicates)
+
+    def __repr__(self):
+        return f'step({self.axis!r}, {self.types!r}, {self.field!r}, {self.predicates!r})'
+
+
+def is_type_name(name: str) -> bool:
+    if name[0] == '.':
+        return False
+    cls = getattr(ast, name, None)
+    return name[0].isupper() or (isinstance(cls, type) and issubclass(cls, ast.AST))
+
+
+@lru_cache(maxsize=None)
+def type_names(name: str):
+    """
+    Names of node types matched by type name: subtypes of abstract ast classes, None for *
+    """
+    if name == '*':
+        return None
+    cls = getattr(ast, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, ast.AST)):
+        return (name,)
+    names = []
+    stack = [cls]
+    while stack:
+        c = stack.pop()
+        names.append(c.__name__)
+        stack.extend(c.__subclasses__())
+    return tuple(sorted(set(names)))
+
+
+def _literal(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        # bare word
+        return text
+
+
+@lru_cache(maxsize=256)
+def compile_selector(selector: str) -> Tuple[Tuple[step, ...], ...]:
+    """
+    Selector as tuple of alternatives, each is tuple of steps.  Compiled selectors are cached.
+    """
+    alternatives = []
+    steps = []
+    # combinator before current step and field waiting for its node step
+    axis = None
+    pending_field = None
+    current = None
+    pos = 0
+    while pos < len(selector):
+        m = _TOKEN.match(selector, pos)
+        if m is None:
+            raise ValueError(f'bad selector at {pos}: {selector[pos:]!r}')
+        pos = m.end()
+        kind = m.lastgroup if m.group('path') is None else 'path'
+        if kind == 'space':
+            if current is not None or pending_field is not None:
+                axis = axis or 'descendant'
+            continue
+        if kind in ('child', 'union'):
+            if current is None and pending_field is None:
+                raise ValueError(f'bad selector at {m.start()}: {selector[m.start():]!r}')
+            if kind == 'union':
+                if pending_field is not None:
+                    raise ValueError(f'field {pending_field} without node in {selector!r}')
+                alternatives.append(tuple(steps))
+                steps, axis, current = [], None, None
+                continue
+            # '>' after field keeps axis of field, '>' after node is child axis
+            axis = 'field' if pending_field is not None else 'child'
+            current = None
+            continue
+
+        if kind == 'path' and pending_field is not None:
+            raise ValueError(f'predicate of field {pending_field[0]} at {m.start()} in {selector!r}')
+        if kind == 'name' or (kind == 'path' and current is None):
+            if current is not None and axis is None:
+                raise ValueError(f'missing combinator at {m.start()} in {selector!r}')
+            name = m.group('name') if kind == 'name' else '*'
+            if name != '*' and not is_type_name(name):
+                # field step
+                field_axis = axis if steps else None
+                if pending_field is not None:
+                    # A > field1 > field2: any node in field1 of A
+                    steps.append(step(pending_field[1], None, pending_field[0]))
+                    field_axis = 'child' if axis == 'field' else 'descendant'
+                pending_field = (name.lstrip('.'), field_axis)
+                current = None
+                axis = None
+                continue
+            if pending_field is not None:
+                field, field_axis = pending_field
+                pending_field = None
+                if axis == 'field':
+                    # A > field > B
+                    current = step(field_axis, type_names(name), field)
+                else:
+                    # A > field B
+                    steps.append(step(field_axis, None, field))
+                    current = step('self', type_names(name))
+            else:
+                current = step(axis if steps else None, type_names(name))
+            steps.append(current)
+            axis = None
+            if kind == 'name':
+                continue
+
+        # predicate of current step
+        if current is None or axis is not None:
+            raise ValueError(f'predicate without node at {m.start()} in {selector!r}')
+        path = m.group('path')
+        if path[0] == '@':
+            if path not in PSEUDO_ATTRS:
+                raise ValueError(f'unknown pseudo attribute {path}, expected one of {", ".join(PSEUDO_ATTRS)}')
+            path = (path,)
+        else:
+            path = tuple(path.split('.'))
+        op = m.group('op')
+        value = _literal(m.group('value')) if op is not None else None
+        current.predicates += ((path, op, value),)
+
+    if pending_field is not None:
+        raise ValueError(f'field {pending_field[0]} without node in {selector!r}')
+    if current is None or len(steps) == 0:
+        raise ValueError(f'selector {selector!r} ends with combinator')
+    alternatives.append(tuple(steps))
+    return tuple(alternatives)
+
+
+class _evaluator:
+    """
+    Evaluation of compiled selector on tables ic
+    """
+
+    def __init__(self, ic):
+        self.ic = ic
+        self.parents = ic.parent_rows()
+        self.ends = ic.subtree_ends()
+
+    def need_nodes(self):
+        if len(self.ic.nodes) != len(self.ic.ids):
+            raise ValueError('fields and attribute predicates need nodes of tables, they are not stored with on_node')
+
+    def candidates(self, s: step):
+        """
+        Sorted rows of step from indexes (None for all rows) and predicates not checked by indexes
+        """
+        ic = self.ic
+        rows = None
+        rest = []
+        # rows are all rows of types, attribute index has only them
+        all_of_types = s.types is not None
+        if s.types is not None:
+            if len(s.types) == 1:
+                rows = ic.rows('types', s.types[0])
+            else:
+                rows = sorted(row for name in s.types for row in ic.rows('types', name))
+        for path, op, value in s.predicates:
+            if op != '=' or (s.types is None and path[0] not in ('@value', '@tree')):
+                rest.append((path, op, value))
+            elif path[0] in ('@value', '@tree'):
+                name = 'values' if path[0] == '@value' else 'trees'
+                if rows is None:
+                    rows = ic.rows(name, value)
+                else:
+                    column = ic.values if name == 'values' else ic.trees
+                    code = ic.hash_codes.get(value, -2)
+                    rows = [row for row in rows if column[row] == code]
+                all_of_types = False
+            elif path[0][0] != '@':
+                index_rows = self.attr_index(s.types, path).get(value, [])
+                rows = index_rows if all_of_types else _intersect(rows, index_rows)
+                all_of_types = False
+            else:
+                rest.append((path, op, value))
+        return rows, rest
+
+    def attr_index(self, types, path):
+        """
+        Index of attribute path of nodes of types: value -> sorted rows,
+        built on first use and cached in tables until rows are added
+        """
+        key = ('attrs', types, path)
+        index = self.ic._cache.get(key)
+        if index is None:
+            index = {}
+            for name in types:
+                for row in self.ic.rows('types', name):
+                    for v in self.attr_values(row, path):
+                        if isinstance(v, (str, int, float)) or v is None:
+                            rows = index.setdefault(v, [])
+                            if len(rows) == 0 or rows[-1] != row:
+                                rows.append(row)
+            if len(types) > 1:
+                for rows in index.values():
+                    rows.sort()
+            self.ic._cache[key] = index
+        return index
+
+    def in_field(self, row, field):
+        """
+        Row is held in attribute field of its parent
+        """
+        parent = self.parents[row]
+        if parent < 0:
+            return False
+        v = self.ic.nodes[parent].get(field)
+        node_id = self.ic.node_id(row)
+        if isinstance(v, dict):
+            return v.get('_id') == node_id
+        if isinstance(v, list) and len(v) > 0 and not isinstance(v[0], str):
+            return any(item is not None and item['_id'] == node_id for item in v)
+        return False
+
+    def children(self, rows, field):
+        """
+        Rows of children of rows, only of attribute field if given, from stubs of child nodes
+        """
+        ic = self.ic
+        result = []
+        for row in rows:
+            node = ic.nodes[row]
+            for v in node.values() if field is None else (node.get(field),):
+                if isinstance(v, dict) and '_id' in v:
+                    result.append(ic.row(v['_id']))
+                elif isinstance(v, list) and len(v) > 0 and not isinstance(v[0], str):
+                    result.extend(ic.row(item['_id']) for item in v if item is not None)
+        return sorted(set(result))
+
+    def within(self, candidates, rows, include_self):
+        """
+        Candidates in subtrees of rows (sorted), all rows of subtrees if candidates is None
+        """
+        ends = self.ends
+        # outermost subtrees only, nested ones are inside them
+        starts = []
+        stops = []
+        for row in rows:
+            if len(stops) == 0 or row >= stops[-1]:
+                starts.append(row)
+                stops.append(ends[row])
+        skip = 0 if include_self else 1
+        result = []
+        if candidates is None:
+            for start, stop in zip(starts, stops):
+                result.extend(range(start + skip, stop))
+        elif len(candidates) < 8 * len(starts):
+            for row in candidates:
+                i = bisect_right(starts, row) - 1
+                if i >= 0 and starts[i] + skip <= row < stops[i]:
+                    result.append(row)
+        else:
+            for start, stop in zip(starts, stops):
+                result.extend(candidates[bisect_left(candidates, start + skip):bisect_left(candidates, stop)])
+        return result
+
+    def attr_values(self, row, path):
+        ic = self.ic
+        name = path[0]
+        if name[0] == '@':
+            if name == '@weight':
+                return [ic.weights[row]]
+            if name == '@depth':
+                return [ic.max_depths[row]]
+            if name == '@type':
+                return [ic.type_names[ic.types[row]]]
+            if name == '@id':
+                return [ic.node_id(row)]
+            code = ic.values[row] if name == '@value' else ic.trees[row]
+            return [ic.hashes[code] if code >= 0 else None]
+        values = [ic.nodes[row]]
+        for part in path:
+            next_values = []
+            for v in values:
+                if isinstance(v, dict) and len(v) == 1 and '_id' in v:
+                    # stub of child node
+                    v = ic.nodes[ic.row(v['_id'])]
+                if not isinstance(v, dict):
+                    continue
+                x = v.get(part, _MISSING)
+                if x is _MISSING:
+                    continue
+                if isinstance(x, list):
+                    next_values.extend(x)
+                else:
+                    next_values.append(x)
+            values = next_values
+        return values
+
+    def test(self, row, field, predicates):
+        if field is not None and not self.in_field(row, field):
+            return False
+        for path, op, value in predicates:
+            values = self.attr_values(row, path)
+            if op is None:
+                if not any(v is not None for v in values):
+                    return False
+            elif op == '!=':
+                if any(_compare(v, '=', value) for v in values):
+                    return False
+            elif not any(_compare(v, op, value) for v in values):
+                return False
+        return True
+
+    def run(self, steps):
+        rows = None
+        for i, s in enumerate(steps):
+            if s.field is not None or any(path[0][0] != '@' for path, op, value in s.predicates):
+                self.need_nodes()
+            candidates, predicates = self.candidates(s)
+            field = s.field
+            if i == 0:
+                rows = candidates if candidates is not None else range(len(self.ic.ids))
+            elif s.axis == 'child':
+                if len(self.ic.nodes) == len(self.ic.ids) and (candidates is None or len(candidates) > 4 * len(rows)):
+                    children = self.children(rows, s.field)
+                    rows = children if candidates is None else _intersect(children, candidates)
+                    field = None
+                else:
+                    parent_rows = set(rows)
+                    parents = self.parents
+                    rows = [row for row in self.within(candidates, rows, False) if parents[row] in parent_rows]
+            else:
+                rows = self.within(candidates, rows, s.axis == 'self')
+            if field is not None or predicates:
+                rows = [row for row in rows if self.test(row, field, predicates)]
+            if len(rows) == 0:
+                break
+        return rows
+
+
+def _intersect(rows1, rows2):
+    """
+    Intersection of sorted lists of rows
+    """
+    if len(rows1) > len(rows2):
+        rows1, rows2 = rows2, rows1
+    result = []
+    for row in rows1:
+        i = bisect_left(rows2, row)
+        if i < len(rows2) and rows2[i] == row:
+            result.append(row)
+    return result
+
+
+def _compare(v, op, value):
+    if op == '=':
+        return v == value and type(v) is not dict
+    if isinstance(v, str) and isinstance(value, str):
+        if op == '^=':
+            return v.startswith(value)
+        if op == '$=':
+            return v.endswith(value)
+        if op == '*=':
+            return value in v
+    if isinstance(v, (int, float)) and isinstance(value, (int, float)) and not isinstance(v, bool):
+        if op == '<':
+            return v < value
+        if op == '>':
+            return v > value
+        if op == '<=':
+            return v <= value
+        if op == '>=':
+            return v >= value
+    return False
+
+
+def select(ic, selector: str) -> List[int]:
+    """
+    Sorted rows of tables ic matching selector
+    """
+    e = _evaluator(ic)
+    alternatives = compile_selector(selector)
+    if len(alternatives) == 1:
+        return list(e.run(alternatives[0]))
+    result = set()
+    for steps in alternatives:
+        result.update(e.run(steps))
+    return sorted(result)
+
+
+def select_ids(ic, selector: str) -> List[str]:
+    """
+    Node ids of nodes of tables ic matching selector, in pre-order
+    """
+    return [ic.node_id(row) for row in select(ic, selector)]
+
+
+def test_select():
+    ast_dump = load_ast_dump()
+    code = '\n'.join([
+        'import os',
+        'def foo(a, b=1):',
+        '    print("foo", a)',
+        '    if a:',
+        '        print(b)',
+        '        x = [print(i) for i in range(b)]',
+        '    return bar(a)',
+        'class A:',
+        '    def method(self):',
+        '        log.print("x")',
+        '        print(self)',
+        'print(foo(1, b=2))',
+    ])
+    ast_dump.node_id_counter = 0
+    ic = ast_dump.tables()
+    ast_dump.walk_tree(ast_dump.node_to_dict(ast.parse(code)), ic)
+
+    def lines(selector):
+        return [ic.nodes[row]['_loc']['lineno'] for row in select(ic, selector)]
+
+    assert lines('FunctionDef') == [2, 9]
+    assert lines('Call[func.id="print"]') == [3, 5, 6, 11, 12]
+    assert lines('FunctionDef > body > Expr > value > Call[func.id="print"]') == [3, 11]
+    assert lines('FunctionDef > body Call[func.id="print"]') == [3, 5, 6, 11]
+    assert lines('Module > body > FunctionDef Call[func.id=print]') == [3, 5, 6]
+    assert lines('ClassDef Call') == [10, 11]
+    assert lines('ClassDef > FunctionDef') == [9]
+    assert lines('Module > ClassDef > body > FunctionDef') == [9]
+    assert lines('If > * > Call') == [5]
+    assert lines('If Call') == [5, 6, 6]
+    assert lines('Call[func.attr]') == [10]
+    assert lines('Call[func.id^=pr][args.value="foo"]') == [3]
+    assert lines('Call[keywords.arg="b"], ClassDef') == [8, 12]
+    assert lines('FunctionDef[name!="foo"]') == [9]
+    assert lines('args > arg[arg="self"]') == [9]
+    assert lines('FunctionDef > args arg') == [2, 2, 9]
+    assert lines('FunctionDef > args > args > arg') == [2, 2, 9]
+    assert lines('FunctionDef > args > defaults > *') == [2]
+    assert compile_selector('Subscript > .slice > slice')[0][-1].field == 'slice'
+    assert lines('FunctionDef > body > stmt') == [3, 4, 7, 10, 11]
+    assert lines('ListComp Name[@depth=1]') == [6, 6, 6, 6, 6]
+    assert lines('Expr > Call[@weight>15]') == [10, 12]
+    assert lines('NoSuchType Call') == []
+
+    # hash predicates use values index
+    call = select(ic, 'Call[func.id="print"][args.id="b"]')[0]
+    value_hash = ic.hashes[ic.values[call]]
+    assert select(ic, f'Call[@value="{value_hash}"]') == [call]
+    assert select(ic, f'Expr > *[@value="{value_hash}"]') == [call]
+
+    for bad in ('', '>', 'A >', 'A > body', 'A > body[x=1] > B', 'A[x', 'A[@foo=1]', 'A B,'):
+        try:
+            compile_selector(bad)
+        except ValueError:
+            continue
+        assert False, bad
+
@@ -0,0 +1,509 @@
+import builtins
+from array import array
+from typing import List, Dict, Any
+
+# Scopes, symbols and usages of names, from one traversal of tree of ast-dump.py.
+#
+# Scope is module, class, function, lambda or comprehension, plus one
+# builtins scope.  Symbol is a name bound in a scope, usages of a name are
+# resolved to symbols by Python rules: global and nonlocal declarations,
+# class scopes are not visible from nested scopes, first iterator of
+# comprehension is evaluated in enclosing scope, := in comprehension binds
+# in enclosing function.  Names not bound anywhere are symbols of module
+# scope, unless they are builtins.
+#
+# Usages are stored in visiting order and grouped by symbol lazily as CSR
+# arrays: usages of symbol s are usage_order[offsets[s]:offsets[s+1]], in
+# order of evaluation (decorators and defaults before binding of function,
+# iterators of comprehension before its element), so previous and next
+# usages of symbol are neighbours there.
+
+SCOPE_KINDS = ('module', 'class', 'function', 'lambda', 'comprehension', 'builtins')
+
+# store, update (x += 1) and bindings by statements bind name in scope,
+# modify (x.a = 1, x[0] = 1) and del of attribute are usages of existing binding
+USAGE_KINDS = ('load', 'store', 'del', 'update', 'modify', 'param', 'def', 'import', 'global', 'nonlocal')
+BINDING_KINDS = ('store', 'del', 'update', 'param', 'def', 'import')
+
+FUNCTION_TYPES = ('FunctionDef', 'AsyncFunctionDef', 'Lambda')
+COMPREHENSION_TYPES = ('ListComp', 'SetComp', 'GeneratorExp', 'DictComp')
+
+# fields evaluated not in order of fields, value is evaluated before targets
+EVALUATION_ORDER = {
+    'Assign': ('value', 'targets'),
+    'AnnAssign': ('value', 'target', 'annotation'),
+    'For': ('iter', 'target', 'body', 'orelse'),
+    'AsyncFor': ('iter', 'target', 'body', 'orelse'),
+}
+
+_KIND_CODES = {kind: code for code, kind in enumerate(USAGE_KINDS)}
+_SCOPE_CODES = {kind: code for code, kind in enumerate(SCOPE_KINDS)}
+_BUILTINS = set(dir(builtins))
+
+
+class scope_tables:
+    """
+    Columnar tables of scopes, symbols and usages of one file or, merged
+    with extend(), of a project; node ids of merged rows are namespaced as
+    in tables of ast-dump.py.
+    """
+
+    def __init__(self):
+        self.file_names = []
+        self.file_codes = {}
+
+        # scopes: kind code, node id of defining node (-1 for builtins), parent scope, name
+        self.scope_files = array('l')
+        self.scope_kinds = array('b')
+        self.scope_nodes = array('q')
+        self.scope_parents = array('q')
+        self.scope_names = []
+        self.builtins_scope = -1
+
+        # symbols: scope and name code, (scope, name code) -> symbol
+        self.symbol_scopes = array('q')
+        self.symbol_names = array('l')
+        self.symbol_codes = {}
+        self.names = []
+        self.name_codes = {}
+
+        # usages in visiting order: symbol, scope of usage, kind code, node id
+        self.usage_files = array('l')
+        self.usage_symbols = array('q')
+        self.usage_scopes = array('q')
+        self.usage_kinds = array('b')
+        self.usage_nodes = array('q')
+
+        self._cache = {}
+
+    @staticmethod
+    def _intern(keys, codes, key):
+        code = codes.get(key)
+        if code is None:
+            code = len(keys)
+            codes[key] = code
+            keys.append(key)
+        return code
+
+    def add_scope(self, kind: str, node_id: int, parent: int, name: str = None, file_code: int = -1) -> int:
+        self.scope_files.append(file_code)
+        self.scope_kinds.append(_SCOPE_CODES[kind])
+        self.scope_nodes.append(node_id)
+        self.scope_parents.append(parent)
+        self.scope_names.append(name)
+        return len(self.scope_kinds) - 1
+
+    def symbol(self, scope: int, name: str, create: bool = True) -> int:
+        """
+        Symbol of name in scope, -1 if not found and not create
+        """
+        name_code = self._intern(self.names, self.name_codes, name) if create else self.name_codes.get(name)
+        if name_code is None:
+            return -1
+        key = (scope, name_code)
+        code = self.symbol_codes.get(key)
+        if code is None:
+            if not create:
+                return -1
+            code = len(self.symbol_scopes)
+            self.symbol_codes[key] = code
+            self.symbol_scopes.append(scope)
+            self.symbol_names.append(name_code)
+        return code
+
+    def add_usage(self, symbol: int, scope: int, kind: str, node_id: int, file_code: int = -1):
+        self.usage_files.append(file_code)
+        self.usage_symbols.append(symbol)
+        self.usage_scopes.append(scope)
+        self.usage_kinds.append(_KIND_CODES[kind])
+        self.usage_nodes.append(node_id)
+        if self._cache:
+            self._cache = {}
+
+    def group(self):
+        """
+        CSR arrays (offsets, order) of usages by symbol, built on first use by counting sort
+        """
+        if 'usages' not in self._cache:
+            n = len(self.symbol_scopes)
+            offsets = array('q', [0]) * (n + 1)
+            for symbol in self.usage_symbols:
+                offsets[symbol + 1] += 1
+            for i in range(n):
+                offsets[i + 1] += offsets[i]
+            order = array('q', [0]) * len(self.usage_symbols)
+            fill = array('q', offsets[:n])
+            for row, symbol in enumerate(self.usage_symbols):
+                order[fill[symbol]] = row
+                fill[symbol] += 1
+            self._cache['usages'] = (offsets, order)
+        return self._cache['usages']
+
+    def usages(self, symbol: int):
+        """
+        Rows of usages of symbol, in order of evaluation
+        """
+        offsets, order = self.group()
+        return order[offsets[symbol]:offsets[symbol + 1]]
+
+    def symbols_by_name(self, name: str) -> List[int]:
+        """
+        Symbols of name in all scopes
+        """
+        if 'names' not in self._cache:
+            by_name = {}
+            for symbol, name_code in enumerate(self.symbol_names):
+                by_name.setdefault(name_code, []).append(symbol)
+            self._cache['names'] = by_name
+        name_code = self.name_codes.get(name)
+        return self._cache['names'].get(name_code, [])
+
+    def node_id(self, node_id: int, file_code: int):
+        if file_code < 0:
+            return str(node_id)
+        return f'{self.file_names[file_code]}:{node_id}'
+
+    def scope_id(self, scope: int):
+        """
+        Node id of node defining scope, 'builtins' for builtins scope
+        """
+        if self.scope_kinds[scope] == _SCOPE_CODES['builtins']:
+            return 'builtins'
+        return self.node_id(self.scope_nodes[scope], self.scope_files[scope])
+
+    def usage_dict(self, row: int):
+        return {
+            'node': self.node_id(self.usage_nodes[row], self.usage_files[row]),
+            'kind': USAGE_KINDS[self.usage_kinds[row]],
+            'scope': self.scope_id(self.usage_scopes[row]),
+        }
+
+    def extend(self, other, file_name: str):
+        """
+        Append scopes, symbols and usages of other (tables of single file) in namespace file_name,
+        builtins scopes of files are merged into one
+        """
+        file_code = self._intern(self.file_names, self.file_codes, file_name)
+        scope_map = array('q', [0]) * len(other.scope_kinds)
+        for scope in range(len(other.scope_kinds)):
+            kind = SCOPE_KINDS[other.scope_kinds[scope]]
+            if kind == 'builtins':
+                if self.builtins_scope < 0:
+                    self.builtins_scope = self.add_scope('builtins', -1, -1)
+                scope_map[scope] = self.builtins_scope
+                continue
+            parent = other.scope_parents[scope]
+            scope_map[scope] = self.add_scope(kind, other.scope_nodes[scope],
+                                              scope_map[parent] if parent >= 0 else -1,
+                                              other.scope_names[scope], file_code)
+        symbol_map = [self.symbol(scope_map[other.symbol_scopes[symbol]], other.names[other.symbol_names[symbol]])
+                      for symbol in range(len(other.symbol_scopes))]
+        self.usage_files.extend(array('l', [file_code]) * len(other.usage_symbols))
+        self.usage_symbols.extend(array('q', [symbol_map[symbol] for symbol in other.usage_symbols]))
+        self.usage_scopes.extend(array('q', [scope_map[scope] for scope in other.usage_scopes]))
+        self.usage_kinds.extend(other.usage_kinds)
+        self.usage_nodes.extend(other.usage_nodes)
+        self._cache = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        scopes = {}
+        for scope in range(len(self.scope_kinds)):
+            d = {'kind': SCOPE_KINDS[self.scope_kinds[scope]]}
+            if self.scope_names[scope] is not None:
+                d['name'] = self.scope_names[scope]
+            parent = self.scope_parents[scope]
+            if parent >= 0:
+                d['parent'] = self.scope_id(parent)
+            d['symbols'] = {}
+            scopes[self.scope_id(scope)] = d
+        for symbol in range(len(self.symbol_scopes)):
+            d = scopes[self.scope_id(self.symbol_scopes[symbol])]
+            d['symbols'][self.names[self.symbol_names[symbol]]] = [self.usage_dict(row) for row in self.usages(symbol)]
+        result = {'scopes': scopes}
+        if len(self.file_names) > 0:
+            result['files'] = self.file_names
+        return result
+
+
+class _builder:
+    """
+    One traversal of tree: scopes are created as they are entered, usages are
+    recorded with raw names and resolved to symbols at the end, when bindings
+    of all scopes are known
+    """
+
+    def __init__(self):
+        self.st = scope_tables()
+        # per scope: names bound in it, global and nonlocal declarations
+        self.bound = []
+        self.declared = []
+        # (scope, scope of resolution, name, kind, node id) in visiting order
+        self.raw = []
+        self.resolved = {}
+
+    def new_scope(self, kind, node, parent, name=None):
+        scope = self.st.add_scope(kind, int(node['_id']), parent, name)
+        self.bound.append(set())
+        self.declared.append({})
+        return scope
+
+    def use(self, scope, name, kind, node, at=None):
+        """
+        Usage of name in scope, resolved in scope at (scope by default)
+        """
+        at = scope if at is None else at
+        if kind in BINDING_KINDS:
+            self.bound[at].add(name)
+        elif kind in ('global', 'nonlocal'):
+            self.declared[at][name] = kind
+        self.raw.append((scope, at, name, kind, int(node['_id'])))
+
+    def function_scope(self, scope):
+        """
+        Scope := in comprehension binds in: nearest enclosing scope which is not comprehension
+        """
+        while self.st.scope_kinds[scope] == _SCOPE_CODES['comprehension']:
+            scope = self.st.scope_parents[scope]
+        return scope
+
+    def arguments(self, args, scope, outer):
+        """
+        Items of arguments: parameters bind in scope of function,
+        defaults and annotations are evaluated in outer scope
+        """
+        params = []
+        items = []
+        for key in ('posonlyargs', 'args', 'vararg', 'kwonlyargs', 'kwarg'):
+            value = args.get(key)
+            if value is None:
+                continue
+            for arg in (value if isinstance(value, list) else [value]):
+                params.append((None, scope, (arg['arg'], 'param', arg)))
+                if arg.get('annotation') is not None:
+                    items.append((arg['annotation'], outer, None))
+        for key in ('defaults', 'kw_defaults'):
+            items.extend((item, outer, None) for item in args.get(key) or [] if item is not None)
+        return items, params
+
+    def walk(self, tree):
+        # (node, scope, flag), or (None, scope, (name, kind, node)) for usage recorded when popped,
+        # items are pushed in reverse order of evaluation
+        stack = [(tree, self.new_scope('module', tree, -1), None)]
+        while stack:
+            node, scope, flag = stack.pop()
+            if node is None:
+                self.use(scope, *flag)
+                continue
+            t = node['__type']
+            if t in FUNCTION_TYPES:
+                # decorators, defaults and annotations, binding of name, then body
+                inner = self.new_scope('lambda' if t == 'Lambda' else 'function', node, scope, node.get('name'))
+                outer_items, params = self.arguments(node['args'], inner, scope)
+                if t == 'Lambda':
+                    items = outer_items + params + [(node['body'], inner, None)]
+                else:
+                    items = [(item, scope, None) for item in node['decorator_list']] + outer_items
+                    if node.get('returns') is not None:
+                        items.append((node['returns'], scope, None))
+                    items.append((None, scope, (node['name'], 'def', node)))
+                    items += params
+                    items += [(item, inner, None) for item in node['body']]
+                stack.extend(reversed(items))
+                continue
+            if t == 'ClassDef':
+                inner = self.new_scope('class', node, scope, node['name'])
+                items = [(item, scope, None) for key in ('decorator_list', 'bases', 'keywords') for item in node[key]]
+                items.append((None, scope, (node['name'], 'def', node)))
+                items += [(item, inner, None) for item in node['body']]
+                stack.extend(reversed(items))
+                continue
+            if t in COMPREHENSION_TYPES:
+                inner = self.new_scope('comprehension', node, scope)
+                for key in ('value', 'key', 'elt'):
+                    if key in node:
+                        stack.append((node[key], inner, None))
+                for i, gen in reversed(list(enumerate(node['generators']))):
+                    stack.extend((item, inner, None) for item in reversed(gen['ifs']))
+                    stack.append((gen['target'], inner, None))
+                    # first iterator is evaluated in enclosing scope
+                    stack.append((gen['iter'], scope if i == 0 else inner, None))
+                continue
+
+            if t == 'Name':
+                ctx = node['ctx']['__type']
+                if ctx == 'Store':
+                    kind = 'update' if flag == 'update' else 'store'
+                elif ctx == 'Del':
+                    kind = 'del'
+                else:
+                    kind = flag or 'load'
+                # := in comprehension binds in enclosing function
+                self.use(scope, node['id'], kind, node, self.function_scope(scope) if flag == 'walrus' else None)
+                continue
+            if t in ('Global', 'Nonlocal'):
+                for name in node['names']:
+                    self.use(scope, name, t.lower(), node)
+                continue
+            if t in ('Import', 'ImportFrom'):
+                for alias in node['names']:
+                    if alias['name'] != '*':
+                        self.use(scope, alias['asname'] or alias['name'].split('.')[0], 'import', alias)
+                continue
+            if t == 'AugAssign':
+                stack.append((node['value'], scope, None))
+                stack.append((node['target'], scope, 'update'))
+                continue
+            if t == 'NamedExpr':
+                stack.append((node['value'], scope, None))
+                stack.append((node['target'], scope, 'walrus'))
+                continue
+            if t in ('Attribute', 'Subscript'):
+                # object is modified by assignment to its attribute or item
+                if flag is not None or node['ctx']['__type'] != 'Load':
+                    children = [(node['value'], scope, 'modify')]
+                    if t == 'Subscript':
+                        children.append((node['slice'], scope, None))
+                    stack.extend(reversed(children))
+                    continue
+            elif t == 'ExceptHandler' and node.get('name'):
+                self.use(scope, node['name'], 'store', node)
+            elif t in ('MatchAs', 'MatchStar') and node.get('name'):
+                self.use(scope, node['name'], 'store', node)
+            elif t == 'MatchMapping' and node.get('rest'):
+                self.use(scope, node['rest'], 'store', node)
+
+            keys = EVALUATION_ORDER.get(t)
+            items = list(node.items()) if keys is None else [(k, node[k]) for k in keys]
+            for k, v in reversed(items):
+                if k[0] == '_' or not isinstance(v, (dict, list)):
+                    continue
+                if isinstance(v, list):
+                    stack.extend((item, scope, None) for item in reversed(v) if isinstance(item, dict))
+                else:
+                    stack.append((v, scope, None))
+
+    def resolve(self, scope, name):
+        """
+        Scope of binding of name used in scope, -1 for builtins
+        """
+        key = (scope, name)
+        result = self.resolved.get(key)
+        if result is not None:
+            return result
+        st = self.st
+        declared = self.declared[scope].get(name)
+        if declared == 'global':
+            result = 0
+        elif declared is None and name in self.bound[scope]:
+            result = scope
+        else:
+            # nonlocal skips own scope, all skip classes except own
+            s = st.scope_parents[scope]
+            result = None
+            while s > 0:
+                if st.scope_kinds[s] != _SCOPE_CODES['class'] and \
+                        (name in self.bound[s] or name in self.declared[s]):
+                    result = self.resolve(s, name)
+                    break
+                s = st.scope_parents[s]
+            if result is None:
+                result = 0 if name in self.bound[0] or name not in _BUILTINS else -1
+        self.resolved[key] = result
+        return result
+
+    def finish(self):
+        st = self.st
+        for scope, at, name, kind, node_id in self.raw:
+            target = self.resolve(at, name)
+            if target < 0:
+                if st.builtins_scope < 0:
+                    st.builtins_scope = st.add_scope('builtins', -1, -1)
+                target = st.builtins_scope
+            st.add_usage(st.symbol(target, name), scope, kind, node_id)
+        return st
+
+
+def build_scopes(tree: Dict[str, Any]) -> scope_tables:
+    """
+    Scope tables of tree of ast-dump.py (module), usages of each symbol are in order of evaluation
+    """
+    b = _builder()
+    b.walk(tree)
+    return b.finish()
+
+
+def test_scopes():
+    import ast
+    from ast_store import load_ast_dump
+    ast_dump = load_ast_dump()
+    code = '\n'.join([
+        'import os.path as p, sys',
+        'x = 1',
+        'def f(a, b=x, *args, c: int = 2, **kw):',
+        '    global g',
+        '    g = a',
+        '    y = [x + i for i in range(a) if i]',
+        '    def inner():',
+        '        nonlocal y',
+        '        y += 1',
+        '        return len(y)',
+        '    a.attr = 1',
+        '    a[0].b = 2',
+        '    del kw',
+        '    return [z := i for i in y]',
+        'class C(object):',
+        '    x = 2',
+        '    y = x',
+        '    def m(self):',
+        '        return x',
+        'try:',
+        '    pass',
+        'except Exception as e:',
+        '    print(e, undefined_name)',
+    ])
+    ast_dump.node_id_counter = 0
+    tree = ast_dump.node_to_dict(ast.parse(code))
+    st = build_scopes(tree)
+
+    def usages(scope_kind, scope_name, name):
+        result = []
+        for symbol in st.symbols_by_name(name):
+            scope = st.symbol_scopes[symbol]
+            if SCOPE_KINDS[st.scope_kinds[scope]] == scope_kind and st.scope_names[scope] == scope_name:
+                result.append([(USAGE_KINDS[st.usage_kinds[row]], SCOPE_KINDS[st.scope_kinds[st.usage_scopes[row]]])
+                               for row in st.usages(symbol)])
+        assert len(result) <= 1, (name, result)
+        return result[0] if result else None
+
+    assert [k for k, s in usages('module', None, 'x')] == ['store', 'load', 'load', 'load']
+    assert usages('class', 'C', 'x') == [('store', 'class'), ('load', 'class')]
+    assert usages('module', None, 'p') == [('import', 'module')]
+    assert usages('module', None, 'sys') == [('import', 'module')]
+    assert usages('module', None, 'g') == [('global', 'function'), ('store', 'function')]
+    assert usages('function', 'f', 'y') == [('store', 'function'), ('nonlocal', 'function'),
+                                            ('update', 'function'), ('load', 'function'),
+                                            ('load', 'function')]
+    assert [k for k, s in usages('function', 'f', 'a')] == ['param', 'load', 'load', 'modify', 'modify']
+    assert [k for k, s in usages('function', 'f', 'kw')] == ['param', 'del']
+    assert usages('function', 'f', 'z') == [('store', 'comprehension')]
+    assert usages('function', 'f', 'i') is None
+    assert len(st.symbols_by_name('i')) == 2
+    assert usages('function', 'f', 'c') == [('param', 'function')]
+    assert usages('builtins', None, 'len') == [('load', 'function')]
+    assert usages('builtins', None, 'int') == [('load', 'module')]
+    assert usages('builtins', None, 'object') == [('load', 'module')]
+    assert usages('module', None, 'e') == [('store', 'module'), ('load', 'module')]
+    assert usages('module', None, 'undefined_name') == [('load', 'module')]
+    assert usages('function', 'm', 'self') == [('param', 'function')]
+
+    # project: builtins scope is shared
+    project = scope_tables()
+    project.extend(st, 'a.py')
+    project.extend(st, 'b.py')
+    (symbol,) = [s for s in project.symbols_by_name('len') if project.symbol_scopes[s] == project.builtins_scope]
+    assert [project.usage_dict(row)['node'].split(':')[0] for row in project.usages(symbol)] == ['a.py', 'b.py']
+    assert len(project.symbols_by_name('x')) == 4
+
+    # value and iterator are evaluated before targets
+    st = build_scopes(ast_dump.node_to_dict(ast.parse('x = x + 1\nfor i in i: pass\n')))
+    assert [USAGE_KINDS[kind] for kind in st.usage_kinds] == ['load', 'store', 'load', 'store']
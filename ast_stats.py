@@ -0,0 +1,203 @@
+import sys
+import io
+import json
+import time
+import cProfile
+import pstats
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from typing import Dict, Any
+
+# Instrumentation of pyast.py and ast-dump.py: per-phase timers and counters.
+#
+# Disabled by default, then phase() returns shared empty context manager and
+# count() returns at once; hot loops check enabled before counting.
+# Timers of nested phases are inclusive.
+
+enabled = False
+
+# name -> count
+counters = Counter()
+# phase name -> [calls, wall seconds, cpu seconds]
+timers = {}
+
+_null = nullcontext()
+
+
+def enable(on: bool = True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    counters.clear()
+    timers.clear()
+
+
+def count(name: str, n: int = 1):
+    if enabled:
+        counters[name] += n
+
+
+class _phase:
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        t = timers.get(self.name)
+        if t is None:
+            t = timers[self.name] = [0, 0.0, 0.0]
+        t[0] += 1
+        t[1] += time.perf_counter() - self.wall
+        t[2] += time.process_time() - self.cpu
+        return False
+
+
+def phase(name: str):
+    """
+    Context manager timing wall and CPU time of phase
+    """
+    if not enabled:
+        return _null
+    return _phase(name)
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        'counters': dict(counters),
+        'phases': {name: {'calls': t[0], 'wall': t[1], 'cpu': t[2]} for name, t in timers.items()},
+    }
+
+
+def merge(stats: Dict[str, Any]):
+    """
+    Add snapshot of other process
+    """
+    counters.update(stats['counters'])
+    for name, p in stats['phases'].items():
+        t = timers.get(name)
+        if t is None:
+            t = timers[name] = [0, 0.0, 0.0]
+        t[0] += p['calls']
+        t[1] += p['wall']
+        t[2] += p['cpu']
+
+
+def _call_with_stats(fn, *args):
+    """
+    Process pool worker: result of fn and stats of this call only,
+    stats collected before are kept, worker may run in this process
+    """
+    enable()
+    saved = snapshot()
+    reset()
+    try:
+        result = fn(*args)
+        stats = snapshot()
+    finally:
+        reset()
+        merge(saved)
+    return result, stats
+
+
+def traced(worker):
+    """
+    Process pool worker collecting stats in worker process, results are unpacked by untraced()
+    """
+    if not enabled:
+        return worker
+    return partial(_call_with_stats, worker)
+
+
+def untraced(results):
+    """
+    Results of traced() worker, stats of workers are merged into stats of this process
+    """
+    if not enabled:
+        return results
+    return _untraced(results)
+
+
+def _untraced(results):
+    for result, stats in results:
+        merge(stats)
+        yield result
+
+
+def write_summary(out=None):
+    out = out or sys.stderr
+    if timers:
+        out.write(f'{"phase":24} {"calls":>8} {"wall, s":>10} {"cpu, s":>10}\n')
+        for name, t in sorted(timers.items(), key=lambda item: -item[1][1]):
+            out.write(f'{name:24} {t[0]:8} {t[1]:10.4f} {t[2]:10.4f}\n')
+    if counters:
+        out.write(f'{"counter":24} {"value":>8}\n')
+        for name, n in sorted(counters.items()):
+            out.write(f'{name:24} {n:8}\n')
+
+
+@contextmanager
+def session(stats: str = None, profile: str = None, top: int = 25):
+    """
+    Run main work of script with --stats (text or json) and --profile FILE:
+    stats are written to stderr, profile is saved to FILE in pstats format
+    and its hottest calls are written to stderr.
+    """
+    if stats:
+        enable()
+        reset()
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            s = io.StringIO()
+            pstats.Stats(profiler, stream=s).sort_stats('cumulative').print_stats(top)
+            sys.stderr.write(s.getvalue())
+        if stats == 'json':
+            sys.stderr.write(json.dumps(snapshot(), indent=4, sort_keys=True) + '\n')
+        elif stats:
+            write_summary()
+        enable(False)
+
+
+def test_stats():
+    was_enabled = enabled
+    saved = snapshot()
+    try:
+        enable(False)
+        reset()
+        assert phase('x') is _null
+        count('x')
+        assert len(counters) == 0 and len(timers) == 0
+        enable()
+        with phase('x'):
+            with phase('y'):
+                count('n', 2)
+        count('n')
+        s = snapshot()
+        assert s['counters'] == {'n': 3} and s['phases']['x']['calls'] == 1
+        merge(s)
+        assert counters['n'] == 6 and timers['y'][0] == 2
+        assert list(untraced([(1, s)])) == [1]
+        assert counters['n'] == 9
+        worker = traced(count)
+        assert list(untraced(map(worker, ['n', 'm']))) == [None, None]
+        assert counters['n'] == 10 and counters['m'] == 1
+    finally:
+        reset()
+        merge(saved)
+        enable(was_enabled)
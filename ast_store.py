@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+import os, sys
+import mmap
+import json
+import struct
+import argparse
+import tempfile
+import importlib.util
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from typing import List, Dict, Any
+
+# File layout, all integers little-endian, sections aligned to 8 bytes:
+#
+#   header: magic, version, number of sections
+#   section table: (name, offset, size) for each section
+#   'strings': count, offsets[count+1], utf-8 blob - pool of all strings
+#   'files':   string codes of file names of project
+#   'offsets': first row of each file
+#   'ids':     node id of each row, sorted within each file
+#   'nodes':   fixed-width NODE_RECORD for each row
+#   'attrs':   ATTR_RECORD for each attribute of each node, attributes of node are contiguous
+#   'lists':   rows of child lists and string codes of name lists
+#   'index.*': count of keys, string codes of keys sorted by string, offsets[count+1], rows
+#
+# Node ids and child references are rows, namespaced 'file:id' ids are built on lookup.
+
+MAGIC = b'ASTSTORE'
+VERSION = 1
+
+HEADER = struct.Struct('<8sII')
+SECTION = struct.Struct('<32sQQ')
+# id, parent id, weight, file code, type, max depth, level, value hash, tree hash, 4 locations, first attr, attrs count
+NODE_RECORD = struct.Struct('<qqqiIiiII4iII')
+# field name, kind, value or offset in lists, count of list items
+ATTR_RECORD = struct.Struct('<IIqq')
+FLOAT = struct.Struct('<d')
+
+LOC_FIELDS = ('lineno', 'col_offset', 'end_lineno', 'end_col_offset')
+# location not set, location is None
+NO_LOC = -(1 << 31)
+NONE_LOC = NO_LOC + 1
+
+# kinds of attributes
+K_NONE = 0
+K_FALSE = 1
+K_TRUE = 2
+K_INT = 3
+K_BIGINT = 4
+K_FLOAT = 5
+K_STR = 6
+K_NODE = 7
+K_NODES = 8
+K_STRS = 9
+
+INDEXES = ('types', 'trees', 'values', 'type_depth_weight')
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+class string_pool:
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def __call__(self, s):
+        code = self.codes.get(s)
+        if code is None:
+            code = len(self.strings)
+            self.codes[s] = code
+            self.strings.append(s)
+        return code
+
+    def to_bytes(self):
+        blobs = [s.encode('utf-8', 'surrogatepass') for s in self.strings]
+        offsets = array('q', [0])
+        for b in blobs:
+            offsets.append(offsets[-1] + len(b))
+        return array('q', [len(blobs)]).tobytes() + offsets.tobytes() + b''.join(blobs)
+
+
+def _index_keys(ic, name):
+    if name == 'types':
+        return ic.type_names
+    if name in ('trees', 'values'):
+        return ic.hashes
+    return ic.tdw_keys
+
+
+def write_store(ic, path):
+    """
+    Write tables ic (with stored nodes) to binary file path
+    """
+    pool = string_pool()
+    sections = []
+
+    files = array('q', [pool(name) for name in ic.file_names])
+    sections.append(('files', files.tobytes()))
+    sections.append(('offsets', array('q', ic.file_offsets).tobytes()))
+    sections.append(('ids', array('q', ic.ids).tobytes()))
+
+    nodes = bytearray()
+    attrs = bytearray()
+    lists = array('q')
+    n_attrs = 0
+    for row, node in enumerate(ic.nodes):
+        loc = node.get('_loc', {})
+        locs = [NO_LOC] * len(LOC_FIELDS)
+        for k, v in loc.items():
+            locs[LOC_FIELDS.index(k)] = NONE_LOC if v is None else v
+        first_attr = n_attrs
+        for k, v in node.items():
+            if k[0] == '_':
+                continue
+            a, b = 0, 0
+            if v is None:
+                kind = K_NONE
+            elif v is True or v is False:
+                kind = K_TRUE if v else K_FALSE
+            elif isinstance(v, int):
+                if INT64_MIN <= v <= INT64_MAX:
+                    kind, a = K_INT, v
+                else:
+                    kind, a = K_BIGINT, pool(str(v))
+            elif isinstance(v, float):
+                kind, a = K_FLOAT, struct.unpack('<q', FLOAT.pack(v))[0]
+            elif isinstance(v, str):
+                kind, a = K_STR, pool(v)
+            elif isinstance(v, dict):
+                kind, a = K_NODE, ic.row(v['_id'])
+            elif len(v) > 0 and isinstance(v[0], str):
+                kind, a, b = K_STRS, len(lists), len(v)
+                lists.extend(pool(s) for s in v)
+            else:
+                # -1 is None item (kw_defaults, keys of dict unpacking)
+                kind, a, b = K_NODES, len(lists), len(v)
+                lists.extend(-1 if item is None else ic.row(item['_id']) for item in v)
+            attrs += ATTR_RECORD.pack(pool(k), kind, a, b)
+            n_attrs += 1
+        parent_id = node['_parent_id']
+        if parent_id is not None and isinstance(parent_id, str):
+            parent_id = parent_id.rsplit(':', 1)[-1]
+        nodes += NODE_RECORD.pack(
+            ic.ids[row], -1 if parent_id is None else int(parent_id), node['_weight'], ic.files[row],
+            pool(node['__type']), node['_max_depth'], node['_level'],
+            pool(node['_val_hash']), pool(node['_tree_hash']), *locs,
+            first_attr, n_attrs - first_attr)
+    sections.append(('nodes', bytes(nodes)))
+    sections.append(('attrs', bytes(attrs)))
+    sections.append(('lists', lists.tobytes()))
+
+    for name in INDEXES:
+        offsets, order = ic.group(name)
+        keys = _index_keys(ic, name)
+        groups = sorted((key, code) for code, key in enumerate(keys) if offsets[code + 1] > offsets[code])
+        key_codes = array('q', [len(groups)])
+        key_offsets = array('q', [0])
+        rows = array('q')
+        for key, code in groups:
+            key_codes.append(pool(key))
+            rows.extend(order[offsets[code]:offsets[code + 1]])
+            key_offsets.append(len(rows))
+        sections.append(('index.' + name, key_codes.tobytes() + key_offsets.tobytes() + rows.tobytes()))
+
+    # pool is complete after all other sections
+    sections.insert(0, ('strings', pool.to_bytes()))
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, data in sections:
+        offset = (offset + 7) & ~7
+        table.append(SECTION.pack(name.encode('ascii'), offset, len(data)))
+        offset += len(data)
+
+    # temporary file of each writer, concurrent writers of same path do not clobber it
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(sections)))
+            f.write(b''.join(table))
+            for name, data in sections:
+                f.write(b'\0' * (-f.tell() % 8))
+                f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class index_view(Mapping):
+    """
+    Index section of store: key -> list of node ids
+    """
+
+    def __init__(self, s, data):
+        self.store = s
+        n = data[0]
+        self.key_codes = data[1:1 + n]
+        self.offsets = data[1 + n:2 + 2 * n]
+        self.rows = data[2 + 2 * n:]
+
+    def _find(self, key):
+        # keys are sorted by string, binary search decodes only probed keys
+        lo, hi = 0, len(self.key_codes)
+        string = self.store.string
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if string(self.key_codes[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.key_codes) and string(self.key_codes[lo]) == key:
+            return lo
+        raise KeyError(key)
+
+    def group_rows(self, key):
+        i = self._find(key)
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, key):
+        return [self.store.node_id(row) for row in self.group_rows(key)]
+
+    def __iter__(self):
+        return (self.store.string(code) for code in self.key_codes)
+
+    def __len__(self):
+        return len(self.key_codes)
+
+
+class node_map(Mapping):
+    """
+    Nodes of store: node id -> flat node dict, decoded on lookup
+    """
+
+    def __init__(self, s):
+        self.store = s
+
+    def __getitem__(self, node_id):
+        return self.store.node(self.store.row(node_id))
+
+    def __iter__(self):
+        return (self.store.node_id(row) for row in range(len(self)))
+
+    def __len__(self):
+        return len(self.store.ids)
+
+
+class store:
+    """
+    Memory-mapped binary tables written by write_store.
+    Sections are read in place through memoryviews, nodes are decoded on lookup:
+
+        s = store('dump.bin')
+        s.nodes['12'], s.types['FunctionDef'], s.values[hash]
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.map)
+        if sys.byteorder != 'little':
+            raise ValueError('AST store is read through native arrays, big-endian platforms are not supported')
+        magic, version, count = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path}: not an AST store')
+        if version != VERSION:
+            raise ValueError(f'{path}: AST store version {version}, expected {VERSION}')
+        self.sections = {}
+        for i in range(count):
+            name, offset, size = SECTION.unpack_from(self.buffer, HEADER.size + i * SECTION.size)
+            self.sections[name.rstrip(b'\0').decode('ascii')] = self.buffer[offset:offset + size]
+
+        strings = self.sections['strings']
+        n = strings[:8].cast('q')[0]
+        self.string_offsets = strings[8:8 * (n + 2)].cast('q')
+        self.string_blob = strings[8 * (n + 2):]
+        self.file_codes = self._q('files')
+        self.file_offsets = self._q('offsets')
+        self.ids = self._q('ids')
+        self.records = self.sections['nodes']
+        self.attrs = self.sections['attrs']
+        self.lists = self._q('lists')
+
+        self.files = [self.string(code) for code in self.file_codes]
+        self.file_index = {name: code for code, name in enumerate(self.files)}
+        self.nodes = node_map(self)
+        self.types = index_view(self, self._q('index.types'))
+        self.trees = index_view(self, self._q('index.trees'))
+        self.values = index_view(self, self._q('index.values'))
+        self.type_depth_weight = index_view(self, self._q('index.type_depth_weight'))
+
+    def _q(self, name):
+        return self.sections[name].cast('q')
+
+    def close(self):
+        for name in ('sections', 'string_offsets', 'string_blob', 'file_codes', 'file_offsets', 'ids',
+                     'records', 'attrs', 'lists'):
+            setattr(self, name, None)
+        self.types = self.trees = self.values = self.type_depth_weight = None
+        self.buffer.release()
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def string(self, code):
+        return str(self.string_blob[self.string_offsets[code]:self.string_offsets[code + 1]], 'utf-8', 'surrogatepass')
+
+    def row(self, node_id):
+        lo, hi = 0, len(self.ids)
+        local_id = node_id
+        if isinstance(node_id, str) and ':' in node_id:
+            file_name, local_id = node_id.rsplit(':', 1)
+            file_code = self.file_index[file_name]
+            lo = self.file_offsets[file_code]
+            if file_code + 1 < len(self.file_offsets):
+                hi = self.file_offsets[file_code + 1]
+        local_id = int(local_id)
+        row = bisect_left(self.ids, local_id, lo, hi)
+        if row == hi or self.ids[row] != local_id:
+            raise KeyError(node_id)
+        return row
+
+    def node_id(self, row, local_id=None):
+        if local_id is None:
+            local_id = self.ids[row]
+        file_code = NODE_RECORD.unpack_from(self.records, row * NODE_RECORD.size)[3]
+        if file_code < 0:
+            return str(local_id)
+        return f'{self.files[file_code]}:{local_id}'
+
+    def node(self, row):
+        """
+        Flat node dict of row, the same as in tables.nodes
+        """
+        (node_id, parent_id, weight, file_code, type_code, max_depth, level, val_hash, tree_hash,
+         *locs, first_attr, n_attrs) = NODE_RECORD.unpack_from(self.records, row * NODE_RECORD.size)
+        prefix = '' if file_code < 0 else self.files[file_code] + ':'
+        node = {
+            '__type': self.string(type_code),
+            '_id': prefix + str(node_id),
+            '_loc': {k: (None if v == NONE_LOC else v) for k, v in zip(LOC_FIELDS, locs) if v != NO_LOC},
+            '_val_hash': self.string(val_hash),
+            '_tree_hash': self.string(tree_hash),
+            '_weight': weight,
+            '_max_depth': max_depth,
+            '_level': level,
+            '_parent_id': None if parent_id < 0 else prefix + str(parent_id),
+        }
+        for i in range(first_attr, first_attr + n_attrs):
+            field, kind, a, b = ATTR_RECORD.unpack_from(self.attrs, i * ATTR_RECORD.size)
+            if kind == K_NONE:
+                v = None
+            elif kind == K_FALSE or kind == K_TRUE:
+                v = kind == K_TRUE
+            elif kind == K_INT:
+                v = a
+            elif kind == K_BIGINT:
+                v = int(self.string(a))
+            elif kind == K_FLOAT:
+                v = FLOAT.unpack(struct.pack('<q', a))[0]
+            elif kind == K_STR:
+                v = self.string(a)
+            elif kind == K_NODE:
+                v = {'_id': self.node_id(a)}
+            elif kind == K_NODES:
+                v = [None if child < 0 else {'_id': self.node_id(child)} for child in self.lists[a:a + b]]
+            else:
+                v = [self.string(code) for code in self.lists[a:a + b]]
+            node[self.string(field)] = v
+        return node
+
+    def to_dict(self):
+        """
+        Same dict as tables.to_dict()
+        """
+        d = {
+            'nodes': dict(self.nodes.items()),
+            'trees': dict(self.trees.items()),
+            'types': dict(self.types.items()),
+            'type_depth_weight': dict(self.type_depth_weight.items()),
+            'values': dict(self.values.items()),
+        }
+        if len(self.files) > 0:
+            d['files'] = list(self.files)
+        return d
+
+
+def load_ast_dump():
+    """
+    ast-dump.py next to this file as module
+    """
+    if 'ast_dump' not in sys.modules:
+        spec = importlib.util.spec_from_file_location('ast_dump', os.path.join(os.path.dirname(__file__), 'ast-dump.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['ast_dump'] = module
+        spec.loader.exec_module(module)
+    return sys.modules['ast_dump']
+
+
+def test_round_trip(verbose: bool = False):
+    ast_dump = load_ast_dump()
+    sources = {
+        'a.py': 'x = 1\ny = x + 2.5\nz = None\n\ndef foo(a, b=True, *, c, d=2):\n    global g\n    return a * b ** 100000000000000000000 + len({**c, 1: d})\n',
+        'b.py': 'class A:\n    s = "строка"\n    t = "\\udc80"\n    b = b"\\x00"\n    c = 1j\n    d = ...\n\n    def f(self):\n        pass\n',
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for name, source in sources.items():
+            files.append(os.path.join(tmp, name))
+            with open(files[-1], 'w') as f:
+                f.write(source)
+
+        single = ast_dump.tables()
+        ast_dump.walk_tree(ast_dump.parse_file(files[0]), single)
+        project, errors = ast_dump.dump_project(files, jobs=1)
+
+        for ic in (single, project):
+            path = os.path.join(tmp, 'dump.bin')
+            write_store(ic, path)
+            expected = ic.to_dict()
+            with store(path) as s:
+                actual = s.to_dict()
+                assert json.dumps(actual, sort_keys=True) == json.dumps(expected, sort_keys=True)
+                node_id = ic.node_id(len(ic.ids) - 1)
+                assert s.nodes[node_id] == expected['nodes'][node_id]
+                assert s.types['FunctionDef'] == expected['types']['FunctionDef']
+                assert 'NoSuchType' not in s.types
+            if verbose:
+                print(f'round trip of {len(ic.ids)} nodes ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read binary AST store written by ast-dump.py --binary.')
+    parser.add_argument('path', metavar='dump.bin', nargs='?', help='binary store')
+    parser.add_argument('--node', action='append', default=[], metavar='ID',
+                        help='print node by id')
+    parser.add_argument('--index', nargs=2, action='append', default=[], metavar=('NAME', 'KEY'),
+                        help='print node ids by key of index: types, trees, values or type_depth_weight')
+    parser.add_argument('--test', action='store_true',
+                        help='run self-tests and exit')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.test:
+        test_round_trip(verbose=True)
+        return
+    if args.path is None:
+        parser.error('path of store is required')
+    with store(args.path) as s:
+        if len(args.node) == 0 and len(args.index) == 0:
+            print(json.dumps(s.to_dict(), indent=4, sort_keys=True))
+            return
+        for node_id in args.node:
+            print(json.dumps(s.nodes[node_id], indent=4, sort_keys=True))
+        for name, key in args.index:
+            print(json.dumps(getattr(s, name)[key], indent=4))
+
+
+if __name__ == '__main__':
+    main()
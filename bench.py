@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+import os, sys
+import ast
+import gc
+import json
+import time
+import random
+import re
+import argparse
+import tracemalloc
+from typing import List, Dict, Any, Callable
+
+from ast_store import load_ast_dump
+import pyast
+
+EDIT_KINDS = ('rename', 'move', 'insert', 'reorder')
+
+# loops, try and with can be statically nested only 20 times, deeper blocks are if
+MAX_LOOP_DEPTH = 10
+
+_NAMES = ['value', 'count', 'index', 'item', 'total', 'result', 'key', 'node', 'data', 'size', 'offset', 'name']
+
+
+class corpus:
+    """
+    Deterministic generator of Python modules and their edited versions.
+
+    Module is a list of functions, function is a dict with name, arguments and
+    top-level statements of its body, statement is a list of source lines.
+    Same seed and parameters always give the same sources.
+    """
+
+    def __init__(self, seed: int = 0, statements: int = 8, depth: int = 3):
+        self.rng = random.Random(seed)
+        self.statements = statements
+        self.depth = depth
+        self.function_counter = 0
+
+    def variable(self, names):
+        return self.rng.choice(names)
+
+    def simple_statement(self, names, indent):
+        r = self.rng
+        v = self.variable(names)
+        kind = r.randrange(5)
+        if kind == 0:
+            line = f'{v} = {self.variable(names)} + {r.randrange(100)}'
+        elif kind == 1:
+            line = f'{v} = {self.variable(names)} * {self.variable(names)} - {r.randrange(10)}'
+        elif kind == 2:
+            line = f'{v} = helper({self.variable(names)}, {r.randrange(100)}, "{r.choice(_NAMES)}")'
+        elif kind == 3:
+            line = f'{v} += len([{self.variable(names)}, {r.randrange(10)}])'
+        else:
+            line = f'{v} = {{"{r.choice(_NAMES)}": {self.variable(names)}}}.get("{r.choice(_NAMES)}", {r.random():.3f})'
+        return [indent + line]
+
+    def block(self, names, indent, level, depth):
+        """
+        Compound statement with nested blocks down to depth
+        """
+        r = self.rng
+        v = self.variable(names)
+        if level < MAX_LOOP_DEPTH and r.randrange(2) == 0:
+            header = f'for {v} in range({self.variable(names)}):'
+        elif level < MAX_LOOP_DEPTH and r.randrange(2) == 0:
+            header = f'while {v} < {r.randrange(100)}:'
+        else:
+            header = f'if {v} > {r.randrange(100)}:'
+        lines = [indent + header]
+        inner = indent + '    '
+        lines += self.simple_statement(names, inner)
+        if level + 1 < depth:
+            lines += self.block(names, inner, level + 1, depth)
+        lines += self.simple_statement(names, inner)
+        if header.startswith('while'):
+            lines.append(inner + 'break')
+        return lines
+
+    def function(self) -> Dict[str, Any]:
+        r = self.rng
+        self.function_counter += 1
+        names = r.sample(_NAMES, 5)
+        args = names[:r.randrange(1, 4)]
+        stmts = [[f'    {name} = {r.randrange(10)}'] for name in names[len(args):]]
+        for i in range(self.statements):
+            if r.randrange(3) == 0:
+                stmts.append(self.block(names, '    ', 1, r.randrange(1, self.depth + 1)))
+            else:
+                stmts.append(self.simple_statement(names, '    '))
+        # at least one block of full depth
+        stmts.insert(r.randrange(len(stmts) + 1), self.block(names, '    ', 1, self.depth))
+        stmts.append([f'    return {names[-1]}'])
+        return {'name': f'function_{self.function_counter}', 'args': args, 'names': names, 'stmts': stmts}
+
+    def module(self, functions: int) -> List[Dict[str, Any]]:
+        return [self.function() for i in range(functions)]
+
+    def edit(self, module: List[Dict[str, Any]], kind: str) -> List[Dict[str, Any]]:
+        """
+        Copy of module with one edit of given kind:
+            rename - rename variable in one function
+            move - move function to other place in module
+            insert - insert new statement into function, or new function
+            reorder - swap two adjacent statements of function
+        """
+        r = self.rng
+        module = [dict(f, stmts=list(f['stmts'])) for f in module]
+        f = r.choice(module)
+        if kind == 'rename':
+            old = r.choice(f['names'])
+            new = f'{old}_{r.randrange(1000)}'
+            # not in string literals
+            pattern = re.compile(r'(?<!")\b' + old + r'\b(?!")')
+            f['args'] = [new if a == old else a for a in f['args']]
+            f['names'] = [new if a == old else a for a in f['names']]
+            f['stmts'] = [[pattern.sub(new, line) for line in stmt] for stmt in f['stmts']]
+        elif kind == 'move':
+            module.remove(f)
+            module.insert(r.randrange(len(module) + 1), f)
+        elif kind == 'insert':
+            if r.randrange(4) == 0:
+                module.insert(r.randrange(len(module) + 1), self.function())
+            else:
+                f['stmts'].insert(r.randrange(len(f['stmts'])), self.simple_statement(f['names'], '    '))
+        elif kind == 'reorder':
+            # return stays last
+            i = r.randrange(max(1, len(f['stmts']) - 2))
+            f['stmts'][i], f['stmts'][i + 1] = f['stmts'][i + 1], f['stmts'][i]
+        else:
+            raise ValueError(f'unknown edit {kind}')
+        return module
+
+    def edits(self, module: List[Dict[str, Any]], count: int, kinds=EDIT_KINDS) -> List[Dict[str, Any]]:
+        for i in range(count):
+            module = self.edit(module, kinds[i % len(kinds)])
+        return module
+
+
+def render(module: List[Dict[str, Any]]) -> str:
+    lines = ['def helper(*args):', '    return args[0]', '']
+    for f in module:
+        lines.append('')
+        lines.append(f'def {f["name"]}({", ".join(f["args"])}):')
+        for stmt in f['stmts']:
+            lines += stmt
+    return '\n'.join(lines) + '\n'
+
+
+def generate(size: int, depth: int = 3, edits: int = 0, seed: int = 0, statements: int = 8, kinds=EDIT_KINDS):
+    """
+    Source of module of size functions and its version after edits
+    """
+    c = corpus(seed, statements, depth)
+    module = c.module(size)
+    return render(module), render(c.edits(module, edits, kinds))
+
+
+def calibrate(n: int = 300000) -> float:
+    """
+    Time of fixed pure Python loop, measure of speed of the machine
+    """
+    best = None
+    for i in range(3):
+        t = time.perf_counter()
+        d = {}
+        for j in range(n):
+            d[j & 1023] = str(j)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def measure(fn: Callable[[], Any], repeat: int, memory: bool = True):
+    """
+    Best time of repeat calls of fn, and peak of memory allocated by one call.
+    Garbage collector is disabled while timing, as in timeit.
+    """
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            gc.collect()
+            t = time.perf_counter()
+            fn()
+            t = time.perf_counter() - t
+            best = t if best is None else min(best, t)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+def bench_cases(before: str, after: str):
+    """
+    Benchmarked functions of pipeline on sources before and after, name -> function
+    """
+    ast_dump = load_ast_dump()
+
+    def dump_tree(code):
+        ast_dump.node_id_counter = 0
+        return ast_dump.node_to_dict(ast.parse(code))
+
+    def build_tables(tree):
+        ic = ast_dump.tables()
+        ast_dump.walk_tree(tree, ic)
+        return ic
+
+    tree = dump_tree(before)
+    tree1 = pyast.node_to_dict(ast.parse(before))
+    tree2 = pyast.node_to_dict(ast.parse(after))
+    body1 = tree1['body']
+    body2 = tree2['body']
+    matrix = [[pyast.compare_hashes(src, dst) for src in body1] for dst in body2]
+
+    return {
+        'parse': lambda: ast.parse(before),
+        'node_to_dict': lambda: dump_tree(before),
+        'pyast.node_to_dict': lambda: pyast.node_to_dict(ast.parse(before)),
+        'tables': lambda: build_tables(tree),
+        'compare_lists': lambda: pyast.compare_lists(body1, body2, pyast.compare_hashes),
+        'align_lists': lambda: pyast.compare_lists(body1, body2, pyast.compare_hashes,
+                                                   pyast.node_type_key, pyast.node_value_key),
+        'calculate_list_diff': lambda: pyast.calculate_list_diff(matrix, len(body1), len(body2)),
+        'ast_node_comparator': lambda: pyast.ast_node_comparator()(tree1, tree2),
+    }
+
+
+def run(sizes: List[int], depth: int = 3, edit_ratio: float = 0.1, seed: int = 0, repeat: int = 3,
+        cases: List[str] = None, memory: bool = True, verbose: bool = False) -> Dict[str, Any]:
+    """
+    Benchmark report: time and peak memory of each case for each size of corpus
+    """
+    report = {
+        'python': sys.version.split()[0],
+        'calibration': calibrate(),
+        'params': {'sizes': sizes, 'depth': depth, 'edit_ratio': edit_ratio, 'seed': seed, 'repeat': repeat},
+        'results': [],
+    }
+    for size in sizes:
+        edits = max(1, int(size * edit_ratio))
+        before, after = generate(size, depth, edits, seed)
+        nodes = sum(1 for node in ast.walk(ast.parse(before)))
+        for name, fn in bench_cases(before, after).items():
+            if cases and name not in cases:
+                continue
+            seconds, peak = measure(fn, repeat, memory)
+            result = {'case': name, 'size': size, 'nodes': nodes, 'edits': edits, 'seconds': seconds,
+                      'us_per_node': seconds * 1e6 / nodes, 'peak_bytes': peak}
+            report['results'].append(result)
+            if verbose:
+                print(f'{name:20} {size:6} functions {nodes:8} nodes {seconds:10.4f} s '
+                      f'{peak if peak is not None else "-":>12} B', file=sys.stderr)
+    # speed of machine may change while running
+    report['calibration'] = min(report['calibration'], calibrate())
+    return report
+
+
+def check_regressions(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.25,
+                      min_seconds: float = 0.001) -> List[str]:
+    """
+    Cases of report slower or using more memory than in baseline by more than threshold.
+    Times of baseline are scaled by calibration of both reports, differences
+    below min_seconds are noise.
+    """
+    scale = report['calibration'] / baseline['calibration']
+    base = {(r['case'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        b = base.get((r['case'], r['size']))
+        if b is None:
+            continue
+        expected = b['seconds'] * scale
+        if r['seconds'] > expected * (1 + threshold) and r['seconds'] - expected > min_seconds:
+            regressions.append(f'{r["case"]} size {r["size"]}: {r["seconds"]:.4f} s, '
+                               f'baseline {b["seconds"]:.4f} s (scaled {expected:.4f} s)')
+        if r['peak_bytes'] is not None and b['peak_bytes'] is not None and \
+                r['peak_bytes'] > b['peak_bytes'] * (1 + threshold):
+            regressions.append(f'{r["case"]} size {r["size"]}: peak {r["peak_bytes"]} B, '
+                               f'baseline {b["peak_bytes"]} B')
+    return regressions
+
+
+def test_corpus():
+    a1, b1 = generate(5, depth=4, edits=8, seed=1)
+    a2, b2 = generate(5, depth=4, edits=8, seed=1)
+    assert a1 == a2 and b1 == b2
+    assert a1 != generate(5, depth=4, seed=2)[0]
+    ast.parse(a1)
+    ast.parse(b1)
+    for kind in EDIT_KINDS:
+        before, after = generate(5, depth=4, edits=1, seed=3, kinds=(kind,))
+        ast.parse(after)
+        assert before != after, kind
+    # deep nesting over limit of static blocks
+    ast.parse(generate(2, depth=40)[0])
+
+    report = {'calibration': 1.0, 'results': [{'case': 'x', 'size': 1, 'seconds': 1.0, 'peak_bytes': 100}]}
+    baseline = {'calibration': 2.0, 'results': [{'case': 'x', 'size': 1, 'seconds': 1.5, 'peak_bytes': 100}]}
+    assert len(check_regressions(report, baseline)) == 1
+    baseline['calibration'] = 1.0
+    assert len(check_regressions(report, baseline)) == 0
+
+
+def main():
+    test_corpus()
+
+    parser = argparse.ArgumentParser(description='Benchmark dump and diff pipeline on generated Python sources.')
+    parser.add_argument('--sizes', default='50,100,200,400',
+                        help='comma separated numbers of functions in generated modules (default: 50,100,200,400)')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='nesting depth of compound statements (default: 3)')
+    parser.add_argument('--edits', type=float, default=0.1,
+                        help='number of edits (renames, moves, inserts, reorders) per function (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of generator (default: 0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each case, best time is reported (default: 3)')
+    parser.add_argument('--case', action='append', default=[],
+                        help='run only this case, may be repeated')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not measure peak memory with tracemalloc')
+    parser.add_argument('--output', '-o', default=None,
+                        help='write JSON report to file instead of stdout')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON report of previous run, exit with 1 if some case regressed')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative slowdown or memory growth against baseline (default: 0.25)')
+    parser.add_argument('--generate', metavar='DIR', default=None,
+                        help='only write generated before.py and after.py of largest size to DIR')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='print results to stderr as they are measured')
+    args = parser.parse_args(sys.argv[1:])
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    if args.generate:
+        size = max(sizes)
+        before, after = generate(size, args.depth, max(1, int(size * args.edits)), args.seed)
+        os.makedirs(args.generate, exist_ok=True)
+        for name, source in (('before.py', before), ('after.py', after)):
+            with open(os.path.join(args.generate, name), 'w') as f:
+                f.write(source)
+        exit(0)
+
+    report = run(sizes, args.depth, args.edits, args.seed, args.repeat, args.case, not args.no_memory, args.verbose)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(report, baseline, args.threshold)
+        for line in regressions:
+            print(f'regression: {line}', file=sys.stderr)
+        if regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
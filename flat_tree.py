@@ -0,0 +1,509 @@
+import sys
+import ast
+import json
+import hashlib
+from array import array
+from collections.abc import Mapping
+from typing import List, Dict, Tuple, Any
+
+# layout of node dicts: ast-dump.py (__type, _loc, _level, ...) or pyast.py (_type, locations as fields)
+SCHEMA_DUMP = 'dump'
+SCHEMA_PYAST = 'pyast'
+
+LOC_FIELDS = ('lineno', 'col_offset', 'end_lineno', 'end_col_offset')
+
+# kinds of fields in node shape
+SCALAR = 0
+NODE = 1
+LIST = 2
+LOC = 3
+# list with None items: positions of None items are scalar of node
+HOLES = 4
+
+# attribute values stored as is, bool is int
+SCALAR_TYPES = (str, int, float, type(None))
+
+# location which is None or not set
+NO_LOC = -(1 << 31)
+
+# bump when layout of arrays or pools changes
+FORMAT_VERSION = 2
+
+
+# same output as json.dumps(..., sort_keys=True), without creating encoder for each node
+_canonical_encoder = json.JSONEncoder(sort_keys=True)
+
+def node_hash(fields, children):
+    """
+    Merkle hash of a node, same as in ast-dump.py and pyast.py
+    """
+    canonical = _canonical_encoder.encode([fields, children])
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
+
+
+class flat_tree:
+    """
+    Tree of nodes in parallel arrays, indexed by node number in pre-order.
+
+    Structure is parent / first child / next sibling links plus field code
+    of each node in its parent.  Type, attribute names and kinds of a node
+    are its shape, interned in shapes pool.  Scalar attributes are codes of
+    interned constants, scalars of node i start at scalars[scalar_offsets[i]].
+    Hashes are the first 64 bits of _val_hash and _tree_hash of node dicts.
+
+    Nodes are read through node_view, mapping with the same keys and
+    values as node dicts of schema, so walk_tree, get_flat_node and
+    comparators work on views as on dicts.
+    """
+
+    def __init__(self, schema=SCHEMA_DUMP):
+        self.schema = schema
+
+        self.types = array('i')
+        self.shapes = array('i')
+        self.parents = array('i')
+        self.first_children = array('i')
+        self.next_siblings = array('i')
+        # code of field of node in its parent, -1 for root
+        self.fields = array('i')
+        self.weights = array('i')
+        self.levels = array('i')
+        self.max_depths = array('i')
+        self.val_hashes = array('Q')
+        self.tree_hashes = array('Q')
+        # first scalar of node, number of scalars is in its shape
+        self.scalar_offsets = array('i')
+        self.scalars = array('i')
+        # LOC_FIELDS of each node, NO_LOC if not set
+        self.locs = array('i')
+
+        self.type_names = []
+        self.type_codes = {}
+        self.field_names = []
+        self.field_codes = {}
+        # shape: (type code, ((field code, kind), ...))
+        self.shape_keys = []
+        self.shape_codes = {}
+        # scalar values, Global and Nonlocal names as tuples
+        self.constants = []
+        self.constant_codes = {}
+
+        # field name -> (kind, slot) of each shape, slot is index of scalar or location
+        self._shape_fields = []
+
+    def __len__(self):
+        return len(self.types)
+
+    @staticmethod
+    def _intern(keys, codes, key):
+        code = codes.get(key)
+        if code is None:
+            code = len(keys)
+            codes[key] = code
+            keys.append(key)
+        return code
+
+    def _intern_constant(self, v):
+        # 1, 1.0 and True are equal as dict keys, -0.0 and 0.0 too
+        key = (type(v).__name__, repr(v) if isinstance(v, float) else v)
+        code = self.constant_codes.get(key)
+        if code is None:
+            code = len(self.constants)
+            self.constant_codes[key] = code
+            self.constants.append(v)
+        return code
+
+    def _intern_shape(self, type_code, fields):
+        code = self.shape_codes.get((type_code, fields))
+        if code is None:
+            code = self._intern(self.shape_keys, self.shape_codes, (type_code, fields))
+            self._shape_fields.append(self._slots(fields))
+        return code
+
+    def _slots(self, fields):
+        slots = {}
+        scalar_slot = 0
+        for field_code, kind in fields:
+            if kind == SCALAR:
+                slots[self.field_names[field_code]] = (kind, scalar_slot)
+                scalar_slot += 1
+            elif kind == LOC:
+                slots[self.field_names[field_code]] = (kind, LOC_FIELDS.index(self.field_names[field_code]))
+            elif kind == HOLES:
+                slots[self.field_names[field_code]] = (kind, (field_code, scalar_slot))
+                scalar_slot += 1
+            else:
+                slots[self.field_names[field_code]] = (kind, field_code)
+        return slots
+
+    @classmethod
+    def from_ast(cls, node, schema=SCHEMA_DUMP):
+        tree = cls(schema)
+        tree._add(node)
+        return tree
+
+    def _add(self, root):
+        """
+        Append ast node root and its subtree, without recursion: first pass
+        appends nodes in pre-order with structure, shapes, scalars and
+        locations, second pass in reverse pre-order computes weights, depths
+        and hashes from already finished children.
+        """
+        first = len(self.types)
+        # value fields of nodes for hashes, in order of nodes
+        value_fields = []
+        # (ast node, parent, field code in parent, level)
+        stack = [(root, -1, -1, 0)]
+        last_child = {}
+        while stack:
+            node, parent, field_code, level = stack.pop()
+            i = len(self.types)
+            if parent >= 0:
+                if parent in last_child:
+                    self.next_siblings[last_child[parent]] = i
+                else:
+                    self.first_children[parent] = i
+                last_child[parent] = i
+            type_name = type(node).__name__
+            type_code = self._intern(self.type_names, self.type_codes, type_name)
+            self.types.append(type_code)
+            self.parents.append(parent)
+            self.first_children.append(-1)
+            self.next_siblings.append(-1)
+            self.fields.append(field_code)
+            self.levels.append(level)
+            self.scalar_offsets.append(len(self.scalars))
+            locs = [NO_LOC] * len(LOC_FIELDS)
+
+            fields = []
+            values = {'__type': type_name}
+            children = []
+            for k,v in node.__dict__.items():
+                k_code = self.field_codes.get(k)
+                if k_code is None:
+                    k_code = self._intern(self.field_names, self.field_codes, k)
+                if k in LOC_FIELDS:
+                    fields.append((k_code, LOC))
+                    if v is not None:
+                        locs[LOC_FIELDS.index(k)] = v
+                elif isinstance(v, ast.AST):
+                    fields.append((k_code, NODE))
+                    children.append((v, i, k_code, level + 1))
+                elif isinstance(v, list) and (len(v) == 0 or not isinstance(v[0], str)):
+                    holes = tuple(j for j, item in enumerate(v) if item is None)
+                    if holes:
+                        # kw_defaults, keys of dict unpacking
+                        fields.append((k_code, HOLES))
+                        self.scalars.append(self._intern_constant(holes))
+                    else:
+                        fields.append((k_code, LIST))
+                    for item in v:
+                        if item is not None:
+                            children.append((item, i, k_code, level + 1))
+                else:
+                    if isinstance(v, list):
+                        # names of Global and Nonlocal
+                        values[k] = v
+                        v = tuple(v)
+                    elif not isinstance(v, SCALAR_TYPES):
+                        # bytes, complex and Ellipsis constants
+                        v = repr(v)
+                        values[k] = v
+                    else:
+                        values[k] = v
+                    fields.append((k_code, SCALAR))
+                    self.scalars.append(self._intern_constant(v))
+            self.shapes.append(self._intern_shape(type_code, tuple(fields)))
+            self.locs.extend(locs)
+            value_fields.append(values)
+            children.reverse()
+            stack.extend(children)
+
+        n = len(self.types)
+        self.weights.extend(array('i', [0]) * (n - first))
+        self.max_depths.extend(array('i', [0]) * (n - first))
+        self.val_hashes.extend(array('Q', [0]) * (n - first))
+        self.tree_hashes.extend(array('Q', [0]) * (n - first))
+        # full hex hashes of finished nodes, needed only by their parents
+        hashes = {}
+        for i in range(n - 1, first - 1, -1):
+            child_hashes = {}
+            weight = 1
+            max_depth = 0
+            for child in self.children(i):
+                child_hashes.setdefault(self.fields[child], []).append(hashes.pop(child))
+                weight += self.weights[child]
+                if self.max_depths[child] >= max_depth:
+                    max_depth = self.max_depths[child] + 1
+            value_children = {}
+            tree_children = {}
+            scalar = self.scalar_offsets[i]
+            for field_code, kind in self.shape_keys[self.shapes[i]][1]:
+                if kind == LOC:
+                    continue
+                weight += 1
+                if kind == SCALAR:
+                    scalar += 1
+                    continue
+                k = self.field_names[field_code]
+                items = child_hashes.get(field_code, [])
+                if kind == NODE:
+                    value_children[k], tree_children[k] = items[0]
+                    continue
+                if kind == HOLES:
+                    items = _with_holes(items, self.constants[self.scalars[scalar]], (None, None))
+                    scalar += 1
+                value_children[k] = [val for val, tre in items]
+                tree_children[k] = [tre for val, tre in items]
+            values = value_fields[i - first]
+            val_hash = node_hash(values, value_children)
+            tree_hash = node_hash({'__type': values['__type']}, tree_children)
+            hashes[i] = (val_hash, tree_hash)
+            self.weights[i] = weight
+            self.max_depths[i] = max_depth
+            self.val_hashes[i] = int(val_hash[:16], 16)
+            self.tree_hashes[i] = int(tree_hash[:16], 16)
+
+    def root(self):
+        return node_view(self, 0)
+
+    def view(self, i):
+        return node_view(self, i)
+
+    def children(self, i):
+        """
+        Numbers of child nodes of node i, in order of attributes
+        """
+        child = self.first_children[i]
+        while child >= 0:
+            yield child
+            child = self.next_siblings[child]
+
+    def val_hash(self, i):
+        return '%016x' % self.val_hashes[i]
+
+    def tree_hash(self, i):
+        return '%016x' % self.tree_hashes[i]
+
+    def memory_usage(self):
+        """
+        Bytes in arrays and pools, without shared interned strings of field and type names
+        """
+        size = 0
+        for column in self._columns():
+            size += column.itemsize * len(column)
+        size += sum(sys.getsizeof(v) for v in self.constants)
+        size += sys.getsizeof(self.constants) + sys.getsizeof(self.constant_codes)
+        size += sys.getsizeof(self.shape_keys) + sys.getsizeof(self.shape_codes)
+        return size
+
+    def _columns(self):
+        return (self.types, self.shapes, self.parents, self.first_children, self.next_siblings, self.fields,
+                self.weights, self.levels, self.max_depths, self.val_hashes, self.tree_hashes,
+                self.scalar_offsets, self.scalars, self.locs)
+
+    def to_tuple(self):
+        """
+        Tree as tuple of bytes, strings and tuples, for marshal (ast_cache.parse_cache)
+        """
+        return (FORMAT_VERSION, self.schema, tuple(column.tobytes() for column in self._columns()),
+                tuple(self.type_names), tuple(self.field_names), tuple(self.shape_keys), tuple(self.constants))
+
+    @classmethod
+    def from_tuple(cls, t):
+        version, schema, columns, type_names, field_names, shape_keys, constants = t
+        if version != FORMAT_VERSION:
+            raise ValueError(f'flat tree format version {version}, expected {FORMAT_VERSION}')
+        tree = cls(schema)
+        for column, data in zip(tree._columns(), columns):
+            column.frombytes(data)
+        tree.type_names = list(type_names)
+        tree.type_codes = {name: code for code, name in enumerate(type_names)}
+        tree.field_names = list(field_names)
+        tree.field_codes = {name: code for code, name in enumerate(field_names)}
+        tree.shape_keys = list(shape_keys)
+        tree.shape_codes = {key: code for code, key in enumerate(shape_keys)}
+        tree._shape_fields = [tree._slots(fields) for type_code, fields in shape_keys]
+        tree.constants = list(constants)
+        tree.constant_codes = {(type(v).__name__, repr(v) if isinstance(v, float) else v): code
+                               for code, v in enumerate(constants)}
+        return tree
+
+
+def _with_holes(items, holes, hole):
+    """
+    List of items with hole inserted at positions holes
+    """
+    result = list(items)
+    # ascending positions in result
+    for j in holes:
+        result.insert(j, hole)
+    return result
+
+
+class node_view(Mapping):
+    """
+    Read-only node of flat_tree as mapping with keys and values of node dict:
+    scalars, child views and lists of child views, meta fields of schema
+    """
+
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def _meta(self):
+        t = self.tree
+        i = self.index
+        type_name = t.type_names[t.types[i]]
+        if t.schema == SCHEMA_PYAST:
+            return {'_id': i, '_type': type_name}, {
+                '_val_hash': t.val_hash(i),
+                '_tree_hash': t.tree_hash(i),
+                '_weight': t.weights[i],
+            }
+        parent = t.parents[i]
+        return {
+            '__type': type_name,
+            '_id': str(i),
+            '_loc': self.loc(),
+            '_val_hash': t.val_hash(i),
+            '_tree_hash': t.tree_hash(i),
+            '_weight': t.weights[i],
+            '_max_depth': t.max_depths[i],
+            '_level': t.levels[i],
+            '_parent_id': None if parent < 0 else str(parent),
+        }, {}
+
+    def loc(self):
+        t = self.tree
+        base = self.index * len(LOC_FIELDS)
+        loc = {}
+        for k, kind in self._fields():
+            if kind == LOC:
+                v = t.locs[base + LOC_FIELDS.index(k)]
+                loc[k] = None if v == NO_LOC else v
+        return loc
+
+    def _fields(self):
+        t = self.tree
+        return [(t.field_names[field_code], kind) for field_code, kind in t.shape_keys[t.shapes[self.index]][1]]
+
+    def attrs(self):
+        """
+        Dict of attributes: scalars, child views and lists of child views
+        """
+        t = self.tree
+        i = self.index
+        children = {}
+        for child in t.children(i):
+            children.setdefault(t.fields[child], []).append(node_view(t, child))
+        scalar = t.scalar_offsets[i]
+        base = i * len(LOC_FIELDS)
+        attrs = {}
+        for field_code, kind in t.shape_keys[t.shapes[i]][1]:
+            k = t.field_names[field_code]
+            if kind == SCALAR:
+                v = t.constants[t.scalars[scalar]]
+                attrs[k] = list(v) if isinstance(v, tuple) else v
+                scalar += 1
+            elif kind == NODE:
+                attrs[k] = children[field_code][0]
+            elif kind == LIST:
+                attrs[k] = children.get(field_code, [])
+            elif kind == HOLES:
+                attrs[k] = _with_holes(children.get(field_code, []), t.constants[t.scalars[scalar]], None)
+                scalar += 1
+            elif t.schema == SCHEMA_PYAST:
+                v = t.locs[base + LOC_FIELDS.index(k)]
+                attrs[k] = None if v == NO_LOC else v
+        return attrs
+
+    def _dict(self):
+        head, tail = self._meta()
+        head.update(self.attrs())
+        head.update(tail)
+        return head
+
+    def __getitem__(self, key):
+        t = self.tree
+        i = self.index
+        slot = t._shape_fields[t.shapes[i]].get(key)
+        if slot is None:
+            head, tail = self._meta()
+            if key in head:
+                return head[key]
+            return tail[key]
+        kind, n = slot
+        if kind == SCALAR:
+            v = t.constants[t.scalars[t.scalar_offsets[i] + n]]
+            return list(v) if isinstance(v, tuple) else v
+        if kind == LOC:
+            if t.schema != SCHEMA_PYAST:
+                raise KeyError(key)
+            v = t.locs[i * len(LOC_FIELDS) + n]
+            return None if v == NO_LOC else v
+        if kind == HOLES:
+            n, slot = n
+            holes = t.constants[t.scalars[t.scalar_offsets[i] + slot]]
+        items = [node_view(t, child) for child in t.children(i) if t.fields[child] == n]
+        if kind == HOLES:
+            return _with_holes(items, holes, None)
+        return items[0] if kind == NODE else items
+
+    def __iter__(self):
+        return iter(self._dict())
+
+    def __len__(self):
+        return len(self._dict())
+
+    def items(self):
+        return self._dict().items()
+
+    def keys(self):
+        return self._dict().keys()
+
+    def values(self):
+        return self._dict().values()
+
+    def __eq__(self, other):
+        if isinstance(other, node_view) and other.tree is self.tree:
+            return other.index == self.index
+        return Mapping.__eq__(self, other)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return f'node_view({self.tree.type_names[self.tree.types[self.index]]}, {self.index})'
+
+    def to_dict(self):
+        """
+        Node dict of schema with subtree, as node_to_dict of ast-dump.py or pyast.py, without recursion
+        """
+        root = {}
+        stack = [(self, root)]
+        while stack:
+            view, d = stack.pop()
+            for k, v in view.items():
+                if isinstance(v, node_view):
+                    child = {}
+                    stack.append((v, child))
+                    v = child
+                elif isinstance(v, list) and len(v) > 0 and not isinstance(v[0], str):
+                    children = []
+                    for item in v:
+                        if item is None:
+                            children.append(None)
+                            continue
+                        child = {}
+                        stack.append((item, child))
+                        children.append(child)
+                    v = children
+                d[k] = v
+        return root
+
+
+def parse(code, schema=SCHEMA_DUMP):
+    return flat_tree.from_ast(ast.parse(code), schema)
@@ -6,92 +6,870 @@ import ast
 import hashlib
 from typing import List, Set, Dict, Tuple, Any, Callable
 import argparse
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
+from py2cxx_types import (types, cxx_type, constant_type, binop_type, is_list, is_range,
+                          BOOL, INT, FLOAT, STR, NONE, ANY, NUMBERS, SCALARS)
 
-def convert_cxx(filename):
+
+# first lines of each generated program
+BANNER = """/**************************************************
+* This program was generated from Python code
+*
+**************************************************/
+
+"""
+
+# runtime of generated programs, inlined in each program, or included from
+# header of this name, which may be precompiled once for many programs
+RUNTIME_HEADER = 'py2cxx_runtime.h'
+
+RUNTIME = """#include <variant>
+#include <iostream>
+#include <string>
+#include <vector>
+#include <memory>
+#include <algorithm>
+#include <type_traits>
+#include <charconv>
+#include <cmath>
+#include <cstdint>
+#include <limits>
+
+struct py_list;
+
+using any = std::variant<int64_t, double, bool, std::string, void*, std::shared_ptr<py_list>>;
+
+// list in any, shared like Python list
+struct py_list : std::vector<any> {};
+
+inline any py_any(any const& v) { return v; }
+template <class T> any py_any(T const& v) { return any(v); }
+template <class T> any py_any(std::vector<T> const& v) {
+    auto l = std::make_shared<py_list>();
+    l->reserve(v.size());
+    for (auto const& e : v) {
+        l->push_back(py_any(e));
+    }
+    return l;
+}
+
+// float as Python prints it: shortest repr, fixed notation in [1e-4, 1e16)
+inline std::string py_float(double v) {
+    char buf[32];
+    double a = std::fabs(v);
+    bool fixed = a == 0 || (a >= 1e-4 && a < 1e16);
+    char* end = std::to_chars(buf, buf + sizeof(buf), v,
+                              fixed ? std::chars_format::fixed : std::chars_format::scientific).ptr;
+    std::string s(buf, end);
+    if (fixed && s.find('.') == std::string::npos) {
+        s += ".0";
+    }
+    return s;
+}
+
+// str() and repr() of values
+inline void py_write(std::ostream& os, int64_t v) { os << v; }
+inline void py_write(std::ostream& os, double v) { os << py_float(v); }
+inline void py_write(std::ostream& os, bool v) { os << (v ? "True" : "False"); }
+inline void py_write(std::ostream& os, std::string const& v) { os << v; }
+inline void py_write(std::ostream& os, void* v) { if (v) os << v; else os << "None"; }
+inline void py_write(std::ostream& os, any const& v);
+inline void py_write(std::ostream& os, std::shared_ptr<py_list> const& v);
+template <class T> void py_write(std::ostream& os, std::vector<T> const& v);
+
+inline void py_repr(std::ostream& os, std::string const& v) {
+    char quote = v.find('\\'') != std::string::npos && v.find('"') == std::string::npos ? '"' : '\\'';
+    os << quote;
+    for (unsigned char c : v) {
+        if (c == '\\\\' || c == quote) {
+            os << '\\\\' << c;
+        } else if (c == '\\n') {
+            os << "\\\\n";
+        } else if (c == '\\r') {
+            os << "\\\\r";
+        } else if (c == '\\t') {
+            os << "\\\\t";
+        } else if (c < 0x20 || c == 0x7f) {
+            const char* hex = "0123456789abcdef";
+            os << "\\\\x" << hex[c >> 4] << hex[c & 15];
+        } else {
+            os << c;
+        }
+    }
+    os << quote;
+}
+inline void py_repr(std::ostream& os, any const& v);
+template <class T> void py_repr(std::ostream& os, T const& v) { py_write(os, v); }
+
+template <class T> void py_write(std::ostream& os, std::vector<T> const& v) {
+    os << '[';
+    for (size_t i = 0; i < v.size(); ++i) {
+        if (i > 0) {
+            os << ", ";
+        }
+        py_repr(os, v[i]);
+    }
+    os << ']';
+}
+inline void py_write(std::ostream& os, std::shared_ptr<py_list> const& v) {
+    py_write(os, static_cast<std::vector<any> const&>(*v));
+}
+inline void py_write(std::ostream& os, any const& v) {
+    std::visit([&os](auto const& e){ py_write(os, e); }, v);
+}
+inline void py_repr(std::ostream& os, any const& v) {
+    std::visit([&os](auto const& e){ py_repr(os, e); }, v);
+}
+
+inline std::ostream& operator<< (std::ostream& os, any const& v) {
+    py_write(os, v);
+    return os;
+}
+
+template <class T> std::ostream& operator<< (std::ostream& os, std::vector<T> const& v) {
+    py_write(os, v);
+    return os;
+}
+
+inline bool py_truth(std::string const& v) { return !v.empty(); }
+template <class T> bool py_truth(std::vector<T> const& v) { return !v.empty(); }
+inline bool py_truth(any const& v) {
+    return std::visit([](auto const& e) -> bool {
+        using T = std::decay_t<decltype(e)>;
+        if constexpr (std::is_same_v<T, std::string>) {
+            return !e.empty();
+        } else if constexpr (std::is_same_v<T, std::shared_ptr<py_list>>) {
+            return !e->empty();
+        } else {
+            return e != 0;
+        }
+    }, v);
+}
+
+// arithmetic with Python semantics where it differs from C++
+inline int64_t py_floordiv(int64_t a, int64_t b) {
+    int64_t q = a / b;
+    return (a % b != 0 && (a < 0) != (b < 0)) ? q - 1 : q;
+}
+inline double py_floordiv(double a, double b) { return std::floor(a / b); }
+inline int64_t py_mod(int64_t a, int64_t b) {
+    int64_t r = a % b;
+    return (r != 0 && (r < 0) != (b < 0)) ? r + b : r;
+}
+inline double py_mod(double a, double b) {
+    double r = std::fmod(a, b);
+    return (r != 0 && (r < 0) != (b < 0)) ? r + b : r;
+}
+inline int64_t py_pow(int64_t a, int64_t b) {
+    int64_t r = 1;
+    for (; b > 0; b >>= 1) {
+        if (b & 1) {
+            r *= a;
+        }
+        a *= a;
+    }
+    return r;
+}
+
+inline int64_t py_range_len(int64_t start, int64_t stop, int64_t step) {
+    if (step > 0 ? start >= stop : start <= stop) {
+        return 0;
+    }
+    return step > 0 ? (stop - start + step - 1) / step : (start - stop - step - 1) / -step;
+}
+
+// item at index, negative counts from end
+template <class T> decltype(auto) py_at(std::vector<T>& v, int64_t i) { return v[i < 0 ? i + int64_t(v.size()) : i]; }
+template <class T> decltype(auto) py_at(std::vector<T> const& v, int64_t i) { return v[i < 0 ? i + int64_t(v.size()) : i]; }
+inline char& py_at(std::string& s, int64_t i) { return s[i < 0 ? i + int64_t(s.size()) : i]; }
+inline char py_at(std::string const& s, int64_t i) { return s[i < 0 ? i + int64_t(s.size()) : i]; }
+
+template <class T> std::vector<T> py_concat(std::vector<T> const& a, std::vector<T> const& b) {
+    std::vector<T> r;
+    r.reserve(a.size() + b.size());
+    r.insert(r.end(), a.begin(), a.end());
+    r.insert(r.end(), b.begin(), b.end());
+    return r;
+}
+template <class T> void py_extend(std::vector<T>& a, std::vector<T> const& b) {
+    // b may be a
+    size_t n = b.size();
+    a.reserve(a.size() + n);
+    for (size_t i = 0; i < n; ++i) {
+        a.push_back(b[i]);
+    }
+}
+inline std::string py_repeat(std::string const& s, int64_t n) {
+    std::string r;
+    if (n > 0) {
+        r.reserve(s.size() * n);
+        while (n-- > 0) {
+            r += s;
+        }
+    }
+    return r;
+}
+template <class T> std::vector<T> py_repeat(std::vector<T> const& v, int64_t n) {
+    std::vector<T> r;
+    if (n > 0) {
+        r.reserve(v.size() * n);
+        while (n-- > 0) {
+            r.insert(r.end(), v.begin(), v.end());
+        }
+    }
+    return r;
+}
+
+"""
+
+
+def convert_cxx(filename, include_runtime=False):
+    """
+    C++ code of Python file, with runtime inlined or included from RUNTIME_HEADER
+    """
     with open(filename) as f:
         code = f.read()
     ast_tree = ast.parse(code)
 
-    test_vis().visit(ast_tree)
+    vis = test_vis(include_runtime)
+    vis.visit(ast_tree)
+    return vis.code()
+
+
+def module_output(filename, out_dir=None):
+    """
+    Path of .cc file of module: next to Python file, or in out_dir
+    """
+    name = os.path.splitext(filename)[0] + '.cc'
+    if out_dir is None:
+        return name
+    return os.path.join(out_dir, os.path.basename(name))
+
+
+def check_outputs(files, out_dir=None):
+    """
+    Exit if two files have same output, create out_dir
+    """
+    outputs = {}
+    for filename in files:
+        output = module_output(filename, out_dir)
+        if output in outputs:
+            sys.exit(f'{filename}: same output {output} as {outputs[output]}')
+        outputs[output] = filename
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+
+
+def translate_file(filename, out_dir=None):
+    """
+    Process pool worker: translate Python file and write its .cc file at once
+    """
+    try:
+        code = convert_cxx(filename)
+    except (SyntaxError, ValueError, UnicodeDecodeError, RecursionError, AttributeError) as e:
+        # AttributeError: construct not supported by translator
+        return filename, None, f'{type(e).__name__}: {e}'
+    output = module_output(filename, out_dir)
+    with open(output, 'w') as f:
+        f.write(code)
+    return filename, output, None
+
+
+def translate_files(files, out_dir=None, jobs=None):
+    """
+    Translate files in process pool, one .cc file per module.
+    Returns dict: file name -> error of files not translated.
+    """
+    worker = partial(translate_file, out_dir=out_dir)
+    if jobs == 1 or len(files) < 2:
+        results = map(worker, files)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(jobs)
+        results = executor.map(worker, files, chunksize=max(1, len(files) // (8 * (jobs or os.cpu_count() or 1))))
+    errors = {}
+    for filename, output, error in results:
+        if error is not None:
+            print(f'{filename}: {error}', file=sys.stderr)
+            errors[filename] = error
+    if executor is not None:
+        executor.shutdown()
+    return errors
+
+
+def _cxx_string(s):
+    """
+    C++ string literal
+    """
+    out = []
+    for c in s:
+        if c in '"\\':
+            out.append('\\' + c)
+        elif c == '\n':
+            out.append('\\n')
+        elif ord(c) < 0x20:
+            out.append(f'\\{ord(c):03o}')
+        else:
+            out.append(c)
+    return '"' + ''.join(out) + '"'
+
+
+def coerce(code, t, to):
+    """
+    C++ expression of value of type t converted to C++ type to
+    """
+    if t == NONE:
+        if code == 'any(nullptr)':
+            return code
+        # value of call of function without return value
+        return f'({code}, any(nullptr))'
+    if to == ANY:
+        if t in SCALARS:
+            # explicit: int literals are ambiguous and char pointers are void* in any
+            return f'any({t}({code}))'
+        if is_list(t):
+            return f'py_any({code})'
+        return code
+    if cxx_type(t) == to:
+        return code
+    if cxx_type(t) == ANY and to in SCALARS:
+        return f'std::get<{to}>({code})'
+    raise ValueError(f'{cxx_type(t)} value {code} where {to} is expected')
+
+
+def _constant_int(node):
+    """
+    Value of integer literal, maybe negative, or None
+    """
+    sign = 1
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        sign = -1
+        node = node.operand
+    if isinstance(node, ast.Constant) and constant_type(node.value) == INT:
+        return sign * node.value
+    return None
+
+
+def _stores(body, name):
+    """
+    Name is bound in statements
+    """
+    for stmt in body:
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name) and node.id == name and isinstance(node.ctx, ast.Store):
+                return True
+    return False
+
+
+BINOPS = {
+    ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/', ast.FloorDiv: '//', ast.Mod: '%', ast.Pow: '**',
+    ast.LShift: '<<', ast.RShift: '>>', ast.BitOr: '|', ast.BitXor: '^', ast.BitAnd: '&',
+}
+
+# operators with same meaning in C++, for numbers of same type
+NATIVE_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.LShift, ast.RShift, ast.BitOr, ast.BitXor, ast.BitAnd)
+
+CMPOPS = {ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
 
 
 class test_vis(ast.NodeVisitor):
-    def __init__(self):
+    def __init__(self, include_runtime=False):
+        self.include_runtime = include_runtime
         self.level = 0
         self.main_body = []
+        # lines of output, joined once by code()
+        self.out = []
+        self.types = None
+        # function_type of function being translated, None in module body
+        self.function = None
+        # number of loops, for names of loop counters
+        self.loops = 0
+        # loop variables known to be non-negative in loops being translated
+        self.nonneg = set()
+
+    def emit(self, s):
+        self.out.append(s)
+
+    def code(self):
+        return '\n'.join(self.out) + '\n'
 
     def _tab(self):
         return '  ' * self.level;
 
-    header = """/**************************************************
-* This program was generated from Python code
-*
-**************************************************/
+    def _statement(self, s):
+        if self.function is None:
+            self.main_body.append(self._tab() + s)
+        else:
+            self.emit(self._tab() + s)
 
-#include <variant>
-#include <iostream>
-#include <string>
+    def _block(self, body):
+        self.level += 1
+        for stmt in body:
+            self.visit(stmt)
+        self.level -= 1
 
-using any = std::variant<int64_t, std::string, void*>;
+    def _signature(self, f):
+        args = ', '.join(f'{t} {name}' for t, name in zip(f.param_decls(), f.params))
+        return f'{f.ret_type()} {f.name}({args})'
 
-std::ostream& operator<< (std::ostream& os, any const& v) {
-    std::visit([&os](auto const& e){ os << e; }, v);
-    return os;
-}
+    def _type(self, node):
+        return self.types.expr_type(node, self.function)
 
-"""
+    def generic_visit(self, node):
+        raise ValueError(f'{type(node).__name__} at line {node.lineno} is not supported')
 
     def visit_Module(self, node):
-        print(test_vis.header)
-        self.generic_visit(node)
-        print('int main()\n{')
+        self.types = types(node)
+        if self.include_runtime:
+            self.emit(BANNER + f'#include "{RUNTIME_HEADER}"\n')
+        else:
+            self.emit(BANNER + RUNTIME)
+        # module variables read by functions are global, others are local to main()
+        for name, t in self.types.globals.items():
+            if name in self.types.shared:
+                self.emit(f'static {cxx_type(t)} {name}{{}};')
+        # functions may be called before their definitions
+        for f in self.types.functions.values():
+            self.emit(self._signature(f) + ';')
+        self.emit('')
+        for stmt in node.body:
+            self.visit(stmt)
+        self.emit('int main()\n{')
+        self.emit('  std::ios::sync_with_stdio(false);')
+        for name, t in self.types.globals.items():
+            if name not in self.types.shared:
+                self.emit(f'  {cxx_type(t)} {name}{{}};')
         for s in self.main_body:
-            print('  ' + s)
-        print('  return 0;\n}\n')
+            self.emit('  ' + s)
+        self.emit('  return 0;\n}\n')
 
     def visit_FunctionDef(self, node):
-        args = ', '.join(['any ' + arg.arg for arg in node.args.args])
-        print(self._tab() + f'void {node.name}({args})\n' + '{')
+        if self.function is not None:
+            raise ValueError(f'nested function {node.name} at line {node.lineno} is not supported')
+        f = self.function = self.types.functions[node.name]
+        self.emit(self._signature(f) + '\n' + '{')
         self.level += 1
-        self.generic_visit(node)
+        for name, t in f.names.items():
+            if name not in f.params:
+                self.emit(self._tab() + f'{cxx_type(t)} {name}{{}};')
+        for stmt in node.body:
+            self.visit(stmt)
+        if f.falls_off and f.ret_type() != 'void':
+            self.emit(self._tab() + 'return any(nullptr);')
         self.level -= 1
-        print(self._tab() + '}\n')
+        self.emit('}\n')
+        self.function = None
 
-    def visit_Call(self, node):
-        if node.func.id == 'print':
-            s = self._call_print(node.args)
+    def visit_Pass(self, node):
+        pass
+
+    def visit_Break(self, node):
+        self._statement('break;')
+
+    def visit_Continue(self, node):
+        self._statement('continue;')
+
+    def visit_Expr(self, node):
+        if isinstance(node.value, ast.Constant):
+            # docstring
+            return
+        code, t = self.expr(node.value)
+        self._statement(code + ';')
+
+    def _target(self, node):
+        """
+        C++ lvalue and type of assignment target
+        """
+        if isinstance(node, ast.Name):
+            return node.id, self.types.name_type(node.id, self.function)
+        if isinstance(node, ast.Subscript):
+            return self._subscript(node)
+        raise ValueError(f'assignment to {type(node).__name__} at line {node.lineno} is not supported')
+
+    def visit_Assign(self, node):
+        if isinstance(node.value, ast.Name) and is_list(self._type(node.value)):
+            raise ValueError(f'list {node.value.id} at line {node.lineno} would be copied, not shared')
+        first = None
+        for target in node.targets:
+            code, t = self._target(target)
+            if first is None:
+                value = self.value(node.value, t)
+                first = code, t
+            else:
+                # next targets are assigned from first one
+                value = coerce(first[0], first[1], cxx_type(t))
+            self._statement(f'{code} = {value};')
+
+    def visit_AugAssign(self, node):
+        code, t = self._target(node.target)
+        vt = self._type(node.value)
+        if (isinstance(node.op, NATIVE_BINOPS) and t in (INT, FLOAT) and vt in NUMBERS
+                and binop_type(node.op, t, vt) == t):
+            self._statement(f'{code} {BINOPS[type(node.op)]}= {self.expr(node.value)[0]};')
+        elif isinstance(node.op, ast.Add) and t == STR and vt == STR:
+            self._statement(f'{code} += {self.expr(node.value)[0]};')
+        elif isinstance(node.op, ast.Add) and is_list(t) and is_list(vt):
+            self._statement(f'py_extend({code}, {self.value(node.value, t)});')
         else:
-            s = self._tab() + f'{node.func.id}({self._call_args(node.args)});'
+            value, rt = self._binop(node.op, node.target, node.value, t)
+            self._statement(f'{code} = {coerce(value, rt, cxx_type(t))};')
 
-        if self.level == 0:
-            self.main_body.append(s)
+    def visit_Return(self, node):
+        if self.function is None:
+            raise ValueError(f'return outside function at line {node.lineno}')
+        if self.function.ret_type() == 'void':
+            if node.value is not None:
+                self._statement(self.expr(node.value)[0] + ';')
+            self._statement('return;')
+            return
+        if node.value is None:
+            self._statement('return any(nullptr);')
         else:
-            print(s)
+            self._statement(f'return {self.value(node.value, self.function.ret)};')
 
-    def _call_args(self, args):
-        a = []
-        for arg in args:
-            if isinstance(arg, ast.Name):
-                a.append(arg.id)
-            if isinstance(arg, ast.Str):
-                s = arg.s
-                s.replace('"', '\\"')
-                a.append(f'"{s}"')
-                #a.append(f'std::string("{s}")')
-            if isinstance(arg, ast.Num):
-                a.append(f'{arg.n}')
-        return ', '.join(a)
+    def visit_If(self, node, keyword='if'):
+        self._statement(f'{keyword} ({self._test(node.test)}) {{')
+        self._block(node.body)
+        if len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
+            self.visit_If(node.orelse[0], '} else if')
+            return
+        if node.orelse:
+            self._statement('} else {')
+            self._block(node.orelse)
+        self._statement('}')
+
+    def visit_While(self, node):
+        if node.orelse:
+            raise ValueError(f'while else at line {node.lineno} is not supported')
+        self._statement(f'while ({self._test(node.test)}) {{')
+        self._block(node.body)
+        self._statement('}')
+
+    def visit_For(self, node):
+        if node.orelse:
+            raise ValueError(f'for else at line {node.lineno} is not supported')
+        if not isinstance(node.target, ast.Name):
+            raise ValueError(f'for target {type(node.target).__name__} at line {node.lineno} is not supported')
+        name = node.target.id
+        t = self.types.name_type(name, self.function)
+        self.loops += 1
+        nonneg = False
+        if is_range(node.iter) and 'range' not in self.types.functions:
+            args = node.iter.args
+            for arg in args:
+                if self._type(arg) not in (BOOL, INT):
+                    raise ValueError(f'range of {cxx_type(self._type(arg))} at line {node.lineno} is not supported')
+            start, stop = ('0', self.expr(args[0])[0]) if len(args) == 1 else (self.expr(args[0])[0], self.expr(args[1])[0])
+            step = _constant_int(args[2]) if len(args) == 3 else 1
+            if not step:
+                raise ValueError(f'range step at line {node.lineno} is not non-zero integer literal')
+            i = f'_i{self.loops}'
+            end = f'_stop{self.loops}'
+            if len(args) == 1 or all(isinstance(arg, (ast.Name, ast.Constant)) for arg in args[:2]):
+                self._reserve(node.body, f'py_range_len({start}, {stop}, {step})')
+            cmp = '<' if step > 0 else '>'
+            inc = f'++{i}' if step == 1 else f'{i} += {step}'
+            self._statement(f'for (int64_t {i} = {start}, {end} = {stop}; {i} {cmp} {end}; {inc}) {{')
+            item = coerce(i, INT, cxx_type(t))
+            # index without check of negative value
+            first = _constant_int(args[0]) if len(args) > 1 else 0
+            nonneg = step > 0 and first is not None and first >= 0 and not _stores(node.body, name)
+        else:
+            code, it = self.expr(node.iter)
+            if is_list(it):
+                if isinstance(node.iter, ast.Name) and self._appends(node.body).get(node.iter.id):
+                    raise ValueError(f'list {node.iter.id} changed while iterated at line {node.lineno}')
+                self._statement(f'for (auto const& _x{self.loops} : {code}) {{')
+                item = coerce(f'_x{self.loops}', it[1], cxx_type(t))
+            elif it == STR:
+                if code.startswith('"'):
+                    code = f'std::string({code})'
+                self._statement(f'for (char _c{self.loops} : {code}) {{')
+                item = coerce(f'std::string(1, _c{self.loops})', STR, cxx_type(t))
+            else:
+                raise ValueError(f'for over {cxx_type(it)} at line {node.lineno} is not supported')
+        self.level += 1
+        self._statement(f'{name} = {item};')
+        self.level -= 1
+        added = nonneg and name not in self.nonneg
+        if added:
+            self.nonneg.add(name)
+        self._block(node.body)
+        if added:
+            self.nonneg.discard(name)
+        self._statement('}')
+
+    def _appends(self, body):
+        """
+        Names of lists appended by statements of loop body: name -> number of appends
+        """
+        counts = {}
+        for stmt in body:
+            for node in ast.walk(stmt):
+                if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'append'
+                        and isinstance(node.func.value, ast.Name)):
+                    counts[node.func.value.id] = counts.get(node.func.value.id, 0) + 1
+        return counts
+
+    def _reserve(self, body, count):
+        # appends done in each iteration: top level statements of loop body only
+        appends = self._appends([stmt for stmt in body if isinstance(stmt, ast.Expr)])
+        for name, n in appends.items():
+            if is_list(self.types.name_type(name, self.function)):
+                total = count if n == 1 else f'{n} * {count}'
+                self._statement(f'{name}.reserve({name}.size() + {total});')
+
+    def _test(self, node):
+        # condition of if, while: without outer parentheses
+        code = self.condition(node)
+        if isinstance(node, (ast.Compare, ast.BoolOp)):
+            return code[1:-1]
+        return code
+
+    def condition(self, node):
+        """
+        C++ condition of Python expression, by truth value
+        """
+        if isinstance(node, ast.BoolOp):
+            op = ' && ' if isinstance(node.op, ast.And) else ' || '
+            return '(' + op.join(self.condition(value) for value in node.values) + ')'
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return f'!{self.condition(node.operand)}'
+        code, t = self.expr(node)
+        if t in NUMBERS:
+            return code
+        return f'py_truth({coerce(code, t, ANY) if t == NONE else code})'
+
+    def value(self, node, to):
+        """
+        C++ code of expression converted to type to, list literals are built of that type
+        """
+        if isinstance(node, ast.List) and is_list(to):
+            items = ', '.join(self.value(item, to[1]) for item in node.elts)
+            return f'{cxx_type(to)}{{{items}}}'
+        if isinstance(node, ast.BinOp) and is_list(to):
+            code, t = self._binop(node.op, node.left, node.right, to)
+            return coerce(code, t, cxx_type(to))
+        return coerce(*self.expr(node), cxx_type(to))
+
+    def _binop(self, op, left, right, to=None):
+        """
+        C++ code and type of left op right, list result of type to if it is list
+        """
+        lt = self._type(left)
+        rt = self._type(right)
+        t = binop_type(op, lt, rt)
+        if t is None or t == ANY:
+            raise ValueError(f'{type(op).__name__} of {cxx_type(lt)} and {cxx_type(rt)} at line {left.lineno}'
+                             ' is not supported')
+        if is_list(t):
+            if is_list(to):
+                t = to
+            if isinstance(op, ast.Add):
+                return f'py_concat({self.value(left, t)}, {self.value(right, t)})', t
+            seq, n = (left, right) if is_list(lt) else (right, left)
+            count = self.expr(n)[0]
+            if isinstance(seq, ast.List) and len(seq.elts) == 1:
+                # [x] * n
+                return f'{cxx_type(t)}(std::max<int64_t>({count}, 0), {self.value(seq.elts[0], t[1])})', t
+            return f'py_repeat({self.value(seq, t)}, {count})', t
+        l = self.expr(left)[0]
+        r = self.expr(right)[0]
+        if t == STR:
+            if isinstance(op, ast.Add):
+                if l.startswith('"'):
+                    l = f'std::string({l})'
+                return f'({l} + {r})', t
+            seq, count = (l, r) if lt == STR else (r, l)
+            return f'py_repeat({seq}, {count})', t
+        # int64_t or double, bool operands and int literals converted
+        if lt != t or _constant_int(left) is not None:
+            l = f'{t}({l})'
+        if rt != t or _constant_int(right) is not None:
+            r = f'{t}({r})'
+        if isinstance(op, ast.FloorDiv):
+            return f'py_floordiv({l}, {r})', t
+        if isinstance(op, ast.Mod):
+            return f'py_mod({l}, {r})', t
+        if isinstance(op, ast.Pow):
+            if t != INT:
+                return f'std::pow({l}, {r})', t
+            # int ** negative int is float in Python, exponent must be known non-negative
+            k = _constant_int(right)
+            if not ((k is not None and k >= 0) or (isinstance(right, ast.Name) and right.id in self.nonneg)):
+                raise ValueError(f'int ** int at line {left.lineno} with exponent not known to be non-negative'
+                                 ' is not supported')
+            return f'py_pow({l}, {r})', t
+        return f'({l} {BINOPS[type(op)]} {r})', t
+
+    def _compare(self, node):
+        parts = []
+        left = node.left
+        for i, (op, right) in enumerate(zip(node.ops, node.comparators)):
+            if type(op) not in CMPOPS:
+                raise ValueError(f'{type(op).__name__} at line {node.lineno} is not supported')
+            if 0 < i < len(node.ops) and not isinstance(left, (ast.Name, ast.Constant)):
+                raise ValueError(f'chained comparison at line {node.lineno} would evaluate operand twice')
+            lt = self._type(left)
+            rt = self._type(right)
+            if not ((lt in NUMBERS and rt in NUMBERS) or lt == rt == STR or
+                    (is_list(lt) and is_list(rt) and cxx_type(lt) == cxx_type(rt))):
+                raise ValueError(f'comparison of {cxx_type(lt)} and {cxx_type(rt)} at line {node.lineno}'
+                                 ' is not supported')
+            l = self.expr(left)[0]
+            r = self.expr(right)[0]
+            if lt == STR and l.startswith('"') and r.startswith('"'):
+                l = f'std::string({l})'
+            parts.append(f'{l} {CMPOPS[type(op)]} {r}')
+            left = right
+        return '(' + ' && '.join(parts) + ')'
+
+    def _subscript(self, node):
+        """
+        C++ lvalue and type of item of list or string
+        """
+        if isinstance(node.slice, ast.Slice):
+            raise ValueError(f'slice at line {node.lineno} is not supported')
+        code, t = self.expr(node.value)
+        if not (is_list(t) or t == STR):
+            raise ValueError(f'subscript of {cxx_type(t)} at line {node.lineno} is not supported')
+        if self._type(node.slice) not in (BOOL, INT):
+            raise ValueError(f'index of {cxx_type(self._type(node.slice))} at line {node.lineno} is not supported')
+        index = self.expr(node.slice)[0]
+        k = _constant_int(node.slice)
+        if (k is not None and k >= 0) or (isinstance(node.slice, ast.Name) and node.slice.id in self.nonneg):
+            item = f'{code}[{index}]'
+        else:
+            item = f'py_at({code}, {index})'
+        if t == STR:
+            return f'std::string(1, {item})', STR
+        return item, t[1]
+
+    def expr(self, node):
+        """
+        C++ code and inferred type of expression
+        """
+        if isinstance(node, ast.Constant):
+            t = constant_type(node.value)
+            if t == INT:
+                if not -2**63 <= node.value < 2**63:
+                    raise ValueError(f'integer {node.value} at line {node.lineno} is out of int64_t range')
+                return (f'{node.value}' if -2**31 <= node.value < 2**31 else f'{node.value}LL'), t
+            if t == FLOAT:
+                return (repr(node.value) if math.isfinite(node.value) else
+                        f'{"-" if node.value < 0 else ""}std::numeric_limits<double>::infinity()'), t
+            if t == STR:
+                return _cxx_string(node.value), t
+            if t == BOOL:
+                return ('true' if node.value else 'false'), t
+            if t == NONE:
+                return 'any(nullptr)', t
+            raise ValueError(f'constant {node.value!r} at line {node.lineno} is not supported')
+        if isinstance(node, ast.Name):
+            t = self.types.name_type(node.id, self.function)
+            # None is stored in any
+            return node.id, ANY if t == NONE else t
+        if isinstance(node, ast.List):
+            t = self._type(node)
+            return self.value(node, t), t
+        if isinstance(node, ast.BinOp):
+            return self._binop(node.op, node.left, node.right)
+        if isinstance(node, ast.UnaryOp):
+            t = self._type(node)
+            if isinstance(node.op, ast.Not):
+                return f'!{self.condition(node.operand)}', t
+            code, ot = self.expr(node.operand)
+            if t not in (INT, FLOAT):
+                raise ValueError(f'{type(node.op).__name__} of {cxx_type(ot)} at line {node.lineno} is not supported')
+            if ot != t:
+                code = f'{t}({code})'
+            return f'({ {ast.USub: "-", ast.UAdd: "+", ast.Invert: "~"}[type(node.op)] }{code})', t
+        if isinstance(node, ast.Compare):
+            return self._compare(node), BOOL
+        if isinstance(node, ast.BoolOp):
+            if self._type(node) != BOOL:
+                raise ValueError(f'{type(node.op).__name__} of values other than bool at line {node.lineno}'
+                                 ' is not supported')
+            return self.condition(node), BOOL
+        if isinstance(node, ast.Subscript):
+            return self._subscript(node)
+        if isinstance(node, ast.Call):
+            return self._call(node)
+        raise ValueError(f'{type(node).__name__} at line {node.lineno} is not supported')
+
+    def _call(self, node):
+        if node.keywords:
+            raise ValueError(f'call with keyword arguments at line {node.lineno} is not supported')
+        if isinstance(node.func, ast.Attribute):
+            code, t = self.expr(node.func.value)
+            if node.func.attr != 'append' or not is_list(t) or len(node.args) != 1:
+                raise ValueError(f'method {node.func.attr} of {cxx_type(t)} at line {node.lineno} is not supported')
+            return f'{code}.push_back({self.value(node.args[0], t[1])})', NONE
+        if not isinstance(node.func, ast.Name):
+            raise ValueError(f'call at line {node.lineno} is not supported')
+        if node.func.id == 'print':
+            return self._call_print(node.args), NONE
+        f = self.types.functions.get(node.func.id)
+        if f is None:
+            if node.func.id == 'len' and len(node.args) == 1:
+                code, t = self.expr(node.args[0])
+                if t == STR and code.startswith('"'):
+                    code = f'std::string({code})'
+                if t == STR or is_list(t):
+                    return f'int64_t({code}.size())', INT
+                raise ValueError(f'len of {cxx_type(t)} at line {node.lineno} is not supported')
+            # not defined in module and not supported builtin
+            raise ValueError(f'function {node.func.id} at line {node.lineno} is not supported')
+        if len(node.args) != len(f.params):
+            raise ValueError(f'{f.name} takes {len(f.params)} arguments, {len(node.args)} given at line {node.lineno}')
+        args = []
+        for arg, param, decl in zip(node.args, f.params, f.param_decls()):
+            if decl.endswith('&') and not decl.endswith('const&') and not isinstance(arg, (ast.Name, ast.Subscript)):
+                raise ValueError(f'{f.name} changes list {param}, its argument at line {node.lineno} is not a variable')
+            args.append(self.value(arg, f.names[param]))
+        return f'{f.name}({", ".join(args)})', f.ret
 
     def _call_print(self, args):
-        a = ' << " " << '.join([arg.id for arg in args])
-        return self._tab() + 'std::cout << ' + a + ' << std::endl;'
+        a = []
+        for arg in args:
+            code, t = self.expr(arg)
+            if t == FLOAT:
+                code = f'py_float({code})'
+            elif t == BOOL:
+                code = f'({code} ? "True" : "False")'
+            elif t == NONE:
+                code = coerce(code, t, ANY)
+            a.append(code)
+        items = " << ' ' << ".join(a) + ' << ' if a else ''
+        return 'std::cout << ' + items + "'\\n'"
 
 
 def main():
-    if len(sys.argv) > 1:
-        convert_cxx(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Translate Python scripts to C++.')
+    parser.add_argument('files', metavar='file.py', nargs='+',
+                        help='Python file to print as C++, or many files to translate to .cc file per module')
+    parser.add_argument('--out-dir', '-o', default=None,
+                        help='write .cc files to directory, also for one file (default: next to Python files)')
+    parser.add_argument('--write', '-w', action='store_true',
+                        help='write .cc file also for one file, instead of printing it')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    args = parser.parse_args(sys.argv[1:])
+
+    if len(args.files) == 1 and args.out_dir is None and not args.write:
+        try:
+            sys.stdout.write(convert_cxx(args.files[0]))
+        except (SyntaxError, ValueError, UnicodeDecodeError, RecursionError, AttributeError) as e:
+            sys.exit(f'{args.files[0]}: {type(e).__name__}: {e}')
         return
 
+    check_outputs(args.files, args.out_dir)
+    errors = translate_files(args.files, args.out_dir, args.jobs)
+    if len(errors) > 0:
+        sys.exit(1)
+
 if __name__ == '__main__':
     main()
@@ -1,13 +1,13 @@
 #!/bin/bash
 
-set -x
+# usage: py2cxx.sh file.py [file.py ...]
+# translate and compile all files with cached builds (see py2cxx_build.py), run each
 
-name="${1::-3}"
+set -e -x
 
-python3 py2cxx.py $1 | tee $name.cc
-
-gcc $name.cc -std=c++17 -lstdc++ -o $name
-
-./$name
+python3 "$(dirname "$0")/py2cxx_build.py" "$@"
 
+for f in "$@"; do
+    ./"${f%.py}"
+done
 
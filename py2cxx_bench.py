@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+import os, sys
+import hashlib
+import json
+import time
+import tempfile
+import threading
+import subprocess
+import shlex
+import signal
+import argparse
+from typing import List, Dict, Any
+
+import py2cxx
+from py2cxx_build import builder, binary_output, DEFAULT_CACHE_DIR, DEFAULT_CXX, DEFAULT_FLAGS
+
+# Differential benchmark of py2cxx: each program of corpus is run by CPython
+# and as binary built by py2cxx_build, stdout of both must be equal.
+# Wall time is best of repeated runs, peak RSS is maximum over runs, from
+# rusage of each child process, so it includes the interpreter.  Programs are
+# run by small launcher built once with the same compiler (LAUNCHER), rusage
+# of children of Python process starts from RSS of Python itself.
+# Speedup is CPython time / binary time, ratio of times on same machine,
+# so reports of different machines are comparable without calibration.
+
+# default corpus: programs in subset of Python translated by py2cxx
+PROGRAMS = {
+    'loops': '''def work(n):
+    s = 0
+    for i in range(n):
+        for j in range(100):
+            s += (i * j) % 7
+    return s
+
+print(work(20000))
+''',
+    'sieve': '''def sieve(n):
+    is_prime = [True] * (n + 1)
+    is_prime[0] = False
+    is_prime[1] = False
+    i = 2
+    while i * i <= n:
+        if is_prime[i]:
+            j = i * i
+            while j <= n:
+                is_prime[j] = False
+                j += i
+        i += 1
+    count = 0
+    for p in is_prime:
+        if p:
+            count += 1
+    return count
+
+print(sieve(1000000))
+''',
+    'collatz': '''def steps(n):
+    k = 0
+    while n != 1:
+        if n % 2 == 0:
+            n = n // 2
+        else:
+            n = 3 * n + 1
+        k += 1
+    return k
+
+best = 0
+arg = 0
+for n in range(1, 100000):
+    s = steps(n)
+    if s > best:
+        best = s
+        arg = n
+print(arg, best)
+''',
+    'matmul': '''def make(n, seed):
+    m = []
+    x = seed
+    for i in range(n):
+        row = []
+        for j in range(n):
+            x = (x * 1103515245 + 12345) % 2147483648
+            row.append(x / 2147483648)
+        m.append(row)
+    return m
+
+def matmul(a, b, n):
+    c = []
+    for i in range(n):
+        row = [0.0] * n
+        for k in range(n):
+            aik = a[i][k]
+            for j in range(n):
+                row[j] += aik * b[k][j]
+        c.append(row)
+    return c
+
+n = 120
+c = matmul(make(n, 1), make(n, 2), n)
+print(c[0][0], c[n - 1][n - 1])
+''',
+    'fib': '''def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+print(fib(27))
+''',
+    'strings': '''def build(n):
+    s = ""
+    words = []
+    for i in range(n):
+        if i % 15 == 0:
+            s += "fizzbuzz"
+        elif i % 3 == 0:
+            s += "fizz"
+        else:
+            s += "x"
+        if i % 10000 == 0:
+            words.append(s[-1] * 3)
+    print(len(s))
+    return words
+
+print(build(300000))
+''',
+    'mixed': '''def show(v):
+    print(v)
+
+items = [1, 2.5, "three"]
+for i in range(3):
+    show(i)
+    show("s")
+print(items, [[1, 2], [3]])
+''',
+}
+
+
+def write_corpus(path: str) -> List[str]:
+    """
+    Write default corpus to directory, returns paths of programs
+    """
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for name, source in PROGRAMS.items():
+        filename = os.path.join(path, name + '.py')
+        with open(filename, 'w') as f:
+            f.write(source)
+        files.append(filename)
+    return files
+
+
+def corpus_files(paths: List[str]) -> List[str]:
+    """
+    Python files given and *.py files of directories given
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.py')))
+        else:
+            files.append(path)
+    return files
+
+
+# Peak RSS of child includes RSS of process which forked it, which is large
+# for Python, so programs are run by this small launcher: it writes wall time
+# and peak RSS of command to file and exits with its exit code.
+LAUNCHER = r"""#include <cstdio>
+#include <ctime>
+#include <sys/resource.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+int main(int argc, char** argv) {
+    if (argc < 3) {
+        return 2;
+    }
+    timespec t0, t1;
+    clock_gettime(CLOCK_MONOTONIC, &t0);
+    pid_t pid = fork();
+    if (pid == 0) {
+        execvp(argv[2], argv + 2);
+        _exit(127);
+    }
+    int status = 0;
+    rusage usage;
+    if (pid < 0 || wait4(pid, &status, 0, &usage) < 0) {
+        return 126;
+    }
+    clock_gettime(CLOCK_MONOTONIC, &t1);
+    FILE* f = fopen(argv[1], "w");
+    if (!f) {
+        return 126;
+    }
+    fprintf(f, "%.9f %ld\n", (t1.tv_sec - t0.tv_sec) + (t1.tv_nsec - t0.tv_nsec) * 1e-9, usage.ru_maxrss);
+    fclose(f);
+    return WIFSIGNALED(status) ? 128 + WTERMSIG(status) : WEXITSTATUS(status);
+}
+"""
+
+
+def build_launcher(b: builder) -> str:
+    """
+    Path of launcher built by compiler of builder, once per compiler
+    """
+    key = hashlib.sha256((b.tag + '\0' + LAUNCHER).encode('utf-8')).hexdigest()
+    path = os.path.join(b.cache_dir, 'tools', key[:32], 'py2cxx_launcher')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            subprocess.run([b.cxx, '-O2', '-x', 'c++', '-', '-o', tmp_path], input=LAUNCHER, text=True, check=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return path
+
+
+def run_process(cmd: List[str], timeout: float = None, launcher: str = None) -> Dict[str, Any]:
+    """
+    Run command: wall time, peak RSS in KiB, exit code and output.
+    Without launcher peak RSS is at least RSS of this process.
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err, \
+            tempfile.NamedTemporaryFile('r') as stats:
+        killed = threading.Event()
+        if launcher is not None:
+            cmd = [launcher, stats.name] + cmd
+        t = time.perf_counter()
+        # own process group: launcher and command are killed together
+        p = subprocess.Popen(cmd, stdout=out, stderr=err, stdin=subprocess.DEVNULL, start_new_session=True)
+
+        def kill():
+            killed.set()
+            os.killpg(p.pid, signal.SIGKILL)
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer is not None:
+            timer.start()
+        try:
+            pid, status, usage = os.wait4(p.pid, 0)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        seconds = time.perf_counter() - t
+        max_rss = usage.ru_maxrss
+        p.returncode = os.waitstatus_to_exitcode(status)
+        if launcher is not None and not killed.is_set():
+            line = stats.read().split()
+            if len(line) != 2:
+                raise OSError(f'launcher {launcher} failed with exit code {p.returncode}')
+            seconds = float(line[0])
+            max_rss = int(line[1])
+        out.seek(0)
+        err.seek(0)
+        return {
+            'seconds': seconds,
+            'max_rss_kb': max_rss,
+            'returncode': p.returncode,
+            'timeout': killed.is_set(),
+            'stdout': out.read(),
+            'stderr': err.read().decode('utf-8', 'replace'),
+        }
+
+
+def measure(cmd: List[str], repeat: int, timeout: float = None, launcher: str = None):
+    """
+    Best time and maximal peak RSS of repeat runs, and last run, or failed run
+    """
+    best = None
+    rss = 0
+    for i in range(repeat):
+        r = run_process(cmd, timeout, launcher)
+        if r['timeout'] or r['returncode'] != 0:
+            return None, None, r
+        best = r['seconds'] if best is None else min(best, r['seconds'])
+        rss = max(rss, r['max_rss_kb'])
+    return best, rss, r
+
+
+def _error(r):
+    if r['timeout']:
+        return 'timeout'
+    return f'exit code {r["returncode"]}: {r["stderr"].strip()[-500:]}'
+
+
+def bench_program(filename: str, binary: str, repeat: int = 3, timeout: float = None,
+                  launcher: str = None) -> Dict[str, Any]:
+    result = {'program': filename}
+    python_seconds, python_rss, r = measure([sys.executable, filename], repeat, timeout, launcher)
+    if python_seconds is None:
+        result.update(status='python failed', error=_error(r))
+        return result
+    expected = r['stdout']
+    binary_seconds, binary_rss, r = measure([binary], repeat, timeout, launcher)
+    if binary_seconds is None:
+        result.update(status='timeout' if r['timeout'] else 'failed', error=_error(r))
+        return result
+    result.update(status='ok' if r['stdout'] == expected else 'mismatch',
+                  python_seconds=python_seconds, binary_seconds=binary_seconds,
+                  speedup=python_seconds / binary_seconds,
+                  python_rss_kb=python_rss, binary_rss_kb=binary_rss)
+    if r['stdout'] != expected:
+        result['error'] = f'stdout differs: {len(expected)} bytes by CPython, {len(r["stdout"])} bytes by binary'
+    return result
+
+
+def run(files: List[str], repeat: int = 3, timeout: float = None, cache_dir: str = DEFAULT_CACHE_DIR,
+        cxx: str = DEFAULT_CXX, flags: str = DEFAULT_FLAGS, jobs: int = None, verbose: bool = False) -> Dict[str, Any]:
+    """
+    Benchmark report of each program of corpus
+    """
+    report = {
+        'python': sys.version.split()[0],
+        'cxx': cxx,
+        'flags': flags,
+        'params': {'repeat': repeat, 'timeout': timeout},
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory() as out_dir:
+        py2cxx.check_outputs(files, out_dir)
+        b = builder(cache_dir, cxx, shlex.split(flags))
+        errors = b.build_files(files, out_dir, jobs)
+        launcher = build_launcher(b)
+        for filename in files:
+            if filename in errors:
+                result = {'program': filename, 'status': 'build failed', 'error': errors[filename][-500:]}
+            else:
+                result = bench_program(filename, binary_output(filename, out_dir), repeat, timeout, launcher)
+            report['results'].append(result)
+            if verbose:
+                print(format_row(result), file=sys.stderr)
+    return report
+
+
+TABLE_HEADER = f'{"program":24} {"status":12} {"python s":>10} {"binary s":>10} {"speedup":>8} ' \
+               f'{"python KiB":>11} {"binary KiB":>11}'
+
+
+def format_row(r: Dict[str, Any]) -> str:
+    name = os.path.basename(r['program'])
+    if 'speedup' not in r:
+        return f'{name:24} {r["status"]:12} {r.get("error", "").splitlines()[0] if r.get("error") else ""}'
+    return f'{name:24} {r["status"]:12} {r["python_seconds"]:10.4f} {r["binary_seconds"]:10.4f} ' \
+           f'{r["speedup"]:8.1f} {r["python_rss_kb"]:11} {r["binary_rss_kb"]:11}'
+
+
+def format_table(report: Dict[str, Any]) -> str:
+    return '\n'.join([TABLE_HEADER] + [format_row(r) for r in report['results']])
+
+
+def check_report(report: Dict[str, Any], baseline: Dict[str, Any] = None, threshold: float = 0.25,
+                 min_speedup: float = None) -> List[str]:
+    """
+    Failures of gate: programs not built, failed or with different output,
+    programs slower than min_speedup, and against baseline: programs which
+    were ok and are not, and programs with speedup lower by more than threshold
+    """
+    failures = []
+    for r in report['results']:
+        name = r['program']
+        if r['status'] != 'ok':
+            failures.append(f'{name}: {r["status"]}' + (f': {r["error"]}' if r.get('error') else ''))
+        elif min_speedup is not None and r['speedup'] < min_speedup:
+            failures.append(f'{name}: speedup {r["speedup"]:.2f}, expected at least {min_speedup}')
+    if baseline is None:
+        return failures
+    base = {r['program']: r for r in baseline['results']}
+    for r in report['results']:
+        b = base.get(r['program'])
+        if b is None or b['status'] != 'ok' or r['status'] != 'ok':
+            continue
+        if r['speedup'] < b['speedup'] * (1 - threshold):
+            failures.append(f'{r["program"]}: speedup {r["speedup"]:.2f}, baseline {b["speedup"]:.2f}')
+    return failures
+
+
+def test_bench():
+    r = run_process([sys.executable, '-c', 'print("x" * 3)'])
+    assert r['returncode'] == 0 and r['stdout'] == b'xxx\n' and r['max_rss_kb'] > 0, r
+    r = run_process([sys.executable, '-c', 'import time; time.sleep(10)'], timeout=0.2)
+    assert r['timeout'] and r['seconds'] < 5, r
+
+    def result(program, status='ok', speedup=10.0):
+        return {'program': program, 'status': status, 'speedup': speedup}
+
+    baseline = {'results': [result('a'), result('b'), result('c', 'build failed'), result('d')]}
+    report = {'results': [result('a', speedup=9.0), result('b', speedup=5.0), result('c'), result('d', 'mismatch')]}
+    failures = check_report(report, baseline)
+    assert [f.split(':')[0] for f in failures] == ['d', 'b'], failures
+    assert len(check_report(report, min_speedup=6)) == 2
+
+
+def main():
+    test_bench()
+
+    parser = argparse.ArgumentParser(description='Run Python programs by CPython and as py2cxx binaries, '
+                                                 'compare output, time and memory.')
+    parser.add_argument('paths', metavar='file.py', nargs='*',
+                        help='Python programs or directories of them (default: built-in corpus)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each program, best time is reported (default: 3)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds per run (default: 60)')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of parallel compilations (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=os.environ.get('PY2CXX_CACHE_DIR', DEFAULT_CACHE_DIR),
+                        help=f'build cache directory (default: $PY2CXX_CACHE_DIR or {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cxx', default=os.environ.get('CXX', DEFAULT_CXX),
+                        help=f'C++ compiler (default: $CXX or {DEFAULT_CXX})')
+    parser.add_argument('--flags', default=DEFAULT_FLAGS,
+                        help=f'compiler flags (default: {DEFAULT_FLAGS})')
+    parser.add_argument('--output', '-o', default=None,
+                        help='write JSON report to file instead of stdout')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON report of previous run, programs which regressed fail the run')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative drop of speedup against baseline (default: 0.25)')
+    parser.add_argument('--min-speedup', type=float, default=None,
+                        help='fail the run if some program is sped up less')
+    parser.add_argument('--write-corpus', metavar='DIR', default=None,
+                        help='only write built-in corpus to DIR')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='print results to stderr as they are measured')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.write_corpus:
+        write_corpus(args.write_corpus)
+        exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = corpus_files(args.paths) if args.paths else write_corpus(tmp)
+        report = run(files, args.repeat, args.timeout, args.cache_dir, args.cxx, args.flags, args.jobs, args.verbose)
+    if not args.paths:
+        # temporary paths of built-in corpus
+        for r in report['results']:
+            r['program'] = os.path.basename(r['program'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+    print(format_table(report), file=sys.stderr)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    failures = check_report(report, baseline, args.threshold, args.min_speedup)
+    for line in failures:
+        print(f'failure: {line}', file=sys.stderr)
+    if failures:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
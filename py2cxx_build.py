@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import os, sys
+import hashlib
+import subprocess
+import tempfile
+import shutil
+import shlex
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import py2cxx
+import py2cxx_types
+from py2cxx_types import test_types
+from ast_cache import parse_cache, converter_tag, DEFAULT_MAX_SIZE
+
+# Build driver of py2cxx: Python file -> .cc file -> binary.
+#
+# Generated code and binary are cached together in content-addressed cache
+# (ast_cache.parse_cache), key is hash of Python source, translator sources,
+# compiler version and flags.  On hit both translation and compilation are
+# skipped, .cc file and binary are written from cache entry.
+# Runtime of generated programs is written as header to cache directory and
+# precompiled once per runtime, compiler and flags, generated programs
+# include it instead of inlining it.
+# Misses are translated and compiled in thread pool: threads wait for their
+# compiler processes, translation itself is short.
+
+DEFAULT_CACHE_DIR = '.py2cxx-cache'
+DEFAULT_CXX = 'g++'
+DEFAULT_FLAGS = '-std=c++17 -O3'
+
+RUNTIME_GUARD = 'PY2CXX_RUNTIME_H'
+
+
+def binary_output(filename, out_dir=None):
+    """
+    Path of binary of module: .cc file path without extension
+    """
+    return os.path.splitext(py2cxx.module_output(filename, out_dir))[0]
+
+
+def _write_binary(path, data):
+    # replace, not overwrite: binary may be running
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o755)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class builder:
+    def __init__(self, cache_dir, cxx=DEFAULT_CXX, flags=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.cxx = cxx
+        self.flags = shlex.split(DEFAULT_FLAGS) if flags is None else flags
+        version = subprocess.run([cxx, '--version'], capture_output=True, text=True, check=True).stdout
+        self.tag = '\0'.join([converter_tag(py2cxx.__file__), converter_tag(py2cxx_types.__file__),
+                              version, shlex.join(self.flags)])
+        self.cache = parse_cache(os.path.join(cache_dir, 'entries'), self.tag, max_size)
+        self.pch_dir = None
+
+    def precompile(self):
+        """
+        Directory with runtime header and its precompiled header, built once
+        """
+        if self.pch_dir is not None:
+            return self.pch_dir
+        key = hashlib.sha256((self.tag + '\0' + py2cxx.RUNTIME).encode('utf-8')).hexdigest()
+        pch_dir = os.path.join(self.cache_dir, 'pch', key[:32])
+        header = os.path.join(pch_dir, py2cxx.RUNTIME_HEADER)
+        if not (os.path.exists(header) and os.path.exists(header + '.gch')):
+            os.makedirs(os.path.dirname(pch_dir), exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(pch_dir))
+            try:
+                tmp_header = os.path.join(tmp_dir, py2cxx.RUNTIME_HEADER)
+                with open(tmp_header, 'w') as f:
+                    f.write(f'#ifndef {RUNTIME_GUARD}\n#define {RUNTIME_GUARD}\n\n{py2cxx.RUNTIME}#endif\n')
+                subprocess.run([self.cxx, *self.flags, '-x', 'c++-header', tmp_header, '-o', tmp_header + '.gch'],
+                               check=True)
+                try:
+                    os.rename(tmp_dir, pch_dir)
+                except OSError:
+                    # built by other process meanwhile
+                    pass
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.pch_dir = pch_dir
+        return pch_dir
+
+    def build_file(self, filename, out_dir=None):
+        """
+        Thread pool worker: .cc file and binary of Python file, from cache or built.
+        Returns (filename, cached, error).
+        """
+        output = py2cxx.module_output(filename, out_dir)
+        binary = binary_output(filename, out_dir)
+        try:
+            with open(filename, 'rb') as f:
+                key = self.cache.key(f.read())
+        except OSError as e:
+            return filename, False, str(e)
+        entry = self.cache.get(key)
+        if entry is not None:
+            with open(output, 'w') as f:
+                f.write(entry['cc'])
+            _write_binary(binary, entry['binary'])
+            return filename, True, None
+
+        try:
+            code = py2cxx.convert_cxx(filename, include_runtime=True)
+        except (SyntaxError, ValueError, UnicodeDecodeError, RecursionError, AttributeError) as e:
+            return filename, False, f'{type(e).__name__}: {e}'
+        with open(output, 'w') as f:
+            f.write(code)
+        p = subprocess.run([self.cxx, *self.flags, '-Winvalid-pch', '-I', self.precompile(), output, '-o', binary],
+                           capture_output=True, text=True)
+        if p.returncode != 0:
+            return filename, False, p.stderr.strip()
+        with open(binary, 'rb') as f:
+            self.cache.put(key, {'cc': code, 'binary': f.read()})
+        return filename, False, None
+
+    def build_files(self, files, out_dir=None, jobs=None):
+        """
+        Build files in thread pool.
+        Returns dict: file name -> error of files not built.
+        """
+        self.precompile()
+        worker = partial(self.build_file, out_dir=out_dir)
+        with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as executor:
+            results = list(executor.map(worker, files))
+        errors = {}
+        cached = 0
+        for filename, hit, error in results:
+            if error is not None:
+                print(f'{filename}: {error}', file=sys.stderr)
+                errors[filename] = error
+            cached += hit
+        print(f'py2cxx: {len(files) - cached - len(errors)} built, {cached} cached, {len(errors)} failed',
+              file=sys.stderr)
+        return errors
+
+
+TEST_PROGRAM = """def f(a):
+    print(a)
+
+def fill(v, n):
+    for i in range(n):
+        v.append(i * 0.5)
+    return v[n - 1]
+
+v = []
+f("hello")
+f(1.0)
+print(fill(v, 5), v, -7 // 2, -7 % 3, len("it's"))
+s = 0
+for x in [3, 1, 2]:
+    while s < 100:
+        s = s * 2 + x
+print(s, s > 99 and s != 0, [["a"], ["it's"]])
+for k in range(4):
+    print(3 ** k, 2 ** 10, 2.0 ** -1, 2 ** -1.0)
+"""
+
+
+def test_build():
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'hello.py')
+        with open(src, 'w') as f:
+            f.write(TEST_PROGRAM)
+        b = builder(os.path.join(tmp, 'cache'))
+        assert b.build_files([src]) == {}
+        assert b.build_file(src) == (src, True, None)
+        os.unlink(binary_output(src))
+        assert b.build_file(src) == (src, True, None)
+        out = subprocess.run([binary_output(src)], capture_output=True, text=True, check=True).stdout
+        expected = subprocess.run([sys.executable, src], capture_output=True, text=True, check=True).stdout
+        assert out == expected, (out, expected)
+        # changed source is a miss
+        with open(src, 'a') as f:
+            f.write('f(1)\n')
+        assert b.build_file(src) == (src, False, None)
+        # int ** negative int is float in Python, not translated
+        with open(src, 'a') as f:
+            f.write('print(2 ** -1)\n')
+        name, hit, error = b.build_file(src)
+        assert error is not None and error.startswith('ValueError: int ** int'), error
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Translate Python scripts to C++ and compile them, with cache.')
+    parser.add_argument('files', metavar='file.py', nargs='*',
+                        help='Python files to build, binary of module is written next to its .cc file')
+    parser.add_argument('--out-dir', '-o', default=None,
+                        help='write .cc files and binaries to directory (default: next to Python files)')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of parallel compilations (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=os.environ.get('PY2CXX_CACHE_DIR', DEFAULT_CACHE_DIR),
+                        help=f'cache directory (default: $PY2CXX_CACHE_DIR or {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cxx', default=os.environ.get('CXX', DEFAULT_CXX),
+                        help=f'C++ compiler (default: $CXX or {DEFAULT_CXX})')
+    parser.add_argument('--flags', default=DEFAULT_FLAGS,
+                        help=f'compiler flags, also part of cache key (default: {DEFAULT_FLAGS})')
+    parser.add_argument('--test', action='store_true',
+                        help='build test program in temporary directory first')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.test:
+        test_types()
+        test_build()
+    if len(args.files) == 0:
+        return
+    py2cxx.check_outputs(args.files, args.out_dir)
+    b = builder(args.cache_dir, args.cxx, shlex.split(args.flags))
+    errors = b.build_files(args.files, args.out_dir, args.jobs)
+    if len(errors) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
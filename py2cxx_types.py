@@ -0,0 +1,373 @@
+import ast
+
+# Local type inference of py2cxx.
+#
+# Types are names of C++ types: bool, int64_t, double, std::string, 'None'
+# for value of call of function without return value, ('list', element type)
+# for std::vector, and any (std::variant of all of them, lists are shared)
+# when more than one type is possible.  Unknown type (None) is below each
+# type, any is above all, lists are joined by their element types.
+# Inference is flow-insensitive: each variable has one type in its scope,
+# join of types of all values assigned to it; each parameter has join of
+# types of arguments at all call sites of its function; function has join
+# of types of returned values.  Passes over module are repeated until no
+# type changes, each type may change at most twice per level of nesting.
+
+BOOL = 'bool'
+INT = 'int64_t'
+FLOAT = 'double'
+STR = 'std::string'
+NONE = 'None'
+ANY = 'any'
+
+NUMBERS = (BOOL, INT, FLOAT)
+SCALARS = (BOOL, INT, FLOAT, STR)
+
+
+def is_list(t):
+    return isinstance(t, tuple)
+
+
+def list_of(t):
+    return ('list', t)
+
+
+def join(a, b):
+    """
+    Least type of both
+    """
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if is_list(a) and is_list(b):
+        return list_of(join(a[1], b[1]))
+    return ANY
+
+
+def cxx_type(t):
+    """
+    C++ type of variable of type t: unknown and None values are stored in any
+    """
+    if t in SCALARS:
+        return t
+    if is_list(t):
+        return f'std::vector<{cxx_type(t[1])}>'
+    return ANY
+
+
+def binop_type(op, l, r):
+    """
+    Type of result of l op r, any if it is not computed natively
+    """
+    if l is None or r is None:
+        return None
+    if l in NUMBERS and r in NUMBERS:
+        if isinstance(op, ast.Div):
+            return FLOAT
+        if FLOAT in (l, r):
+            return ANY if isinstance(op, (ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift)) else FLOAT
+        # int ** int is int for non-negative exponents only, py2cxx rejects other exponents
+        return INT
+    if isinstance(op, ast.Add) and (l == r == STR or (is_list(l) and is_list(r))):
+        return join(l, r)
+    if isinstance(op, ast.Mult):
+        if (l == STR or is_list(l)) and r in (BOOL, INT):
+            return l
+        if (r == STR or is_list(r)) and l in (BOOL, INT):
+            return r
+    return ANY
+
+
+def unaryop_type(op, t):
+    if t is None:
+        return None
+    if isinstance(op, ast.Not):
+        return BOOL
+    if t in NUMBERS and not (isinstance(op, ast.Invert) and t == FLOAT):
+        return FLOAT if t == FLOAT else INT
+    return ANY
+
+
+def element_type(t):
+    """
+    Type of items of sequence of type t
+    """
+    if t is None:
+        return None
+    if is_list(t):
+        return t[1]
+    if t == STR:
+        return STR
+    return ANY
+
+
+def is_range(node):
+    """
+    Call of range() with one to three positional arguments
+    """
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'range'
+            and 1 <= len(node.args) <= 3 and not node.keywords)
+
+
+def constant_type(value):
+    if isinstance(value, bool):
+        return BOOL
+    if isinstance(value, int):
+        return INT
+    if isinstance(value, float):
+        return FLOAT
+    if isinstance(value, str):
+        return STR
+    if value is None:
+        return NONE
+    return None
+
+
+def _stored_names(nodes, names):
+    for stmt in nodes:
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                names.setdefault(node.id, None)
+
+
+class function_type:
+    def __init__(self, node):
+        self.node = node
+        self.name = node.name
+        self.params = [arg.arg for arg in node.args.args]
+        # name -> type of parameters and local variables
+        self.names = dict.fromkeys(self.params)
+        _stored_names(node.body, self.names)
+        self.ret = None
+        # last statement is not return: None is returned
+        self.falls_off = len(node.body) == 0 or not isinstance(node.body[-1], ast.Return)
+        # names bound again, and names of lists changed in place
+        self.rebound = set()
+        self.mutated = set()
+        for n in ast.walk(node):
+            if isinstance(n, (ast.Assign, ast.For)):
+                targets = n.targets if isinstance(n, ast.Assign) else [n.target]
+                for target in targets:
+                    if isinstance(target, ast.Name):
+                        self.rebound.add(target.id)
+                    elif isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name):
+                        self.mutated.add(target.value.id)
+            elif isinstance(n, ast.AugAssign):
+                # list += is in place
+                target = n.target.value if isinstance(n.target, ast.Subscript) else n.target
+                if isinstance(target, ast.Name):
+                    self.mutated.add(target.id)
+            elif isinstance(n, ast.Call) and isinstance(n.func, ast.Attribute) and isinstance(n.func.value, ast.Name):
+                self.mutated.add(n.func.value.id)
+
+    def param_types(self):
+        return [cxx_type(self.names[p]) for p in self.params]
+
+    def param_decls(self):
+        """
+        C++ types of parameters: strings and lists by reference unless bound again,
+        lists changed in place by non-const reference, so caller sees changes
+        """
+        decls = []
+        for p in self.params:
+            t = cxx_type(self.names[p])
+            if p in self.rebound or not (t == STR or is_list(self.names[p])):
+                decls.append(t)
+            elif p in self.mutated and is_list(self.names[p]):
+                decls.append(t + '&')
+            else:
+                decls.append(t + ' const&')
+        return decls
+
+    def ret_type(self):
+        """
+        C++ return type, void if function returns nothing but None
+        """
+        if self.ret == NONE:
+            return 'void'
+        return cxx_type(self.ret)
+
+
+class types:
+    """
+    Types of functions, module variables and local variables of module tree
+    """
+
+    def __init__(self, module):
+        # name -> function_type
+        self.functions = {}
+        # name -> type of module variables
+        self.globals = {}
+        self.module_body = []
+        for stmt in module.body:
+            if isinstance(stmt, ast.FunctionDef):
+                if stmt.name in self.functions:
+                    raise ValueError(f'function {stmt.name} redefined at line {stmt.lineno}')
+                self.functions[stmt.name] = function_type(stmt)
+            else:
+                self.module_body.append(stmt)
+        _stored_names(self.module_body, self.globals)
+        # module variables read by functions, others may be local to main()
+        self.shared = set()
+        for f in self.functions.values():
+            for node in ast.walk(f.node):
+                if isinstance(node, ast.Name) and node.id not in f.names and node.id in self.globals:
+                    self.shared.add(node.id)
+        self._solve()
+
+    def _scope(self, name, function):
+        if function is not None and name in function.names:
+            return function.names
+        return self.globals
+
+    def name_type(self, name, function=None):
+        return self._scope(name, function).get(name)
+
+    def expr_type(self, node, function=None):
+        if isinstance(node, ast.Constant):
+            return constant_type(node.value)
+        if isinstance(node, ast.Name):
+            return self.name_type(node.id, function)
+        if isinstance(node, ast.List):
+            t = None
+            for item in node.elts:
+                t = join(t, self.expr_type(item, function))
+            return list_of(t)
+        if isinstance(node, ast.BinOp):
+            return binop_type(node.op, self.expr_type(node.left, function), self.expr_type(node.right, function))
+        if isinstance(node, ast.UnaryOp):
+            return unaryop_type(node.op, self.expr_type(node.operand, function))
+        if isinstance(node, ast.Compare):
+            return BOOL
+        if isinstance(node, ast.BoolOp):
+            t = None
+            for value in node.values:
+                t = join(t, self.expr_type(value, function))
+            # and, or return one of operands
+            return t
+        if isinstance(node, ast.Subscript) and not isinstance(node.slice, ast.Slice):
+            return element_type(self.expr_type(node.value, function))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id == 'print':
+                return NONE
+            if node.func.id == 'len' and node.func.id not in self.functions:
+                return INT
+            f = self.functions.get(node.func.id)
+            if f is not None:
+                return f.ret
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'append':
+            return NONE
+        return ANY
+
+    def _set(self, scope, name, t):
+        t = join(scope.get(name), t)
+        if scope.get(name) != t:
+            scope[name] = t
+            self.changed = True
+
+    def _set_target(self, target, t, function):
+        if isinstance(target, ast.Name):
+            self._set(self._scope(target.id, function), target.id, t)
+        elif isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name):
+            # item of list
+            self._set(self._scope(target.value.id, function), target.value.id, list_of(t))
+
+    def _pass(self, body, function):
+        for stmt in body:
+            for node in ast.walk(stmt):
+                if isinstance(node, ast.Assign):
+                    t = self.expr_type(node.value, function)
+                    for target in node.targets:
+                        self._set_target(target, t, function)
+                elif isinstance(node, ast.AugAssign):
+                    t = binop_type(node.op, self.expr_type(node.target, function), self.expr_type(node.value, function))
+                    self._set_target(node.target, t, function)
+                elif isinstance(node, ast.For):
+                    t = INT if is_range(node.iter) else element_type(self.expr_type(node.iter, function))
+                    self._set_target(node.target, t, function)
+                elif isinstance(node, ast.Return) and function is not None:
+                    t = NONE if node.value is None else self.expr_type(node.value, function)
+                    if join(function.ret, t) != function.ret:
+                        function.ret = join(function.ret, t)
+                        self.changed = True
+                elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                    f = self.functions.get(node.func.id)
+                    if f is None:
+                        continue
+                    for param, arg in zip(f.params, node.args):
+                        self._set(f.names, param, self.expr_type(arg, function))
+                        if param in f.mutated and param not in f.rebound and is_list(f.names[param]):
+                            # list changed in place by function is same list as argument
+                            self._set_target(arg, f.names[param], function)
+                elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                      and node.func.attr == 'append' and isinstance(node.func.value, ast.Name) and len(node.args) == 1):
+                    name = node.func.value.id
+                    self._set(self._scope(name, function), name, list_of(self.expr_type(node.args[0], function)))
+
+    def _solve(self):
+        for f in self.functions.values():
+            if f.falls_off:
+                f.ret = join(f.ret, NONE)
+        self.changed = True
+        while self.changed:
+            self.changed = False
+            self._pass(self.module_body, None)
+            for f in self.functions.values():
+                self._pass(f.node.body, f)
+
+
+def test_types():
+    t = types(ast.parse('\n'.join([
+        'def add(a, b):',
+        '    return a',
+        'def show(x):',
+        '    print(x)',
+        'def fact(n):',
+        '    return fact(n)',
+        'def unused(u):',
+        '    return u',
+        's = "x"',
+        'v = add(1, 2)',
+        'w = add(v, 3)',
+        'm = 1',
+        'm = "m"',
+        'r = show(1.5)',
+        'show(2.5)',
+    ])))
+    assert t.globals == {'s': STR, 'v': INT, 'w': INT, 'm': ANY, 'r': NONE}, t.globals
+    f = t.functions
+    assert (f['add'].param_types(), f['add'].ret_type()) == ([INT, INT], INT)
+    assert (f['show'].param_types(), f['show'].ret_type()) == ([FLOAT], 'void')
+    # never known: any
+    assert (f['fact'].param_types(), f['fact'].ret_type()) == ([ANY], ANY)
+    assert (f['unused'].param_types(), f['unused'].ret_type()) == ([ANY], ANY)
+    # local variable and module variable of same name
+    t = types(ast.parse('def f(a):\n    x = a\n    return x\nx = "s"\ny = f(1.0)\n'))
+    assert t.functions['f'].names == {'a': FLOAT, 'x': FLOAT}
+    assert t.globals == {'x': STR, 'y': FLOAT}
+    # returns value on one path only
+    t = types(ast.parse('def g(a):\n    if a:\n        return 1\n'))
+    assert t.functions['g'].ret == ANY
+    # lists, loops, arithmetic
+    t = types(ast.parse('\n'.join([
+        'def fill(v, n):',
+        '    for i in range(n):',
+        '        v.append(i / 2)',
+        'def first(w):',
+        '    return w[0] * 2',
+        'a = []',
+        'fill(a, 3)',
+        'b = [1, 2] + [3]',
+        'c = first(b) > 1',
+        'd = -b[0] // 2',
+        'for s in ["x"]:',
+        '    s += "y"',
+        'e = [[]]',
+        'e[0].append(1)',
+    ])))
+    assert t.globals == {'a': list_of(FLOAT), 'b': list_of(INT), 'c': BOOL, 'd': INT, 's': STR,
+                         'e': list_of(list_of(None))}, t.globals
+    assert t.functions['fill'].names == {'v': list_of(FLOAT), 'n': INT, 'i': INT}
+    assert t.functions['fill'].param_decls() == ['std::vector<double>&', 'int64_t']
+    assert t.functions['first'].param_decls() == ['std::vector<int64_t> const&']
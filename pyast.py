@@ -1,34 +1,154 @@
 #!/usr/bin/env python3
 
 import os, sys
+import argparse
+import subprocess
 import json
 import ast
+import hashlib
 from pprint import pprint
 from typing import List, Set, Dict, Tuple, Any, Callable
 from enum import Enum
-from copy import copy, deepcopy
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from ast_cache import cache_from_env, converter_tag
+from ast_dataflow import dataflow, scopes_dict, test_dataflow
+from ast_moves import summary, find_moves, test_moves
+import flat_tree
+import ast_json
+import ast_stats
+from flat_tree import node_view
+
+# location attributes, not part of values of node
+LOC_FIELDS = ('lineno', 'col_offset', 'end_lineno', 'end_col_offset')
+
+# attribute values stored as is, bool is int
+SCALAR_TYPES = (str, int, float, type(None))
+
+# same output as json.dumps(..., sort_keys=True), without creating encoder for each node
+_canonical_encoder = json.JSONEncoder(sort_keys=True)
+
+def node_hash(fields, children):
+    """
+    Merkle hash of a node: md5 of its own fields plus hashes of its children,
+    same as in ast-dump.py
+    """
+    canonical = _canonical_encoder.encode([fields, children])
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
 
 def node_to_dict(node):
-    type_name = type(node).__name__
-    node_id = id(node)
-    tree_node = {'_id':node_id, '_type':type_name}
-    for k,v in node.__dict__.items():
-        if isinstance(v, str) or isinstance(v, int) or isinstance(v, float) or v is None:
-            tree_node[k] = v
-        elif isinstance(v, list):
-            res = []
-            for item in v:
-                res.append(node_to_dict(item))
-            tree_node[k] = res
+    """
+    Convert ast node with subtree to tree of dicts, without recursion:
+    first pass creates dicts in pre-order, second pass in reverse pre-order
+    computes hashes and weights from already finished children.
+    """
+    order = []
+    root = None
+    # (ast node, parent dict, key in parent, index in list or None)
+    stack = [(node, None, None, None)]
+    while stack:
+        node, parent, key, index = stack.pop()
+        tree_node = {'_id':id(node), '_type':type(node).__name__}
+        if parent is None:
+            root = tree_node
+        elif index is not None:
+            parent[key][index] = tree_node
         else:
-            tree_node[k] = node_to_dict(v)
-    return tree_node
-
-def parse_file(filename):
-    with open(filename) as f:
+            parent[key] = tree_node
+        order.append(tree_node)
+        children = []
+        for k,v in node.__dict__.items():
+            if isinstance(v, SCALAR_TYPES):
+                tree_node[k] = v
+            elif isinstance(v, list):
+                if len(v) > 0 and isinstance(v[0], str):
+                    # names of Global and Nonlocal
+                    tree_node[k] = v
+                else:
+                    # None items (kw_defaults, keys of dict unpacking) stay None
+                    tree_node[k] = [None] * len(v)
+                    for i, item in enumerate(v):
+                        if item is not None:
+                            children.append((item, tree_node, k, i))
+            elif isinstance(v, ast.AST):
+                # placeholder keeps order of keys
+                tree_node[k] = None
+                children.append((v, tree_node, k, None))
+            else:
+                # bytes, complex and Ellipsis constants
+                tree_node[k] = repr(v)
+        children.reverse()
+        stack.extend(children)
+
+    ast_stats.count('nodes converted', len(order))
+    with ast_stats.phase('hash'):
+        for tree_node in reversed(order):
+            type_name = tree_node['_type']
+            # values compared by ast_node_comparator, children by their hashes
+            value_fields = {'__type': type_name}
+            value_children = {}
+            tree_children = {}
+            # same weight as in ast-dump.py: 1 for node, 1 for each attribute and weights of children
+            weight = 1
+            for k,v in tree_node.items():
+                if k[0] == '_' or k in LOC_FIELDS:
+                    continue
+                weight += 1
+                if isinstance(v, dict):
+                    value_children[k] = v['_val_hash']
+                    tree_children[k] = v['_tree_hash']
+                    weight += v['_weight']
+                elif isinstance(v, list) and (len(v) == 0 or not isinstance(v[0], str)):
+                    value_children[k] = [None if item is None else item['_val_hash'] for item in v]
+                    tree_children[k] = [None if item is None else item['_tree_hash'] for item in v]
+                    for item in v:
+                        if item is not None:
+                            weight += item['_weight']
+                else:
+                    value_fields[k] = v
+            tree_node['_val_hash'] = node_hash(value_fields, value_children)
+            tree_node['_tree_hash'] = node_hash({'__type': type_name}, tree_children)
+            tree_node['_weight'] = weight
+
+    return root
+
+def parse_file(filename, cache=None, flat=False):
+    with open(filename, 'rb') as f:
         code = f.read()
-    ast_tree = ast.parse(code)
-    return node_to_dict(ast_tree)
+    return parse_source(code, cache, flat)
+
+def parse_source(code: bytes, cache=None, flat=False):
+    """
+    With flat returns root view of flat_tree.flat_tree instead of nested dicts
+    """
+    ast_stats.count('bytes parsed', len(code))
+    if cache is not None:
+        with ast_stats.phase('cache'):
+            key = cache.key(b'flat\0' + code if flat else code)
+            tree = cache.get(key)
+        if tree is not None:
+            ast_stats.count('cache hits')
+            return flat_tree.flat_tree.from_tuple(tree).root() if flat else tree
+        ast_stats.count('cache misses')
+    with ast_stats.phase('parse'):
+        ast_tree = ast.parse(code)
+    if flat:
+        with ast_stats.phase('convert'):
+            ft = flat_tree.flat_tree.from_ast(ast_tree, flat_tree.SCHEMA_PYAST)
+        ast_stats.count('nodes converted', len(ft))
+        if cache is not None:
+            with ast_stats.phase('cache'):
+                cache.put(key, ft.to_tuple())
+        return ft.root()
+    with ast_stats.phase('convert'):
+        tree = node_to_dict(ast_tree)
+    if cache is not None:
+        with ast_stats.phase('cache'):
+            cache.put(key, tree)
+    return tree
 
 
 # TODO:
@@ -108,7 +228,7 @@ def parse_file(filename):
 
 # Change representation:
 # - for each node with _id and _type add _changed key
-# - for each keys except starting from underline, lineno, col_offset
+# - for each keys except starting from underline, lineno, col_offset, end_lineno, end_col_offset
 #   - list:
 #     - compare list of elements and save result into _changed[key]
 #       - compare each element in new list with each element in old
@@ -128,7 +248,16 @@ def jprint(x):
         d = x.to_dict()
     else:
         d = x
-    print(json.dumps(d, indent=4))
+    with ast_stats.phase('serialize'):
+        # write encoded blocks as they are ready instead of building the whole string
+        chunks = ast_json.iterencode(d, indent=4)
+        while True:
+            block = ''.join(islice(chunks, 4096))
+            if not block:
+                break
+            ast_stats.count('bytes serialized', len(block))
+            sys.stdout.write(block)
+        sys.stdout.write('\n')
 
 def print_modification(mod):
     _mod_type = {
@@ -144,7 +273,8 @@ def print_modification(mod):
 # for example modification function body can be compared that way
 # while modifications of array initializer, or argument list may require different set of allowed modifications
 #TODO: Consider compare structure of objects and return 3-tuple of bool flags
-def compare_lists(before: List[Any], after: List[Any], compare_object_callback: Callable[[Any, Any], Tuple[bool, bool]]
+def compare_lists(before: List[Any], after: List[Any], compare_object_callback: Callable[[Any, Any], Tuple[bool, bool]],
+    type_key: Callable[[Any], Any] = None, value_key: Callable[[Any], Any] = None
     )-> Tuple[List[List[int]], List[Tuple[int, int]]]:
     """
     compare_object_callback - return tuple of bool flags: (same_type, same_values)
@@ -152,6 +282,10 @@ def compare_lists(before: List[Any], after: List[Any], compare_object_callback:
                               (True, False) => updated object
                               (False, None) => replaced object
 
+    type_key, value_key - optional hashable keys consistent with compare_object_callback:
+                          same type_key <=> same_type, same value_key <=> same_type and same_values.
+                          If given, lists are aligned with align_lists without comparison matrix.
+
     Types of changes in order of priority:
         - reorder (same type anv value):
             - copy into multiple places
@@ -162,8 +296,12 @@ def compare_lists(before: List[Any], after: List[Any], compare_object_callback:
             - insert new, append, prepend
             - remove
     """
+    if type_key is not None and value_key is not None:
+        return align_lists(before, after, type_key, value_key)
+
     m = []
 
+    ast_stats.count('matrix cells', len(before) * len(after))
     for dst_el in after:
         n = []
         for src_el in before:
@@ -236,10 +374,84 @@ def calculate_list_diff(m: List[List[Tuple[int, int]]], src_count=None, dst_coun
     return src, dst
 
 
+def closest_index(indexes: List[int], i: int) -> int:
+    """
+    Index from sorted list closest to i, smaller one on tie, -1 for empty list
+    """
+    if not indexes:
+        return -1
+    pos = bisect_left(indexes, i)
+    if pos == 0:
+        return indexes[0]
+    if pos == len(indexes):
+        return indexes[-1]
+    left, right = indexes[pos - 1], indexes[pos]
+    return left if i - left <= right - i else right
+
+
+def align_lists(before: List[Any], after: List[Any], type_key: Callable[[Any], Any], value_key: Callable[[Any], Any]
+    )-> Tuple[List[List[int]], List[Tuple[int, int]]]:
+    """
+    Same result as calculate_list_diff over full comparison matrix in O((n + m) log n):
+    each rule of calculate_list_diff takes the closest source element with the same value
+    or the same type, which is a lookup in sorted bucket of source indexes.
+    """
+    src_count = len(before)
+    dst_count = len(after)
+
+    by_value = {}
+    by_type = {}
+    for src_i, src_el in enumerate(before):
+        by_value.setdefault(value_key(src_el), []).append(src_i)
+        by_type.setdefault(type_key(src_el), []).append(src_i)
+
+    src = [[] for i in range(src_count)]
+    dst = [(-1, -1) for i in range(dst_count)]
+
+    # Look for copy from source
+    for dst_i, dst_el in enumerate(after):
+        source_index = closest_index(by_value.get(value_key(dst_el)), dst_i)
+        if source_index >= 0:
+            dst[dst_i] = (source_index, 0)
+            src[source_index].append(dst_i)
+
+    # Look for updated copy from source
+    for dst_i, dst_el in enumerate(after):
+        if dst[dst_i][0] >= 0:
+            continue
+        source_index = closest_index(by_type.get(type_key(dst_el)), dst_i)
+        if source_index >= 0 and ((len(src) > dst_i and len(src[dst_i]) == 0) or source_index == dst_i):
+            dst[dst_i] = (source_index, 1)
+            src[source_index].append(dst_i)
+
+    for dst_i in range(dst_count):
+        if dst[dst_i][0] >= 0:
+            continue
+        # Check for replace
+        if len(src) > dst_i and len(src[dst_i]) == 0:
+            dst[dst_i] = (dst_i, 2)
+            src[dst_i].append(dst_i)
+            continue
+
+        # Fallback to insert
+        dst[dst_i] = (-1, 3)
+
+    for src_i, src_el in enumerate(src):
+        src[src_i] = sorted(src_el)
+
+    return src, dst
+
+
 def test_compare_lists(verbose: bool = False):
     def simple_cmp(x, y):
         return type(x) == type(y), x == y
 
+    def simple_type_key(x):
+        return type(x)
+
+    def simple_value_key(x):
+        return type(x), x
+
     tests = [
         (([0], [0]),       ([[0]], [(0, 0)])), # copy
         (([0], [1]),       ([[0]], [(0, 1)])), # update
@@ -274,43 +486,62 @@ def test_compare_lists(verbose: bool = False):
         expected_output = test[1]
 
         output = compare_lists(args[0], args[1], simple_cmp)
+        aligned_output = compare_lists(args[0], args[1], simple_cmp, simple_type_key, simple_value_key)
 
-        if verbose or output != expected_output:
+        if verbose or output != expected_output or aligned_output != expected_output:
             print(f'input: arg1={args[0]}, arg2={args[1]}')
             print(f'output: {output}')
-            if output != expected_output:
+            print(f'aligned output: {aligned_output}')
+            if output != expected_output or aligned_output != expected_output:
                 print(f'expected output: {expected_output}')
         assert output == expected_output
+        assert aligned_output == expected_output
 
 
 
 
-def ast_list_compare(seq1: List[Dict[str, Any]], seq2: List[Dict[str, Any]]):
+def compare_hashes(before: Dict[str, Any], after: Dict[str, Any]):
     """
-
+    Same result as ast_node_comparator()(before, after), but in O(1) from precomputed hashes
     """
-    modified = False
-    comparators = []
-    m = []
-    for dst_el in seq2:
-        comp = []
-        n = []
-        for src_el in seq1:
-            c = ast_node_comparator()
-            comp.append(c)
-            n.append(c(src_el, dst_el))
-        m.append(n)
-        comparators.append(comp)
+    if before is None or after is None:
+        # None items of lists
+        return (before is after, before is after or None)
+    if before['_type'] != after['_type']:
+        return (False, None)
+    if before.get('_val_hash') is None or after.get('_val_hash') is None:
+        return ast_node_comparator()(before, after)
+    return (True, before['_val_hash'] == after['_val_hash'])
+
 
-    #jprint(seq1)
-    #jprint(seq2)
-    #jprint(m)
+def node_type_key(node: Dict[str, Any]):
+    return None if node is None else node['_type']
 
-    src, dst = calculate_list_diff(m, len(seq1), len(seq2))
+
+def node_value_key(node: Dict[str, Any]):
+    # value hash covers type too
+    return None if node is None else node['_val_hash']
+
+
+def ast_list_compare(seq1: List[Dict[str, Any]], seq2: List[Dict[str, Any]]):
+    """
+    Generator: yields (comparator, before, after) for updated pairs to be compared
+    by caller (ast_node_comparator), returns (changed, (src_attr, dst_attr), modified)
+    """
+    modified = False
+    if all(el is None or '_val_hash' in el for el in seq1) and all(el is None or '_val_hash' in el for el in seq2):
+        ast_stats.count('aligned lists')
+        src, dst = align_lists(seq1, seq2, node_type_key, node_value_key)
+    else:
+        ast_stats.count('matrix cells', len(seq1) * len(seq2))
+        m = []
+        for dst_el in seq2:
+            m.append([compare_hashes(src_el, dst_el) for src_el in seq1])
+        src, dst = calculate_list_diff(m, len(seq1), len(seq2))
     # store changes summary in any case
     changed = (src, dst)
 
-    # select where store deepcopy and where comparator
+    # select where store reference and where comparator
     src_attr = [None]*len(src)
     dst_attr = [None]*len(dst)
     for dst_i, dst_el in enumerate(dst):
@@ -318,28 +549,62 @@ def ast_list_compare(seq1: List[Dict[str, Any]], seq2: List[Dict[str, Any]]):
             #TODO: store value that was copied or not? store hash will be useful for checking appliability of patch?
             pass
         if dst_el[1] == 1: # updated
-            # store comparator
-            dst_attr[dst_i] = comparators[dst_i][dst_el[0]]
+            # store comparator, only updated pairs are compared recursively
+            c = ast_node_comparator()
+            yield c, seq1[dst_el[0]], seq2[dst_i]
+            dst_attr[dst_i] = c
             modified = True
         if dst_el[1] == 2: # replaced
             # store both values
-            src_attr[dst_el[0]] = deepcopy(seq1[dst_el[0]])
-            dst_attr[dst_i] = deepcopy(seq2[dst_i])
+            src_attr[dst_el[0]] = node_ref(seq1[dst_el[0]])
+            dst_attr[dst_i] = node_ref(seq2[dst_i])
             modified = True
         if dst_el[1] == 3: # inserted
             # store only new value
-            dst_attr[dst_i] = deepcopy(seq2[dst_i])
+            dst_attr[dst_i] = node_ref(seq2[dst_i])
             modified = True
 
     for src_i, src_el in enumerate(src):
         if len(src_el) == 0: # removed
             # store only removed value
-            src_attr[src_i] = deepcopy(seq1[src_i])
+            src_attr[src_i] = node_ref(seq1[src_i])
             modified = True
 
     return changed, (src_attr, dst_attr), modified
 
 
+class node_ref:
+    """
+    Reference to subtree of before or after tree, stored in changes instead of copy.
+    Trees are shared with comparator and must not be modified while changes are alive.
+    """
+
+    __slots__ = ('node',)
+
+    def __init__(self, node):
+        self.node = node
+
+    @property
+    def id(self):
+        return self.node['_id'] if isinstance(self.node, (dict, node_view)) else None
+
+    def to_dict(self):
+        if isinstance(self.node, node_view):
+            return self.node.to_dict()
+        if isinstance(self.node, list) and len(self.node) > 0 and isinstance(self.node[0], node_view):
+            return [item.to_dict() for item in self.node]
+        return self.node
+
+    @staticmethod
+    def materialize(value):
+        """
+        Value of change for serialization: referenced subtree, comparator dict or value itself
+        """
+        if isinstance(value, (node_ref, ast_node_comparator)):
+            return value.to_dict()
+        return value
+
+
 class ast_node_comparator:
 
     def __init__(self):
@@ -348,40 +613,93 @@ class ast_node_comparator:
         self.attrs = {}
 
     def to_dict(self):
-        d = {
-            '_type': self.type,
-            '_changed': self.changed,
-        }
+        """
+        Changes as dict, nested comparators are converted with explicit stack
+        """
+        root = {}
+        stack = [(self, root)]
+        while stack:
+            c, d = stack.pop()
+            c._fill_dict(d, stack)
+        return root
+
+    def _fill_dict(self, d, stack):
+        def materialize(value):
+            if isinstance(value, ast_node_comparator):
+                # filled later from stack
+                child = {}
+                stack.append((value, child))
+                return child
+            return node_ref.materialize(value)
+
+        changed = {}
+        for k,v in self.changed.items():
+            if isinstance(v[0], node_ref) or isinstance(v[1], node_ref):
+                changed[k] = (node_ref.materialize(v[0]), node_ref.materialize(v[1]))
+            else:
+                changed[k] = v
+        d['_type'] = self.type
+        d['_changed'] = changed
         attrs = {}
         for k,v in self.attrs.items():
             if isinstance(v, list):
                 assert False
             elif isinstance(v, ast_node_comparator):
-                attrs[k] = v.to_dict()
+                attrs[k] = materialize(v)
             elif isinstance(v, tuple) and len(v) == 2 and isinstance(v[0], list) and isinstance(v[1], list):
                 attrs[k] = (
-                    [el.to_dict() if isinstance(el, ast_node_comparator) else el for el in v[0]],
-                    [el.to_dict() if isinstance(el, ast_node_comparator) else el for el in v[1]]
+                    [materialize(el) for el in v[0]],
+                    [materialize(el) for el in v[1]]
                 )
             else:
                 attrs[k] = v
         d['_attrs'] = attrs
-        return d
 
     def __repr__(self):
-        return json.dumps(self.to_dict())
+        return ast_json.dumps(self.to_dict())
 
 
     def __call__(self, before: Dict[str, Any], after: Dict[str, Any]):
+        """
+        Compare trees, returns (same type, same value).
+        Nested comparisons are run with explicit stack of _compare generators,
+        depth of trees is not limited by recursion.
+        """
+        stack = [self._compare(before, after)]
+        comparisons = 1
+        result = None
+        while True:
+            try:
+                c, value1, value2 = stack[-1].send(result)
+            except StopIteration as e:
+                stack.pop()
+                result = e.value
+                if len(stack) == 0:
+                    ast_stats.count('comparisons', comparisons)
+                    return result
+                continue
+            stack.append(c._compare(value1, value2))
+            comparisons += 1
+            result = None
+
+    def _compare(self, before: Dict[str, Any], after: Dict[str, Any]):
+        """
+        Generator: yields (comparator, before, after) for nested comparisons
+        and gets their results, returns (same type, same value)
+        """
         if before['_type'] != after['_type']:
             return (False, None)
 
         self.type = after['_type']
 
+        # equal subtrees, nothing to descend into
+        if before.get('_val_hash') is not None and before['_val_hash'] == after.get('_val_hash'):
+            return (True, True)
+
         keys1 = set(before.keys())
         keys2 = set(after.keys())
 
-        exclude = set(['lineno', 'col_offset'])
+        exclude = set(LOC_FIELDS)
         keys1 = [key for key in keys1 if key not in exclude and key[0] != '_']
         keys2 = [key for key in keys2 if key not in exclude and key[0] != '_']
 
@@ -391,23 +709,27 @@ class ast_node_comparator:
             value1 = before[key]
             value2 = after[key]
 
-            assert type(value1) == type(value2)
+            if type(value1) != type(value2):
+                # None <-> node, or constant of other type
+                self.changed[key] = (node_ref(value1), node_ref(value2))
+                continue
 
-            if isinstance(value1, str) or isinstance(value1, int) or isinstance(value1, float) or value1 is None:
+            if isinstance(value1, str) or isinstance(value1, int) or isinstance(value1, float) or value1 is None or \
+                    (isinstance(value1, list) and len(value1) > 0 and isinstance(value1[0], str)):
                 if not value1 == value2:
-                    self.changed[key] = (copy(value1), copy(value2))
+                    self.changed[key] = (value1, value2)
 
             elif isinstance(value1, list):
-                changed, attr, modified = ast_list_compare(value1, value2)
+                changed, attr, modified = yield from ast_list_compare(value1, value2)
                 if modified:
                     self.changed[key] = changed
                     self.attrs[key] = attr
 
             else:
                 c = ast_node_comparator()
-                same_type, same_val = c(value1, value2)
+                same_type, same_val = yield c, value1, value2
                 if not same_type:
-                    self.changed[key] = (deepcopy(value1), deepcopy(value2))
+                    self.changed[key] = (node_ref(value1), node_ref(value2))
                 elif not same_val:
                     self.attrs[key] = c
 
@@ -419,27 +741,583 @@ class ast_node_comparator:
 
 
 
-def main():
-    test_compare_lists()
+def node_type(node: Dict[str, Any]) -> str:
+    """
+    Type of node of pyast.py (_type) or ast-dump.py (__type) tree
+    """
+    return node['_type'] if '_type' in node else node['__type']
+
+
+class postorder_tree:
+    """
+    Tree flattened in post-order for tree edit distance.
+
+    For each node: type, tuple of scalar values, own cost (_weight without
+    weights of children), leftmost leaf and signature - hash of type, values
+    and signatures of children, without locations, equal for equal subtrees.
+    """
+
+    def __init__(self, tree: Dict[str, Any]):
+        self.types = []
+        self.values = []
+        self.costs = []
+        self.leftmost = []
+        self.signatures = []
+
+        # explicit stack of (node, expanded), and signatures of children of expanded nodes
+        stack = [(tree, False)]
+        first_leaf = []
+        child_signatures = [[]]
+        while stack:
+            node, expanded = stack.pop()
+            if not expanded:
+                stack.append((node, True))
+                first_leaf.append(len(self.types))
+                child_signatures.append([])
+                for child in reversed(list(child_nodes(node))):
+                    stack.append((child, False))
+                continue
+            children_weight = 0
+            values = []
+            for k,v in node.items():
+                if k[0] == '_' or k in LOC_FIELDS:
+                    continue
+                if isinstance(v, (dict, node_view)):
+                    children_weight += v.get('_weight', 1)
+                elif isinstance(v, list) and len(v) > 0 and not isinstance(v[0], str):
+                    children_weight += sum(item.get('_weight', 1) for item in v if item is not None)
+                else:
+                    values.append(v if not isinstance(v, list) else tuple(v))
+            t = node_type(node)
+            values = tuple(values)
+            signature = hash((t, values, tuple(child_signatures.pop())))
+            child_signatures[-1].append(signature)
+            self.leftmost.append(first_leaf.pop())
+            self.types.append(t)
+            self.values.append(values)
+            self.costs.append(max(1, node.get('_weight', 1 + len(values)) - children_weight))
+            self.signatures.append(signature)
+
+        # keyroots: highest node for each leftmost leaf
+        last = {}
+        for i, l in enumerate(self.leftmost):
+            last[l] = i
+        self.keyroots = sorted(last.values())
+
+        # prefix sums of costs: weight of nodes [a, b) in post-order is prefix[b] - prefix[a]
+        self.prefix = [0]
+        for c in self.costs:
+            self.prefix.append(self.prefix[-1] + c)
+
+    def __len__(self):
+        return len(self.types)
+
+    def type_mass(self):
+        mass = {}
+        for t, c in zip(self.types, self.costs):
+            mass[t] = mass.get(t, 0) + c
+        return mass
+
+
+def child_nodes(node: Dict[str, Any]):
+    """
+    Child nodes of tree node in order of attributes
+    """
+    for k,v in node.items():
+        if k[0] == '_':
+            continue
+        if isinstance(v, (dict, node_view)):
+            yield v
+        elif isinstance(v, list) and len(v) > 0 and not isinstance(v[0], str):
+            yield from (item for item in v if item is not None)
+
+
+def distance_lower_bound(t1: postorder_tree, t2: postorder_tree) -> int:
+    """
+    Lower bound of tree edit distance in O(n):
+    delete or insert of node of type T changes cost mass of T by its cost and costs the same,
+    rename of T1 to T2 costs cost1 + cost2 and changes masses by no more than that.
+    """
+    mass1 = t1.type_mass()
+    mass2 = t2.type_mass()
+    return sum(abs(mass1.get(t, 0) - mass2.get(t, 0)) for t in set(mass1) | set(mass2))
+
+
+def tree_edit_distance(tree1: Dict[str, Any], tree2: Dict[str, Any], limit: int = None):
+    """
+    Code distance (TODO 4): weighted number of modifications between two trees,
+    Zhang-Shasha tree edit distance with costs from _weight:
+        - delete or insert node: its own weight (_weight without weights of children)
+        - rename node of same type: number of changed values
+        - rename node to other type: delete + insert
+
+    With limit returns None if distance is greater than limit: either rejected
+    by O(n) lower bounds, or computed only over cells of distance matrices
+    which can be within limit.
+
+    Trees can be given as postorder_tree to reuse them for many comparisons.
+    """
+    t1 = tree1 if isinstance(tree1, postorder_tree) else postorder_tree(tree1)
+    t2 = tree2 if isinstance(tree2, postorder_tree) else postorder_tree(tree2)
+
+    if t1.signatures[-1] == t2.signatures[-1]:
+        return 0
+
+    lower_bound = max(abs(t1.prefix[-1] - t2.prefix[-1]), distance_lower_bound(t1, t2))
+    if limit is not None:
+        if lower_bound > limit:
+            return None
+        return _zhang_shasha(t1, t2, limit)
+
+    # exact distance: bounded runs with growing limit, bounded run computes only
+    # a band of cells, so close trees are compared much faster than in one full run
+    total = t1.prefix[-1] + t2.prefix[-1]
+    limit = max(lower_bound, 16)
+    while limit < total:
+        distance = _zhang_shasha(t1, t2, limit)
+        if distance is not None:
+            return distance
+        limit *= 4
+    return _zhang_shasha(t1, t2)
+
+
+def _zhang_shasha(t1: postorder_tree, t2: postorder_tree, limit: int = None):
+    """
+    Zhang-Shasha over pairs of keyroots.  Pairs of keyroots with equal signatures
+    (repeated subtrees, common in code) are computed once.
+
+    With limit only cells which can be within limit are computed and stored.
+    Nodes left of mapped pair are mapped only between themselves, so pair of
+    keyroots is skipped if weights of nodes before their leftmost leaves differ
+    by more than limit, in other pairs only cells where weights of compared
+    forests differ by no more than the rest of limit are computed.  Tree and
+    forest distances are dicts of computed cells, missing cell is out of limit.
+    """
+    n1 = len(t1)
+    n2 = len(t2)
+    types1, values1, costs1, l1, sig1, prefix1 = t1.types, t1.values, t1.costs, t1.leftmost, t1.signatures, t1.prefix
+    types2, values2, costs2, l2, sig2, prefix2 = t2.types, t2.values, t2.costs, t2.leftmost, t2.signatures, t2.prefix
+
+    inf = float('inf')
+    empty = {}
+    # td[x][y]: distance of subtrees x and y
+    td = {}
+
+    def rename_cost(i, j):
+        if types1[i] != types2[j]:
+            return costs1[i] + costs2[j]
+        if sig1[i] == sig2[j] or values1[i] == values2[j]:
+            return 0
+        return sum(1 for a, b in zip(values1[i], values2[j]) if a != b) + abs(len(values1[i]) - len(values2[j]))
+
+    # keyroots of t2 by weight of nodes before their leftmost leaves
+    keyroots2 = sorted(t2.keyroots, key=lambda j: prefix2[l2[j]])
+    before2 = [prefix2[l2[j]] for j in keyroots2]
+    # keyroot of t2 -> (ins, q, on_path2), the same for all keyroots of t1
+    columns = {}
+    # (signature1, signature2) -> (budget, tree distances of left path pairs relative to leftmost leaves)
+    done = {}
+
+    for i in t1.keyroots:
+        li = l1[i]
+        ioff = li - 1
+        rows = i - li + 2
+        # left path of i: nodes x with leftmost leaf li
+        path1 = [x for x in range(1, rows) if l1[x + ioff] == li]
+        if limit is None:
+            candidates = t2.keyroots
+        else:
+            candidates = sorted(keyroots2[bisect_left(before2, prefix1[li] - limit):
+                                          bisect_right(before2, prefix1[li] + limit)])
+        for j in candidates:
+            lj = l2[j]
+            joff = lj - 1
+            base2 = prefix2[lj]
+            budget = None if limit is None else limit - abs(prefix1[li] - base2)
+            key = (sig1[i], sig2[j])
+            memo = done.get(key)
+            if memo is not None and (memo[0] is None or memo[0] >= budget):
+                for x, y, d in memo[1]:
+                    td.setdefault(x + ioff, {})[y + joff] = d
+                continue
+
+            c = columns.get(j)
+            if c is None:
+                ins = costs2[lj:j + 1]
+                # q[y-1]: column of forest before subtree of node y, 0 for nodes on left path of j
+                q = [l2[y] - 1 - joff for y in range(lj, j + 1)]
+                on_path2 = [y for y in range(1, len(q) + 1) if q[y - 1] == 0]
+                c = columns[j] = (ins, q, on_path2)
+            ins, q, on_path2 = c
+            cols = len(q) + 1
+
+            # rows of forests heavier than whole subtree of j by more than budget are out of limit
+            last_row = rows
+            y_to = cols
+            if budget is not None:
+                last_row = min(rows, bisect_right(prefix1, prefix1[li] + prefix2[j + 1] - base2 + budget, li + 1) - ioff)
+                y_to = min(cols, bisect_right(prefix2, base2 + budget, lj + 1) - joff - 1)
+
+            fd = [None] * last_row
+            fd[0] = first = {y: prefix2[lj + y] - base2 for y in range(y_to)}
+            for x in range(1, last_row):
+                xi = x + ioff
+                prev = fd[x-1]
+                prev_get = prev.get
+                row = {}
+                del_cost = costs1[xi]
+                forest1 = prefix1[xi + 1] - prefix1[li]
+                if budget is None:
+                    y_from, y_to = 1, cols
+                    row[0] = prev[0] + del_cost
+                else:
+                    y_from = max(1, bisect_left(prefix2, base2 + forest1 - budget, lj + 1) - joff - 1)
+                    y_to = min(cols, bisect_right(prefix2, base2 + forest1 + budget, lj + 1) - joff - 1)
+                    if forest1 <= budget:
+                        row[0] = prev_get(0, inf) + del_cost
+                left = row.get(y_from - 1, inf)
+                lxi = l1[xi]
+                if lxi == li:
+                    # forest of x is a tree, compare with trees and forests of j
+                    td_x = td.setdefault(xi, {})
+                    for y in range(y_from, y_to):
+                        d = prev_get(y, inf) + del_cost
+                        a = left + ins[y-1]
+                        if a < d:
+                            d = a
+                        if q[y-1] == 0:
+                            a = prev_get(y-1, inf) + rename_cost(xi, y + joff)
+                            if a < d:
+                                d = a
+                            td_x[y + joff] = d
+                        else:
+                            a = first.get(q[y-1], inf) + td_x.get(y + joff, inf)
+                            if a < d:
+                                d = a
+                        row[y] = d
+                        left = d
+                else:
+                    before_x = fd[lxi - 1 - ioff].get
+                    td_x = td.get(xi, empty).get
+                    for y in range(y_from, y_to):
+                        d = prev_get(y, inf) + del_cost
+                        a = left + ins[y-1]
+                        if a < d:
+                            d = a
+                        a = before_x(q[y-1], inf) + td_x(y + joff, inf)
+                        if a < d:
+                            d = a
+                        row[y] = d
+                        left = d
+                fd[x] = row
+
+            pairs = []
+            for x in path1:
+                td_x = td.get(x + ioff, empty)
+                for y in on_path2:
+                    d = td_x.get(y + joff)
+                    if d is not None:
+                        pairs.append((x, y, d))
+            done[key] = (budget, pairs)
+
+    distance = td.get(n1 - 1, empty).get(n2 - 1, inf)
+    if limit is not None and distance > limit:
+        return None
+    return distance
+
+
+def code_difference(tree1: Dict[str, Any], tree2: Dict[str, Any]) -> float:
+    """
+    Difference of two nodes (TODO 5): distance / (weight1 + weight2), from 0.0 to 1.0
+    """
+    t1 = postorder_tree(tree1)
+    t2 = postorder_tree(tree2)
+    total = t1.prefix[-1] + t2.prefix[-1]
+    if total == 0:
+        return 0.0
+    return tree_edit_distance(t1, t2) / total
+
+
+def test_tree_edit_distance():
+    def tree(code):
+        return node_to_dict(ast.parse(code))
+
+    a = tree('x = f(1)')
+    assert tree_edit_distance(a, tree('x = f(1)')) == 0
+    # rename of Name value
+    assert tree_edit_distance(a, tree('y = f(1)')) == 1
+    assert tree_edit_distance(a, tree('y = f(1)'), limit=0) is None
+    assert tree_edit_distance(a, tree('y = f(1)'), limit=1) == 1
+    # insert of second statement costs its weight
+    b = tree('x = f(1)\nz = 2')
+    inserted = b['body'][1]['_weight']
+    assert tree_edit_distance(a, b) == inserted
+    assert tree_edit_distance(b, a) == inserted
+    assert tree_edit_distance(a, b, limit=inserted - 1) is None
+    c = tree('def foo(a, b):\n    return a + b * 2\n')
+    d = tree('def foo(a, c):\n    return a - c * 2\n')
+    assert tree_edit_distance(c, d) == tree_edit_distance(c, d, limit=100) == tree_edit_distance(d, c)
+    assert 0.0 < code_difference(c, d) < 1.0
+
+
+def git_changed_files(rev1, rev2, repo=None):
+    """
+    Changed *.py files between two revisions: list of (status, path, blob1, blob2).
+    git diff-tree compares trees by object id, so unchanged directories and files are never read.
+    """
+    out = subprocess.run(['git', 'diff-tree', '-r', '-z', '--no-renames', rev1, rev2],
+                         cwd=repo, stdout=subprocess.PIPE, check=True).stdout
+    fields = out.split(b'\0')
+    changes = []
+    for meta, path in zip(fields[0::2], fields[1::2]):
+        if not meta:
+            continue
+        mode1, mode2, blob1, blob2, status = meta[1:].decode().split(' ')
+        path = os.fsdecode(path)
+        if not path.endswith('.py') or blob1 == blob2:
+            continue
+        changes.append((status, path, blob1, blob2))
+    return changes
+
+
+class git_blob_reader:
+    """
+    Read blobs straight from object store with single `git cat-file --batch` process
+    """
+
+    def __init__(self, repo=None):
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repo,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, blob):
+        # added or removed file
+        if blob.strip('0') == '':
+            return b''
+        self.proc.stdin.write(blob.encode() + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) < 3:
+            raise KeyError(blob)
+        size = int(header[2])
+        data = self.proc.stdout.read(size)
+        self.proc.stdout.read(1)
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def diff_sources(item, flat=False):
+    """
+    Process pool worker: compare two versions of file
+    """
+    status, path, code1, code2 = item
+    try:
+        tree1 = parse_source(code1, flat=flat)
+        tree2 = parse_source(code2, flat=flat)
+    except (SyntaxError, ValueError, RecursionError) as e:
+        return path, status, None, f'{type(e).__name__}: {e}'
+    c = ast_node_comparator()
+    with ast_stats.phase('compare'):
+        same_type, same_val = c(tree1, tree2)
+    if same_val:
+        return path, status, None, None
+    return path, status, c.to_dict(), None
+
+
+def summarize_sources(item):
+    """
+    Process pool worker: summaries of two versions of file for find_moves()
+    """
+    status, path, code1, code2 = item
+    try:
+        summary1 = summary(parse_source(code1))
+        summary2 = summary(parse_source(code2))
+    except (SyntaxError, ValueError, RecursionError) as e:
+        return path, status, None, None, f'{type(e).__name__}: {e}'
+    return path, status, summary1, summary2, None
+
+
+def git_changed_sources(rev1, rev2, repo=None):
+    """
+    Changed *.py files between two revisions: list of (status, path, source1, source2)
+    """
+    with ast_stats.phase('git'):
+        changes = git_changed_files(rev1, rev2, repo)
+        reader = git_blob_reader(repo)
+        items = [(status, path, reader.read(blob1), reader.read(blob2)) for status, path, blob1, blob2 in changes]
+        reader.close()
+    return items
+
+
+def git_moves(rev1, rev2, repo=None, jobs=None):
+    """
+    Functions and classes moved or renamed between two git revisions across all changed files,
+    see ast_moves.py. Files are summarized in process pool, summaries are joined by hashes.
+    """
+    items = git_changed_sources(rev1, rev2, repo)
+    worker = ast_stats.traced(summarize_sources)
+    executor = None
+    if jobs == 1 or len(items) < 2:
+        results = map(worker, items)
+    else:
+        executor = ProcessPoolExecutor(jobs)
+        results = executor.map(worker, items, chunksize=max(1, len(items) // (8 * (jobs or os.cpu_count() or 1))))
+
+    before = {}
+    after = {}
+    errors = {}
+    try:
+        for path, status, summary1, summary2, error in ast_stats.untraced(results):
+            if error is not None:
+                errors[path] = {'status': status, 'error': error}
+                continue
+            if status != 'A':
+                before[path] = summary1
+            if status != 'D':
+                after[path] = summary2
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    with ast_stats.phase('moves'):
+        result = {'moves': find_moves(before, after)}
+    if len(errors) > 0:
+        result['errors'] = errors
+    return result
+
+
+def iter_git_diff(rev1, rev2, repo=None, jobs=None, flat=False):
+    """
+    Compare changed *.py files between two git revisions in process pool, without checkouts.
+    Yields (path, result) in order of paths as soon as each file is compared.
+    """
+    items = git_changed_sources(rev1, rev2, repo)
+    worker = ast_stats.traced(partial(diff_sources, flat=flat))
+    executor = None
+    if jobs == 1 or len(items) < 2:
+        results = map(worker, items)
+    else:
+        executor = ProcessPoolExecutor(jobs)
+        results = executor.map(worker, items)
+
+    try:
+        for path, status, changed, error in ast_stats.untraced(results):
+            if error is not None:
+                yield path, {'status': status, 'error': error}
+            elif changed is not None:
+                yield path, {'status': status, 'changes': changed}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
 
-    if len(sys.argv) == 1:
-        jprint(parse_file(sys.argv[0]))
-        exit(0)
+def git_diff(rev1, rev2, repo=None, jobs=None, flat=False):
+    """
+    Changes of *.py files between two git revisions as dict: path -> result
+    """
+    return dict(iter_git_diff(rev1, rev2, repo, jobs, flat))
 
-    if len(sys.argv) == 2:
-        jprint(parse_file(sys.argv[1]))
-        exit(0)
 
-    if len(sys.argv) == 3:
-        tree1 = parse_file(sys.argv[1])
-        tree2 = parse_file(sys.argv[2])
+def run_tests():
+    test_compare_lists()
+    test_tree_edit_distance()
+    ast_json.test_iterencode()
+    ast_stats.test_stats()
+    test_dataflow()
+    test_moves()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print AST of Python file or diff of two files.')
+    parser.add_argument('files', metavar='file.py', nargs='*',
+                        help='one file to print, or two files to compare')
+    parser.add_argument('--git', nargs=2, metavar=('REV1', 'REV2'),
+                        help='compare *.py files changed between two git revisions')
+    parser.add_argument('--repo', default=None,
+                        help='git repository for --git (default: current directory)')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes for --git (default: number of CPUs)')
+    parser.add_argument('--flat', action='store_true',
+                        help='convert to compact array-backed trees (flat_tree.py) instead of nested dicts')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='with --git, write result of each file as one line as soon as it is compared')
+    parser.add_argument('--moves', action='store_true',
+                        help='with --git or two files, print functions and classes moved or renamed, '
+                             'renames with their usages')
+    parser.add_argument('--dataflow', action='store_true',
+                        help='with two files, print data-flow graphs of scopes of second file changed since first one')
+    parser.add_argument('--stats', nargs='?', const='text', choices=('text', 'json'), default=None,
+                        help='write time of phases and counters to stderr, as table or JSON')
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help='save cProfile stats to FILE and write hottest calls to stderr '
+                             '(work of worker processes is profiled with -j 1 only)')
+    parser.add_argument('--test', action='store_true',
+                        help='run self-tests and exit')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.test:
+        run_tests()
+        return
+    with ast_stats.session(args.stats, args.profile):
+        run(args)
+
+
+def run(args):
+    if args.git:
+        if args.moves:
+            jprint(git_moves(args.git[0], args.git[1], args.repo, args.jobs))
+            return
+        if args.ndjson:
+            for path, result in iter_git_diff(args.git[0], args.git[1], args.repo, args.jobs, args.flat):
+                line = {'path': path}
+                line.update(result)
+                line = json.dumps(line, separators=(',', ':'))
+                ast_stats.count('bytes serialized', len(line) + 1)
+                print(line, flush=True)
+            return
+        jprint(git_diff(args.git[0], args.git[1], args.repo, args.jobs, args.flat))
+        return
+
+    # persistent parse cache in $AST_CACHE_DIR
+    cache = cache_from_env(converter_tag(__file__) + ',' + converter_tag(flat_tree.__file__))
+
+    if len(args.files) == 0:
+        jprint(parse_file(sys.argv[0], cache, args.flat))
+        return
+
+    if len(args.files) == 1:
+        jprint(parse_file(args.files[0], cache, args.flat))
+        return
+
+    if len(args.files) == 2:
+        tree1 = parse_file(args.files[0], cache, args.flat)
+        tree2 = parse_file(args.files[1], cache, args.flat)
+
+        if args.moves:
+            # two versions of one file
+            summary1 = summary(tree1.to_dict() if args.flat else tree1)
+            summary2 = summary(tree2.to_dict() if args.flat else tree2)
+            jprint({'moves': find_moves({args.files[1]: summary1}, {args.files[1]: summary2})})
+            return
+
+        if args.dataflow:
+            # graphs of unchanged scopes of second tree are taken from first one
+            df = dataflow()
+            df.update(tree1.to_dict() if args.flat else tree1)
+            jprint(scopes_dict(df.update(tree2.to_dict() if args.flat else tree2), True))
+            return
 
         c = ast_node_comparator()
-        c(tree1, tree2)
+        with ast_stats.phase('compare'):
+            c(tree1, tree2)
 
         #jprint(tree1), "\n"*10)
         #jprint(tree2), "\n"*10)
-        print(c)
+        with ast_stats.phase('serialize'):
+            out = repr(c)
+        ast_stats.count('bytes serialized', len(out) + 1)
+        print(out)
 
 
 if __name__ == '__main__':
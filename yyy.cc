@@ -6,23 +6,214 @@
 #include <variant>
 #include <iostream>
 #include <string>
+#include <vector>
+#include <memory>
+#include <algorithm>
+#include <type_traits>
+#include <charconv>
+#include <cmath>
+#include <cstdint>
+#include <limits>
 
-using any = std::variant<int64_t, std::string, void*>;
+struct py_list;
 
-std::ostream& operator<< (std::ostream& os, any const& v) {
-    std::visit([&os](auto const& e){ os << e; }, v);
+using any = std::variant<int64_t, double, bool, std::string, void*, std::shared_ptr<py_list>>;
+
+// list in any, shared like Python list
+struct py_list : std::vector<any> {};
+
+inline any py_any(any const& v) { return v; }
+template <class T> any py_any(T const& v) { return any(v); }
+template <class T> any py_any(std::vector<T> const& v) {
+    auto l = std::make_shared<py_list>();
+    l->reserve(v.size());
+    for (auto const& e : v) {
+        l->push_back(py_any(e));
+    }
+    return l;
+}
+
+// float as Python prints it: shortest repr, fixed notation in [1e-4, 1e16)
+inline std::string py_float(double v) {
+    char buf[32];
+    double a = std::fabs(v);
+    bool fixed = a == 0 || (a >= 1e-4 && a < 1e16);
+    char* end = std::to_chars(buf, buf + sizeof(buf), v,
+                              fixed ? std::chars_format::fixed : std::chars_format::scientific).ptr;
+    std::string s(buf, end);
+    if (fixed && s.find('.') == std::string::npos) {
+        s += ".0";
+    }
+    return s;
+}
+
+// str() and repr() of values
+inline void py_write(std::ostream& os, int64_t v) { os << v; }
+inline void py_write(std::ostream& os, double v) { os << py_float(v); }
+inline void py_write(std::ostream& os, bool v) { os << (v ? "True" : "False"); }
+inline void py_write(std::ostream& os, std::string const& v) { os << v; }
+inline void py_write(std::ostream& os, void* v) { if (v) os << v; else os << "None"; }
+inline void py_write(std::ostream& os, any const& v);
+inline void py_write(std::ostream& os, std::shared_ptr<py_list> const& v);
+template <class T> void py_write(std::ostream& os, std::vector<T> const& v);
+
+inline void py_repr(std::ostream& os, std::string const& v) {
+    char quote = v.find('\'') != std::string::npos && v.find('"') == std::string::npos ? '"' : '\'';
+    os << quote;
+    for (unsigned char c : v) {
+        if (c == '\\' || c == quote) {
+            os << '\\' << c;
+        } else if (c == '\n') {
+            os << "\\n";
+        } else if (c == '\r') {
+            os << "\\r";
+        } else if (c == '\t') {
+            os << "\\t";
+        } else if (c < 0x20 || c == 0x7f) {
+            const char* hex = "0123456789abcdef";
+            os << "\\x" << hex[c >> 4] << hex[c & 15];
+        } else {
+            os << c;
+        }
+    }
+    os << quote;
+}
+inline void py_repr(std::ostream& os, any const& v);
+template <class T> void py_repr(std::ostream& os, T const& v) { py_write(os, v); }
+
+template <class T> void py_write(std::ostream& os, std::vector<T> const& v) {
+    os << '[';
+    for (size_t i = 0; i < v.size(); ++i) {
+        if (i > 0) {
+            os << ", ";
+        }
+        py_repr(os, v[i]);
+    }
+    os << ']';
+}
+inline void py_write(std::ostream& os, std::shared_ptr<py_list> const& v) {
+    py_write(os, static_cast<std::vector<any> const&>(*v));
+}
+inline void py_write(std::ostream& os, any const& v) {
+    std::visit([&os](auto const& e){ py_write(os, e); }, v);
+}
+inline void py_repr(std::ostream& os, any const& v) {
+    std::visit([&os](auto const& e){ py_repr(os, e); }, v);
+}
+
+inline std::ostream& operator<< (std::ostream& os, any const& v) {
+    py_write(os, v);
+    return os;
+}
+
+template <class T> std::ostream& operator<< (std::ostream& os, std::vector<T> const& v) {
+    py_write(os, v);
     return os;
 }
 
+inline bool py_truth(std::string const& v) { return !v.empty(); }
+template <class T> bool py_truth(std::vector<T> const& v) { return !v.empty(); }
+inline bool py_truth(any const& v) {
+    return std::visit([](auto const& e) -> bool {
+        using T = std::decay_t<decltype(e)>;
+        if constexpr (std::is_same_v<T, std::string>) {
+            return !e.empty();
+        } else if constexpr (std::is_same_v<T, std::shared_ptr<py_list>>) {
+            return !e->empty();
+        } else {
+            return e != 0;
+        }
+    }, v);
+}
+
+// arithmetic with Python semantics where it differs from C++
+inline int64_t py_floordiv(int64_t a, int64_t b) {
+    int64_t q = a / b;
+    return (a % b != 0 && (a < 0) != (b < 0)) ? q - 1 : q;
+}
+inline double py_floordiv(double a, double b) { return std::floor(a / b); }
+inline int64_t py_mod(int64_t a, int64_t b) {
+    int64_t r = a % b;
+    return (r != 0 && (r < 0) != (b < 0)) ? r + b : r;
+}
+inline double py_mod(double a, double b) {
+    double r = std::fmod(a, b);
+    return (r != 0 && (r < 0) != (b < 0)) ? r + b : r;
+}
+inline int64_t py_pow(int64_t a, int64_t b) {
+    int64_t r = 1;
+    for (; b > 0; b >>= 1) {
+        if (b & 1) {
+            r *= a;
+        }
+        a *= a;
+    }
+    return r;
+}
+
+inline int64_t py_range_len(int64_t start, int64_t stop, int64_t step) {
+    if (step > 0 ? start >= stop : start <= stop) {
+        return 0;
+    }
+    return step > 0 ? (stop - start + step - 1) / step : (start - stop - step - 1) / -step;
+}
+
+// item at index, negative counts from end
+template <class T> decltype(auto) py_at(std::vector<T>& v, int64_t i) { return v[i < 0 ? i + int64_t(v.size()) : i]; }
+template <class T> decltype(auto) py_at(std::vector<T> const& v, int64_t i) { return v[i < 0 ? i + int64_t(v.size()) : i]; }
+inline char& py_at(std::string& s, int64_t i) { return s[i < 0 ? i + int64_t(s.size()) : i]; }
+inline char py_at(std::string const& s, int64_t i) { return s[i < 0 ? i + int64_t(s.size()) : i]; }
+
+template <class T> std::vector<T> py_concat(std::vector<T> const& a, std::vector<T> const& b) {
+    std::vector<T> r;
+    r.reserve(a.size() + b.size());
+    r.insert(r.end(), a.begin(), a.end());
+    r.insert(r.end(), b.begin(), b.end());
+    return r;
+}
+template <class T> void py_extend(std::vector<T>& a, std::vector<T> const& b) {
+    // b may be a
+    size_t n = b.size();
+    a.reserve(a.size() + n);
+    for (size_t i = 0; i < n; ++i) {
+        a.push_back(b[i]);
+    }
+}
+inline std::string py_repeat(std::string const& s, int64_t n) {
+    std::string r;
+    if (n > 0) {
+        r.reserve(s.size() * n);
+        while (n-- > 0) {
+            r += s;
+        }
+    }
+    return r;
+}
+template <class T> std::vector<T> py_repeat(std::vector<T> const& v, int64_t n) {
+    std::vector<T> r;
+    if (n > 0) {
+        r.reserve(v.size() * n);
+        while (n-- > 0) {
+            r.insert(r.end(), v.begin(), v.end());
+        }
+    }
+    return r;
+}
+
+
+void foo(any a, std::string const& b);
 
-void foo(any a, any b)
+void foo(any a, std::string const& b)
 {
-  std::cout << a << " " << b << std::endl;
+  std::cout << a << ' ' << b << '\n';
 }
 
 int main()
 {
-  foo(a, "X");
+  std::ios::sync_with_stdio(false);
+  any a{};
+  a = py_any(std::vector<int64_t>{0, 1, 2});
+  a = (foo(a, "X"), any(nullptr));
   return 0;
 }
 